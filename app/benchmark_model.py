@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import time
+import tempfile
+
+import sys, os
+sys.path.append(os.path.join(os.path.abspath(''), '..', 'shared_libs'))
+import data_transform
+import tree_ensemble
+
+DATA_PATH = '../shared_libs/data'
+MODELS_PATH = '../shared_libs/data/models'
+MODEL_NAME = 'model_abr'
+
+def measure(predict, X, repeats):
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        predict(X)
+    return (time.perf_counter() - start_time) / repeats
+
+if __name__ == '__main__':
+    # сравнение исходной модели (sklearn) и ее представления в виде массивов (tree_ensemble.TreeEnsemble)
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    df = pd.read_csv(DATA_PATH + '/data_valid.csv', dtype={"zipcode": str})
+
+    artifacts = data_transform.get_serving_artifacts(DATA_PATH, MODELS_PATH, MODEL_NAME)
+    X = data_transform.transform_matrix_for_prediction(data_transform.convert_to_data_frame(df.values), artifacts)
+
+    model = artifacts['model']
+
+    # экспорт в файл и загрузка обратно - тот же путь, что и при поставке модели отдельным файлом
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, MODEL_NAME + '.npz')
+        tree_ensemble.save_tree_ensemble(file_path, tree_ensemble.export_tree_ensemble(model))
+        compiled = tree_ensemble.load_tree_ensemble(file_path)
+
+    y_model = model.predict(X)
+    y_compiled = compiled.predict(X)
+
+    print('Rows:', len(X), 'estimators:', len(compiled.roots), 'nodes:', len(compiled.value))
+    print('Identical predictions:', np.array_equal(y_model, y_compiled), 'max diff:', np.abs(y_model - y_compiled).max())
+
+    # некорректные значения (NaN, бесконечность, переполнение float32) - ошибка в обеих моделях
+    for name, value in [('NaN', np.NaN), ('inf', np.inf), ('float32 overflow', 1e39)]:
+        X_invalid = X.iloc[:2].copy()
+        X_invalid.iloc[0, 0] = value
+
+        errors = []
+        for predict in [model.predict, compiled.predict]:
+            try:
+                predict(X_invalid)
+                errors.append(False)
+            except ValueError:
+                errors.append(True)
+
+        print('Invalid input ({}): sklearn error {}, arrays error {}'.format(name, errors[0], errors[1]))
+
+    for size in [1, 10, 100, 500, len(X)]:
+        X_part = X.iloc[:size]
+
+        model_time = measure(model.predict, X_part, repeats)
+        compiled_time = measure(compiled.predict, X_part, repeats)
+
+        print('Batch {:>6}: sklearn {:9.3f} ms, arrays {:9.3f} ms, speedup {:6.1f}x'.format(
+            size, model_time*1000, compiled_time*1000, model_time / compiled_time
+        ))
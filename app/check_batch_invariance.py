@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+import sys, os
+sys.path.append(os.path.join(os.path.abspath(''), '..', 'shared_libs'))
+import data_transform
+
+DATA_PATH = '../shared_libs/data'
+MODELS_PATH = '../shared_libs/data/models'
+MODEL_NAME = 'model_abr'
+
+def predict_by_chunks(transform, data, artifacts, chunk_size):
+    model = artifacts['model']
+    columns = data_transform.get_model_columns(model)
+
+    y_pred = []
+    for start in range(0, len(data), chunk_size):
+        X = transform(data.iloc[start:start+chunk_size].reset_index(drop=True), artifacts)
+        y_pred.append(model.predict(pd.DataFrame(X, columns=columns)))
+
+    return np.concatenate(y_pred)
+
+def transform_records(df, artifacts):
+    return data_transform.transform_records_for_prediction(df.to_dict('records'), artifacts)
+
+def transform_by_training_stages(df, artifacts):
+    # цепочка этапов обучения (can_drop_rows=False) на обученных значениях снимка - эталон для подготовки данных сервисом
+    default_values_file_name = artifacts['files']['default_values']
+    default_values = artifacts['default_values']
+
+    df = data_transform.clear_data_base_line(df, default_values_file_name, default_values=default_values)
+    df = data_transform.fix_incorrect_states_and_cities(df, default_values_file_name, artifacts['cities_dict'], default_values=default_values)
+    df = data_transform.add_city_features(
+        df,
+        default_values_file_name,
+        artifacts['cities_dict'],
+        artifacts['address_dict'],
+        artifacts['address_by_zip_dict'],
+        artifacts['cities_clusters_dict'],
+        default_values=default_values
+    )
+    df = data_transform.add_population_features(df, default_values_file_name, artifacts['us_population'], default_values=default_values)
+    df = data_transform.encode_state_and_city(df, default_values_file_name, default_values=default_values)
+    df = data_transform.final_tune_pca_and_scale(df, default_values_file_name, default_values=default_values)
+
+    return df[data_transform.get_model_columns(artifacts['model'])]
+
+if __name__ == '__main__':
+    # предсказание записи не должно зависеть от других записей пакета: перемешанный и разбитый
+    # на части пакет должен давать те же предсказания, что и весь пакет, обработанный этапами обучения,
+    # на всех путях подготовки данных сервисом
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+
+    df = pd.read_csv(DATA_PATH + '/data_valid.csv', dtype={"zipcode": str})
+    data = data_transform.convert_to_data_frame(np.array(data_transform.prepare_for_json(df)))
+
+    artifacts = data_transform.get_serving_artifacts(DATA_PATH, MODELS_PATH, MODEL_NAME)
+
+    transforms = {
+        'matrix': data_transform.transform_matrix_for_prediction,
+        'records': transform_records
+    }
+
+    y_base = predict_by_chunks(transform_by_training_stages, data, artifacts, len(data))
+
+    order = np.random.default_rng(seed).permutation(len(data))
+    shuffled = data.iloc[order].reset_index(drop=True)
+
+    failed = 0
+    for name, transform in transforms.items():
+        chunk_sizes = [1, 8] if name == 'records' else [1, 7, 16, 17, 100, len(data)]
+
+        for chunk_size in chunk_sizes:
+            y_pred = np.empty(len(data))
+            y_pred[order] = predict_by_chunks(transform, shuffled, artifacts, chunk_size)
+
+            identical = np.array_equal(y_base, y_pred)
+            failed += 0 if identical else 1
+
+            print('{:>10} chunk {:>6}: identical {}, rows differ {}'.format(name, chunk_size, identical, int((y_base != y_pred).sum())))
+
+    sys.exit(1 if failed > 0 else 0)
@@ -2,16 +2,95 @@ import numpy as np
 import pandas as pd
 import json
 import pickle
-from flask import Flask, request, jsonify
+import time
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from flask import Flask, Response, request, jsonify, stream_with_context
 
 import sys, os
 sys.path.append(os.path.join(os.path.abspath(''), '..', 'shared_libs'))
 import data_transform
+import prediction_cache
+import geocode_enricher
+import service_metrics
+import tree_ensemble
+
+DATA_PATH = '../shared_libs/data'
+MODELS_PATH = '../shared_libs/data/models'
+MODEL_NAME = 'model_abr'
+
+# размер пакета записей, обрабатываемых за один проход в /predict/stream
+STREAM_CHUNK_SIZE = 1000
+STREAM_MAX_CHUNK_SIZE = 10000
+
+# пакеты не больше FAST_PATH_MAX_SIZE записей обрабатываются по значениям, без замера каждого этапа (transform_records_for_prediction)
+FAST_PATH_MAX_SIZE = 8
+
+# пакеты не больше COMPILED_MODEL_MAX_SIZE записей оцениваются моделью, преобразованной в массивы NumPy
+# (см. shared_libs/tree_ensemble.py, предсказания совпадают с исходной моделью); на больших пакетах
+# выигрыша нет, и используется исходная модель
+COMPILED_MODEL_ENABLED = True
+COMPILED_MODEL_MAX_SIZE = 1000
+
+# пакеты от PARALLEL_MIN_SIZE записей делятся на части, которые готовятся в пуле из PARALLEL_WORKERS процессов
+# (см. data_transform.transform_for_prediction_parallel, результат совпадает с последовательной обработкой)
+# Пул создается сразу после fork рабочего процесса uWSGI (postfork), пока в процессе нет других потоков;
+# если части пакета не готовы за PARALLEL_TIMEOUT секунд, пул отключается и пакеты обрабатываются последовательно
+PARALLEL_ENABLED = False
+PARALLEL_WORKERS = 4
+PARALLEL_MIN_SIZE = 2000
+PARALLEL_TIMEOUT = 60
+
+# кэш предсказаний, общий для всех процессов uWSGI (см. shared_libs/prediction_cache.py); предсказание записи
+# зависит только от нее самой и версии артефактов (см. check_batch_invariance.py)
+PREDICTION_CACHE_ENABLED = True
+PREDICTION_CACHE_MAX_SIZE = 200000
+PREDICTION_CACHE_TTL = 24*3600
+PREDICTION_CACHE_SNAPSHOT_PATH = None
+
+# объединение небольших одновременных запросов в один пакет (нужен uWSGI с threads > 1):
+# запросы, пришедшие в течение COALESCE_WINDOW_MS, обрабатываются одним проходом цепочки и модели
+COALESCE_ENABLED = False
+COALESCE_WINDOW_MS = 5
+COALESCE_MAX_BATCH_SIZE = 64
+COALESCE_MAX_REQUEST_SIZE = 4
+
+# фоновое геокодирование адресов, не найденных в словарях геоданных (см. shared_libs/geocode_enricher.py):
+# ответ сразу строится с расстояниями по умолчанию, а найденные позже координаты используются следующими запросами;
+# предсказания для таких записей не сохраняются в кэш. Для проверки без сети - GEO_ENRICHMENT_PROVIDERS = ['stub']
+GEO_ENRICHMENT_ENABLED = False
+GEO_ENRICHMENT_STORE_PATH = DATA_PATH + '/geocache.sqlite'
+GEO_ENRICHMENT_PROVIDERS = ['osm']
+GEO_ENRICHMENT_GOOGLE_KEY = None
+GEO_ENRICHMENT_QUEUE_SIZE = 10000
+# частота запросов к геокодерам суммарно по всем процессам (None - geocode_builder.default_providers_rates)
+GEO_ENRICHMENT_RATES = None
+
+# артефакты загружаются при импорте, т.е. в мастер-процессе uWSGI до fork (lazy-apps = false),
+# в компактном виде и с исключением из сборки мусора, чтобы память оставалась общей для рабочих процессов
+# (см. data_transform.preload_serving_artifacts)
+PRELOAD_ARTIFACTS = True
 
 app = Flask(__name__)
 
+# метрики процессов сервиса собираются через файлы; модуль импортируется в мастер-процессе uWSGI до fork,
+# поэтому файлы предыдущего запуска удаляются один раз при старте сервиса
+service_metrics.start_file_export(clean=True)
+
+# артефакты загружаются один раз при старте процесса, далее - только при изменении файлов
+if PRELOAD_ARTIFACTS:
+    data_transform.preload_serving_artifacts(DATA_PATH, MODELS_PATH, MODEL_NAME)
+else:
+    data_transform.get_serving_artifacts(DATA_PATH, MODELS_PATH, MODEL_NAME)
+
 @app.errorhandler(Exception)
 def all_exception_handler(error):
+    # шаблон маршрута, а не путь запроса: пути сканеров (404) не должны порождать новые серии метрик
+    service_metrics.inc_counter('fyp_request_errors_total', endpoint=request.url_rule.rule if request.url_rule else 'unmatched')
+    
     return jsonify({
         'status': 'ERROR',
         'error': str(error)
@@ -22,69 +101,349 @@ def all_exception_handler(error):
 def index_action():
     return 'Use POST method to send data to /predict URI', 200
 
-@app.route('/predict', methods=['POST'])
-def predict_action():
-    data = data_transform.convert_to_data_frame(np.array(request.json.get('data')))
-    
-    df = data_transform.clear_data_base_line(
-        data, 
-        '../shared_libs/data/default_values.pkl', 
-        can_drop_rows=False, 
-        force_rebuild_cached_data=False
-    )
-    
-    cities_dict = data_transform.get_cities_dict('../shared_libs/data/cities_dict.pkl', force_read=True)
-    address_dict = data_transform.get_addresses_dict('../shared_libs/data/address_dict.pkl', force_read=True)
-    address_by_zip_dict = data_transform.get_address_by_zipcode_dict('../shared_libs/data/address_by_zip_dict.pkl', force_read=True)
-    cities_clusters_dict = data_transform.get_citiess_clusters_dict('../shared_libs/data/cities_clusters_dict.pkl', force_read=True)
-    
-    df = data_transform.fix_incorrect_states_and_cities(
-        df, 
-        '../shared_libs/data/default_values.pkl', 
-        cities_dict, 
-        can_drop_rows=False
-    )
-    
-    df = data_transform.add_city_features(
-        df,
-        '../shared_libs/data/default_values.pkl', 
-        cities_dict, 
-        address_dict,
-        address_by_zip_dict,
-        cities_clusters_dict,
-        force_rebuild_cached_data=False
-    )
-    
-    df = data_transform.add_population_features(
-        df, 
-        '../shared_libs/data/default_values.pkl', 
-        '../shared_libs/data/uscities.csv', 
-        can_drop_rows=False,
-        force_rebuild_cached_data=False
-    )
-    
-    df = data_transform.encode_state_and_city(
-        df, 
-        '../shared_libs/data/default_values.pkl', 
-        can_drop_rows=False, 
-        force_rebuild_cached_data=False
-    )
-    
-    df = data_transform.final_tune_pca_and_scale(
-        df, 
-        '../shared_libs/data/default_values.pkl', 
-        force_rebuild_cached_data=False
-    )
-    
-    model = data_transform.get_current_prediction_model('../shared_libs/data/models', 'model_abr')
-    
-    y_pred = model.predict(df)
+@app.route('/metrics')
+def metrics_action():
+    # метрики всех рабочих процессов в текстовом формате Prometheus
+    return Response(service_metrics.render_prometheus(), status=200, mimetype='text/plain; version=0.0.4')
+
+def read_request_data():
+    if request.mimetype == data_transform.get_binary_content_type():
+        return data_transform.convert_binary_to_data_frame(request.get_data())
+    
+    return data_transform.convert_to_data_frame(np.array(request.json.get('data')))
+
+def make_predictions_response(y_pred):
+    if request.accept_mimetypes.best == data_transform.get_binary_content_type():
+        return Response(
+            data_transform.prepare_predictions_for_binary(y_pred), 
+            status=200, 
+            mimetype=data_transform.get_binary_content_type()
+        )
     
     return jsonify({
         'status': 'OK',
         'predictions': y_pred.tolist()
     }), 200
 
+predictions_cache = prediction_cache.PredictionCache(
+    max_size=PREDICTION_CACHE_MAX_SIZE,
+    ttl=PREDICTION_CACHE_TTL,
+    snapshot_path=PREDICTION_CACHE_SNAPSHOT_PATH
+)
+
+geo_enricher = geocode_enricher.GeocodeEnricher(
+    GEO_ENRICHMENT_STORE_PATH,
+    GEO_ENRICHMENT_PROVIDERS,
+    GEO_ENRICHMENT_GOOGLE_KEY,
+    max_queue_size=GEO_ENRICHMENT_QUEUE_SIZE,
+    rates=GEO_ENRICHMENT_RATES
+)
+
+def get_prediction_artifacts():
+    artifacts = data_transform.get_serving_artifacts(**get_artifacts_params())
+    
+    if GEO_ENRICHMENT_ENABLED:
+        artifacts = geo_enricher.wrap_artifacts(artifacts)
+    
+    return artifacts
+
+def submit_unresolved_locations(data, artifacts):
+    # адреса без координат ставятся в очередь фонового геокодирования; возвращается маска таких записей
+    if not GEO_ENRICHMENT_ENABLED:
+        return np.zeros(len(data), dtype=bool)
+    
+    try:
+        mask, locations = data_transform.get_unresolved_locations(data, artifacts)
+        geo_enricher.submit(locations)
+    except Exception:
+        # ответ уже готов - ошибка постановки в очередь на него не влияет
+        return np.zeros(len(data), dtype=bool)
+    
+    return mask
+
+def predict_data_frame(data):
+    artifacts = get_prediction_artifacts()
+    
+    if not PREDICTION_CACHE_ENABLED:
+        y_pred = predict_data_frame_with_artifacts(data, artifacts)
+        submit_unresolved_locations(data, artifacts)
+        
+        return y_pred
+    
+    # из кэша берутся уже посчитанные записи, через модель проходят только промахи
+    keys = data_transform.get_records_cache_keys(data, artifacts['version'])
+    cached = predictions_cache.get_many(keys)
+    
+    y_pred = np.array([cached.get(key, np.NaN) for key in keys], dtype=np.float64)
+    
+    miss_rows = [indx for indx, key in enumerate(keys) if key not in cached]
+    
+    service_metrics.inc_counter('fyp_prediction_cache_lookups_total', len(keys) - len(miss_rows), result='hit')
+    service_metrics.inc_counter('fyp_prediction_cache_lookups_total', len(miss_rows), result='miss')
+    if len(miss_rows) > 0:
+        miss_data = data.iloc[miss_rows].reset_index(drop=True)
+        y_miss = predict_data_frame_with_artifacts(miss_data, artifacts)
+        
+        y_pred[miss_rows] = y_miss
+        
+        # предсказания с расстояниями по умолчанию не кэшируются: после геокодирования адреса они изменятся
+        unresolved = submit_unresolved_locations(miss_data, artifacts)
+        predictions_cache.set_many({keys[indx]: value for indx, value, skip in zip(miss_rows, y_miss, unresolved) if not skip})
+    
+    return y_pred
+
+def predict_data_frame_with_artifacts(data, artifacts):
+    if len(data) <= FAST_PATH_MAX_SIZE:
+        X = None
+        try:
+            with service_metrics.measure_stage('fast_path', len(data)):
+                X = data_transform.transform_records_for_prediction(data.to_dict('records'), artifacts)
+                if not np.isfinite(X.values).all():
+                    raise ValueError('Fast path produced non-finite features')
+        except (ValueError, KeyError, TypeError) as ex:
+            # записи, которые быстрый путь не смог обработать (некорректные значения полей), проходят полную цепочку (с ее обработкой ошибок)
+            service_metrics.inc_counter('fyp_fast_path_fallbacks_total', len(data), error=type(ex).__name__)
+            X = None
+        
+        if X is not None:
+            with service_metrics.measure_stage('model_predict', len(X)):
+                return get_prediction_model(artifacts, len(X)).predict(X)
+    
+    # процессы пула берут артефакты из реестра, без координат фонового геокодирования
+    df = None
+    executor = get_parallel_executor()
+    if executor is not None and not GEO_ENRICHMENT_ENABLED and len(data) >= PARALLEL_MIN_SIZE:
+        try:
+            df = data_transform.transform_for_prediction_parallel(
+                data,
+                artifacts,
+                executor,
+                PARALLEL_WORKERS,
+                get_artifacts_params(),
+                PARALLEL_TIMEOUT
+            )
+        except concurrent.futures.TimeoutError:
+            # процесс пула завис - пул больше не используется
+            stop_parallel_executor()
+            df = None
+        except RuntimeError:
+            # пул сломан или артефакты в нем уже другой версии - обрабатываем пакет последовательно
+            df = None
+    
+    if df is None:
+        # признаки записываются сразу в матрицу в порядке колонок модели (см. data_transform.transform_matrix_for_prediction)
+        df = data_transform.transform_matrix_for_prediction(data, artifacts)
+    
+    with service_metrics.measure_stage('model_predict', len(df)):
+        return get_prediction_model(artifacts, len(df)).predict(df)
+
+def get_artifacts_params():
+    return {
+        'data_path': DATA_PATH,
+        'models_path': MODELS_PATH,
+        'model_name': MODEL_NAME,
+        'compact_geo': PRELOAD_ARTIFACTS
+    }
+
+parallel_executor = None
+parallel_executor_pid = None
+parallel_executor_lock = threading.Lock()
+
+def start_parallel_executor():
+    # пул создается до запуска потоков процесса (fork при занятой другим потоком блокировке оставил бы ее
+    # занятой навсегда в процессе пула); процессы пула получают уже загруженные артефакты
+    global parallel_executor, parallel_executor_pid
+    
+    if not PARALLEL_ENABLED:
+        return
+    
+    executor = ProcessPoolExecutor(PARALLEL_WORKERS, mp_context=multiprocessing.get_context('fork'))
+    # при fork все процессы пула создаются при первой задаче - сразу, а не во время обработки запроса
+    executor.submit(int).result()
+    
+    with parallel_executor_lock:
+        parallel_executor = executor
+        parallel_executor_pid = os.getpid()
+
+def stop_parallel_executor():
+    global parallel_executor
+    
+    with parallel_executor_lock:
+        executor = parallel_executor
+        parallel_executor = None
+    
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def get_parallel_executor():
+    # пул не пересоздается во время работы процесса (в нем уже есть потоки): сломанный пул (упавший процесс)
+    # или пул другого процесса не используется
+    with parallel_executor_lock:
+        if parallel_executor is None or parallel_executor_pid != os.getpid() or parallel_executor._broken:
+            return None
+        
+        return parallel_executor
+
+try:
+    from uwsgidecorators import postfork
+    postfork(start_parallel_executor)
+except ImportError:
+    # не под uWSGI (app.run) - пул создается при импорте, до запуска потоков
+    start_parallel_executor()
+
+def get_prediction_model(artifacts, rows_count):
+    if COMPILED_MODEL_ENABLED and rows_count <= COMPILED_MODEL_MAX_SIZE:
+        try:
+            return data_transform.get_derived_artifact(artifacts['model'], 'tree_ensemble', tree_ensemble.TreeEnsemble.from_model)
+        except ValueError:
+            # модель другого типа - используется как есть
+            pass
+    
+    return artifacts['model']
+
+class PredictionCoalescer:
+    """
+    Объединяет небольшие одновременные запросы в один пакет: запросы, пришедшие в течение окна
+    window_ms (но не более max_batch_size записей), обрабатываются одним вызовом predict_func,
+    и каждый запрос получает свою часть предсказаний
+    """
+
+    def __init__(self, predict_func, window_ms, max_batch_size):
+        self.predict_func = predict_func
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+
+    def ensure_started(self):
+        # поток создается лениво в рабочем процессе: потоки мастер-процесса uWSGI не переживают fork
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive() or self.thread_pid != os.getpid():
+                self.queue = queue.Queue()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread_pid = os.getpid()
+                self.thread.start()
+
+    def predict(self, data):
+        self.ensure_started()
+
+        item = {'data': data, 'done': threading.Event(), 'result': None, 'error': None}
+        self.queue.put(item)
+        item['done'].wait()
+
+        if item['error'] is not None:
+            raise item['error']
+
+        return item['result']
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            size = len(items[0]['data'])
+            deadline = time.monotonic() + self.window
+
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                items.append(item)
+                size += len(item['data'])
+
+            self.process(items)
+
+    def process(self, items):
+        try:
+            if len(items) == 1:
+                data = items[0]['data']
+            else:
+                data = pd.concat([item['data'] for item in items], ignore_index=True)
+
+            y_pred = self.predict_func(data)
+
+            pos = 0
+            for item in items:
+                item['result'] = y_pred[pos:pos+len(item['data'])]
+                pos += len(item['data'])
+        except Exception as ex:
+            if len(items) > 1:
+                # ошибка одного запроса не должна влиять на остальные - обрабатываем их по отдельности
+                for item in items:
+                    self.process([item])
+                return
+
+            items[0]['error'] = ex
+
+        for item in items:
+            item['done'].set()
+
+coalescer = PredictionCoalescer(predict_data_frame, COALESCE_WINDOW_MS, COALESCE_MAX_BATCH_SIZE)
+
+def predict_data_frame_coalesced(data):
+    if COALESCE_ENABLED and len(data) <= COALESCE_MAX_REQUEST_SIZE:
+        return coalescer.predict(data)
+    
+    return predict_data_frame(data)
+
+@app.route('/predict', methods=['POST'])
+def predict_action():
+    with service_metrics.measure_time('fyp_request_duration_seconds', endpoint='/predict'):
+        with service_metrics.measure_time('fyp_stage_duration_seconds', stage='decode_request'):
+            data = read_request_data()
+        
+        service_metrics.inc_counter('fyp_request_rows_total', len(data), endpoint='/predict')
+        
+        y_pred = predict_data_frame_coalesced(data)
+        
+        with service_metrics.measure_stage('encode_response', len(y_pred)):
+            return make_predictions_response(y_pred)
+
+def read_ndjson_chunks(stream, chunk_size):
+    chunk = []
+    for line in stream:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    
+    if len(chunk) > 0:
+        yield chunk
+
+@app.route('/predict/stream', methods=['POST'])
+def predict_stream_action():
+    # каждая строка запроса - одна запись (список значений, как в prepare_for_json, или объект),
+    # каждая строка ответа - предсказание (или ошибка) для записи с тем же номером
+    chunk_size = min(request.args.get('chunk_size', STREAM_CHUNK_SIZE, type=int), STREAM_MAX_CHUNK_SIZE)
+    
+    def generate():
+        with service_metrics.measure_time('fyp_request_duration_seconds', endpoint='/predict/stream'):
+            for lines in read_ndjson_chunks(request.stream, max(chunk_size, 1)):
+                service_metrics.inc_counter('fyp_request_rows_total', len(lines), endpoint='/predict/stream')
+                
+                try:
+                    records = [json.loads(line) for line in lines]
+                    y_pred = predict_data_frame(data_transform.convert_records_to_data_frame(records))
+                    
+                    out_lines = [json.dumps({'prediction': x}) for x in y_pred.tolist()]
+                except Exception as ex:
+                    service_metrics.inc_counter('fyp_request_errors_total', endpoint='/predict/stream')
+                    out_lines = [json.dumps({'error': str(ex)})] * len(lines)
+                
+                yield '\n'.join(out_lines) + '\n'
+    
+    return Response(stream_with_context(generate()), status=200, mimetype='application/x-ndjson')
+
 if __name__ == '__main__':
     app.run('0.0.0.0', 5000)
     
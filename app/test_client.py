@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 import requests
+import json
 
 from sklearn.metrics import mean_absolute_percentage_error
 from sklearn.metrics import mean_squared_error
@@ -9,21 +10,71 @@ import sys, os
 sys.path.append(os.path.join(os.path.abspath(''), '..', 'shared_libs'))
 import data_transform
 
+def post_json(df):
+    r = requests.post('http://localhost/predict', json={'data': data_transform.prepare_for_json(df)})
+    if r.status_code != 200:
+        return None, r.text
+
+    if r.json()['status'] != 'OK':
+        return None, r.json()['error']
+
+    return np.array(r.json()['predictions']), None
+
+def post_binary(df):
+    binary_type = data_transform.get_binary_content_type()
+
+    r = requests.post(
+        'http://localhost/predict',
+        data=data_transform.prepare_for_binary(df),
+        headers={'Content-Type': binary_type, 'Accept': binary_type}
+    )
+    if r.status_code != 200:
+        return None, r.text
+
+    # ошибки сервис всегда возвращает в JSON
+    if r.headers.get('Content-Type', '').split(';')[0] != binary_type:
+        return None, r.json()['error']
+
+    return data_transform.convert_binary_to_predictions(r.content), None
+
+def post_stream(df):
+    def ndjson_lines():
+        for rec in data_transform.prepare_for_json(df):
+            yield (json.dumps(rec) + '\n').encode('utf-8')
+
+    r = requests.post('http://localhost/predict/stream', data=ndjson_lines(), stream=True)
+    if r.status_code != 200:
+        return None, r.text
+
+    y_pred = []
+    for line in r.iter_lines():
+        rec = json.loads(line)
+        if 'error' in rec:
+            return None, rec['error']
+
+        y_pred.append(rec['prediction'])
+
+    return np.array(y_pred), None
+
 if __name__ == '__main__':
+    # формат обмена: json (по умолчанию), binary или stream (NDJSON, /predict/stream)
+    wire_format = sys.argv[1] if len(sys.argv) > 1 else 'json'
+
     df = pd.read_csv('../shared_libs/data/data_valid.csv', dtype={"zipcode": str})
     target = pd.read_csv('../shared_libs/data/data_valid_target.csv')
-    
-    r = requests.post('http://localhost/predict', json={'data': data_transform.prepare_for_json(df)})
-    if r.status_code == 200:
-        if r.json()['status'] == 'OK':
-            y_pred = np.array(r.json()['predictions'])
-            y = target['target']
-            
-            print('MAPE:', mean_absolute_percentage_error(y, y_pred)*100)
-            print('RMSE:', mean_squared_error(y, y_pred)**0.5)
-        else:
-            print('ERROR...')
-            print(r.json()['error'])
+
+    if wire_format == 'binary':
+        y_pred, error = post_binary(df)
+    elif wire_format == 'stream':
+        y_pred, error = post_stream(df)
+    else:
+        y_pred, error = post_json(df)
+
+    if error is None:
+        y = target['target']
+
+        print('MAPE:', mean_absolute_percentage_error(y, y_pred)*100)
+        print('RMSE:', mean_squared_error(y, y_pred)**0.5)
     else:
-        print('ERROR 500')
-        print(r.text)
+        print('ERROR...')
+        print(error)
@@ -1,10 +1,20 @@
 import numpy as np
 import pandas as pd
-import locale
 import json
 import re
+import ast
 import random
 import pickle
+import hashlib
+import io
+import os
+import time
+import threading
+import gc
+import contextlib
+import concurrent.futures
+from collections import OrderedDict
+from collections.abc import Mapping
 import requests
 import urllib.parse
 from geopy.geocoders import Nominatim
@@ -16,14 +26,88 @@ from sklearn.preprocessing import StandardScaler
 
 import category_encoders as ce
 
-locale.setlocale(locale.LC_ALL, 'en_US.UTF8')
+import service_metrics
+import geo_cache
 
 osm_geolocator = Nominatim(user_agent='myapplication')
 us_census_geocoder = GeocodioClient('USCensus API key')
 Gmaps_API_key = 'GoogleMap API key'
 
-def set_locale(loc_val, loc_type=locale.LC_ALL):
-    locale.setlocale(loc_type, loc_val)
+##################################################################################################
+#
+# Разбор чисел в формате en_US ("1,234.5") без использования locale: locale.setlocale действует
+# на весь процесс, не потокобезопасен и требует установленной в образе локали.
+# Результат тот же, что и у locale.atof при локали en_US.UTF8: разделители групп разрядов удаляются,
+# остаток разбирается float()
+#
+##################################################################################################
+
+thousands_separator = ','
+
+# строки этого вида float() разбирает одинаково с векторным преобразованием NumPy
+number_str_regexp = r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?'
+# прочие строки, которые может разобрать float() (пробелы по краям, '1_000', inf, nan)
+number_str_candidate_regexp = r'\d|inf|nan'
+
+def convert_str_to_float(value):
+    """
+    Функция переводит строку с числом в формате en_US в число типа float
+
+    Parameters:
+    value (str): Строка с числом
+
+    Returns:
+    float: Число (при ошибке формата - исключение ValueError)
+    """
+
+    return float(value.replace(thousands_separator, ''))
+
+# колонки не длиннее column_loop_max_size значений обрабатываются по значениям: для нескольких записей
+# накладные расходы pandas на колонку больше самой обработки (результат тот же, что и у векторного варианта)
+column_loop_max_size = 16
+
+def convert_str_column_to_float(values):
+    """
+    Функция переводит колонку строк с числами в формате en_US в числа типа float (векторно)
+
+    Parameters:
+    values (Series): Строки с числами
+
+    Returns:
+    ndarray: Числа (для пропусков, нестроковых значений и ошибок формата - NaN)
+    """
+
+    values = values.astype(object).str.replace(thousands_separator, '', regex=False)
+    result = np.full(len(values), np.NaN)
+
+    is_number = values.str.fullmatch(number_str_regexp).to_numpy(dtype=bool, na_value=False)
+    result[is_number] = values[is_number].to_numpy(dtype=object).astype(np.float64)
+
+    is_candidate = values.str.contains(number_str_candidate_regexp, case=False).to_numpy(dtype=bool, na_value=False)
+    for indx in np.flatnonzero(is_candidate & ~is_number):
+        try:
+            result[indx] = float(values.iat[indx])
+        except ValueError:
+            pass
+
+    return result
+
+def round_float_column_to_int(values):
+    """
+    Функция округляет числа так же, как int(round(value)) (до четного), для inf и NaN - NaN
+
+    Parameters:
+    values (ndarray): Числа
+
+    Returns:
+    ndarray: Округленные числа (тип float)
+    """
+
+    return np.where(np.isfinite(values), np.round(values), np.NaN)
+
+def get_words_column(values, word_indx):
+    parts = values.astype(object).str.strip().str.split(' ')
+    return parts.str[word_indx]
 
 
 def target_str_to_float(value, print_error_value=False):
@@ -39,13 +123,26 @@ def target_str_to_float(value, print_error_value=False):
     """
     
     try:
-        result = locale.atof(value.strip("$").strip("+"))
+        result = convert_str_to_float(value.strip("$").strip("+"))
         return result
     except:
         if print_error_value:
             print(value)
         return np.NaN
 
+def convert_target_column_to_float(values):
+    """
+    Функция конвертации колонки целевой цены недвижимости во float (векторный вариант target_str_to_float)
+
+    Parameters:
+    values (Series): Исходные цены
+
+    Returns:
+    ndarray: Цены в виде float или NaN
+    """
+
+    return convert_str_column_to_float(values.astype(object).str.strip('$').str.strip('+'))
+
 
 def drop_not_informative_columns(df, cols):
     return df.drop(cols, axis=1)
@@ -80,6 +177,117 @@ def convert_to_json_str(value, noneValue=None):
     
     return result
 
+##################################################################################################
+#
+# Декодер структурированных полей (homeFacts, schools), записанных в формате repr Python:
+# строка просматривается один раз регулярным выражением, строковые литералы (в одинарных или двойных
+# кавычках) и None/True/False переводятся в JSON, после чего результат разбирает json.loads.
+# Результаты запоминаются по содержимому строки (значения полей часто повторяются)
+#
+##################################################################################################
+
+repr_tokens_regexp = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|\b(?:None|True|False)\b""", re.S)
+
+# в строках без двойных кавычек, экранирования и True/False (практически все значения) каждый апостроф -
+# граница строкового литерала, поэтому замена выполняется без вызова функции на каждый литерал:
+# простой заменой символа, а при наличии None - шаблоном: '...' -> "...", None -> "" (группа не найдена)
+repr_simple_tokens_regexp = re.compile(r"'([^']*)'|\bNone\b")
+
+repr_decoder_memo = OrderedDict()
+repr_decoder_memo_max_size = 50000
+# кэш и счетчики общие для потоков обработки (ThreadPoolExecutor, потоки uWSGI)
+repr_decoder_lock = threading.Lock()
+# разобранное значение может быть None, поэтому отсутствие в кэше обозначается отдельным объектом
+repr_decoder_missing = object()
+
+repr_decoder_stats = {
+    'calls': 0,
+    'memo_hits': 0,
+    'failures': 0
+}
+
+class ReprParseFailure:
+    # ошибка разбора в кэше: хранится только сообщение, исключение создается заново при каждом обращении
+    # (повторно выброшенное исключение накапливает трассировку и удерживает кадры с данными запросов)
+    def __init__(self, message):
+        self.message = message
+
+def convert_repr_token_to_json(token, none_value):
+    if token == 'None':
+        return 'null' if none_value is None else json.dumps(none_value)
+    elif token == 'True':
+        return 'true'
+    elif token == 'False':
+        return 'false'
+
+    # экранированные символы встречаются редко - такие литералы разбираются стандартным парсером
+    value = token[1:-1] if '\\' not in token else ast.literal_eval(token)
+
+    return json.dumps(value)
+
+def decode_repr_value(value, none_value=''):
+    """
+    Функция разбирает значение структурированного поля в формате repr Python (словари, списки, строки, числа, None)
+
+    Parameters:
+    value (str): Исходное значение
+    none_value (any): Значение, подставляемое вместо None (по умолчанию '' - как в convert_to_json_str)
+
+    Returns:
+    any: Разобранное значение (результат общий для одинаковых строк, изменять его нельзя)
+
+    Raises:
+    ValueError: Если значение разобрать не удалось (учитывается в repr_decoder_stats['failures'])
+    """
+
+    # пропущенное значение (NaN) ошибкой разбора не считается
+    if not isinstance(value, str):
+        raise ValueError('Structured value is not a string: ' + str(value))
+
+    key = (value, none_value)
+    with repr_decoder_lock:
+        repr_decoder_stats['calls'] += 1
+
+        result = repr_decoder_memo.get(key, repr_decoder_missing)
+        if result is not repr_decoder_missing:
+            repr_decoder_stats['memo_hits'] += 1
+            repr_decoder_memo.move_to_end(key)
+
+    if result is repr_decoder_missing:
+        # разбор выполняется вне блокировки: одновременный разбор одного значения в двух потоках дает одинаковый результат
+        try:
+            if '"' in value or '\\' in value or 'True' in value or 'False' in value:
+                json_value = repr_tokens_regexp.sub(lambda m: convert_repr_token_to_json(m.group(0), none_value), value)
+            elif 'None' not in value:
+                json_value = value.replace("'", '"')
+            elif none_value == '':
+                json_value = repr_simple_tokens_regexp.sub(r'"\1"', value)
+            else:
+                json_value = repr_tokens_regexp.sub(lambda m: convert_repr_token_to_json(m.group(0), none_value), value)
+
+            result = json.loads(json_value)
+        except Exception as ex:
+            result = ReprParseFailure('Incorrect structured value: ' + str(ex))
+
+        with repr_decoder_lock:
+            # вытесняются давно не использованные значения
+            while len(repr_decoder_memo) >= repr_decoder_memo_max_size:
+                repr_decoder_memo.popitem(last=False)
+            repr_decoder_memo[key] = result
+
+    if isinstance(result, ReprParseFailure):
+        with repr_decoder_lock:
+            repr_decoder_stats['failures'] += 1
+        service_metrics.inc_counter('fyp_repr_parse_failures_total')
+        raise ValueError(result.message)
+
+    return result
+
+def get_repr_decoder_stats():
+    with repr_decoder_lock:
+        return dict(repr_decoder_stats, memo_size=len(repr_decoder_memo))
+
+
 def get_subfact(value, sub_fact_label, need_print_error=False):
     """
     Функция выборки элемента из структуры поля homeFacts по имени
@@ -95,8 +303,7 @@ def get_subfact(value, sub_fact_label, need_print_error=False):
 
     try:
         src_value = value
-        value = convert_to_json_str(value)
-        facts = json.loads(value)['atAGlanceFacts']
+        facts = decode_repr_value(value)['atAGlanceFacts']
         for fact in facts:
             if fact['factLabel'] == sub_fact_label:
                 return np.NaN if fact['factValue'] == '' else fact['factValue']
@@ -109,6 +316,75 @@ def get_subfact(value, sub_fact_label, need_print_error=False):
             
         return np.NaN
 
+def get_home_facts(value, need_print_error=False):
+    """
+    Функция разбирает поле homeFacts один раз и возвращает все его элементы
+    (для каждого имени - то же значение, что вернет get_subfact)
+
+    Parameters:
+    value (str): Значение поля homeFacts
+    need_print_error (bool): Флаг вывода ошибок в консоль
+
+    Returns:
+    dictionary: Имя поля в структуре -> значение (отсутствующие в словаре поля - NaN)
+    """
+
+    result = {}
+
+    try:
+        facts = decode_repr_value(value)['atAGlanceFacts']
+        for fact in facts:
+            # элемент без имени прерывает поиск всех следующих полей (как в get_subfact)
+            label = fact['factLabel']
+            if label in result:
+                continue
+
+            try:
+                result[label] = np.NaN if fact['factValue'] == '' else fact['factValue']
+            except Exception:
+                result[label] = np.NaN
+    except Exception as e:
+        if need_print_error:
+            print(value)
+            print(e)
+
+    return result
+
+def get_home_facts_arrays(values, facts_list):
+    """
+    Функция разбирает значения homeFacts (каждое - один раз) и возвращает значения фактов
+
+    Parameters:
+    values (list или ndarray): Значения поля homeFacts
+    facts_list (list(dictionary)): Описание фактов (col_name, col_value), см. facts и extra_facts
+
+    Returns:
+    dictionary: Имя факта (col_name) -> ndarray значений
+    """
+
+    home_facts = [get_home_facts(value) for value in values]
+
+    result = {}
+    for fact in facts_list:
+        result[fact['col_name']] = np.empty(len(home_facts), dtype=object)
+        result[fact['col_name']][:] = [item.get(fact['col_value'], np.NaN) for item in home_facts]
+
+    return result
+
+def get_home_facts_columns(values, facts_list):
+    """
+    Функция разбирает столбец homeFacts (каждое значение - один раз) и возвращает столбцы фактов
+
+    Parameters:
+    values (Series): Значения поля homeFacts
+    facts_list (list(dictionary)): Описание фактов (col_name, col_value), см. facts и extra_facts
+
+    Returns:
+    DataFrame: Столбцы фактов (col_name) с индексом values
+    """
+
+    return pd.DataFrame(get_home_facts_arrays(values.values, facts_list), index=values.index)
+
 def convert_str_to_school_rating(value):
     """
     Функция конвертации рейтинга школы в int
@@ -220,7 +496,7 @@ def convert_school_distance_str_to_float(str_val):
     float: Расстояние в милях
     """
   
-    return locale.atof(str.upper(str_val).strip('MI').strip())
+    return convert_str_to_float(str.upper(str_val).strip('MI').strip())
 
 def get_schools_count(value, need_print_error=False):
     """
@@ -236,8 +512,7 @@ def get_schools_count(value, need_print_error=False):
     try:
         src_value = value
         
-        value = convert_to_json_str(value)
-        schools = json.loads(value)
+        schools = decode_repr_value(value)
 
         return len(schools[0]['rating'])
     except Exception as e:
@@ -261,8 +536,7 @@ def get_schools_avg_rate(value, need_print_error=False):
     try:
         src_value = value
         
-        value = convert_to_json_str(value)
-        schools = json.loads(value)
+        schools = decode_repr_value(value)
 
         all_ratings = []
         for rating in schools[0]['rating']:
@@ -290,8 +564,7 @@ def get_schools_grades_list(value, need_print_error=False):
     try:
         src_value = value
         
-        value = convert_to_json_str(value)
-        schools = json.loads(value)
+        schools = decode_repr_value(value)
 
         all_schools_gr_cats = []
             
@@ -322,8 +595,7 @@ def get_schools_min_distance(value, need_print_error=False):
     try:
         src_value = value
         
-        value = convert_to_json_str(value)
-        schools = json.loads(value)
+        schools = decode_repr_value(value)
 
         dist_list = []
         for distance in schools[0]['data']['Distance']:
@@ -351,8 +623,7 @@ def get_schools_avg_distance(value, need_print_error=False):
     try:
         src_value = value
         
-        value = convert_to_json_str(value)
-        schools = json.loads(value)
+        schools = decode_repr_value(value)
 
         dist_list = []
         for distance in schools[0]['data']['Distance']:
@@ -366,6 +637,157 @@ def get_schools_avg_distance(value, need_print_error=False):
             
         return np.NaN
 
+# биты типов школ в маске (см. get_school_grade_category)
+school_grades_bits = {'PK': 1, 'K': 2, 'M': 4, 'H': 8}
+
+def get_school_grades_range_mask(lb, ub):
+    """
+    Функция возвращает маску типов школ для диапазона классов (аналог get_school_grade_category для каждого класса диапазона)
+
+    Parameters:
+    lb (int): Первый класс
+    ub (int): Последний класс
+
+    Returns:
+    int: Маска типов школ (school_grades_bits)
+    """
+
+    if lb > ub:
+        return 0
+
+    mask = 0
+    if lb <= 0 and ub >= 0:
+        mask |= school_grades_bits['PK']
+    if lb <= 5 and ub >= 1:
+        mask |= school_grades_bits['K']
+    if lb <= 8 and ub >= 6:
+        mask |= school_grades_bits['M']
+    if lb < 0 or ub > 8:
+        mask |= school_grades_bits['H']
+
+    return mask
+
+def get_school_grades_mask(str_value):
+    """
+    Функция возвращает маску типов школ по строке классов (результат совпадает с get_school_grades)
+
+    Parameters:
+    str_value (str): Классы школы (после preprocess_grade_str)
+
+    Returns:
+    int: Маска типов школ (school_grades_bits)
+    """
+
+    mask = 0
+
+    for part in str_value.split(','):
+        part = part.strip().upper()
+        if part == '' or part == 'N/A' or part == 'NA':
+            continue
+
+        if '-' in part:
+            bounds = part.split('-')
+            mask |= get_school_grades_range_mask(int(bounds[0]), int(bounds[1]))
+        else:
+            grade_indx = int(part)
+            mask |= get_school_grades_range_mask(grade_indx, grade_indx)
+
+    return mask
+
+def get_schools_features(value, need_print_error=False):
+    """
+    Функция разбирает строку описания близлежащих школ один раз и возвращает все признаки по школам
+    (значения совпадают с get_schools_count, get_schools_avg_rate, get_schools_min_distance, get_schools_avg_distance;
+    если классы школ разобрать не удалось, маска типов школ - 0)
+
+    Parameters:
+    value (str): Строка описания данных о школах
+    need_print_error (bool): Флаг вывода ошибок в консоль
+
+    Returns:
+    tuple: Количество школ, средний рейтинг, минимальное и среднее расстояние, маска типов школ (school_grades_bits)
+    """
+
+    count, avg_rate, min_distance, avg_distance, grades_mask = np.NaN, np.NaN, np.NaN, np.NaN, 0
+
+    try:
+        schools = decode_repr_value(value)
+    except Exception as e:
+        if need_print_error:
+            print(value)
+            print(e)
+
+        return count, avg_rate, min_distance, avg_distance, grades_mask
+
+    # каждый признак вычисляется независимо: ошибка в одном не влияет на остальные
+    try:
+        count = len(schools[0]['rating'])
+    except Exception:
+        pass
+
+    try:
+        all_ratings = [convert_str_to_school_rating(rating) for rating in schools[0]['rating']]
+        avg_rate = 0 if len(all_ratings) == 0 else np.array(all_ratings).mean()
+    except Exception:
+        pass
+
+    try:
+        dist_list = [convert_school_distance_str_to_float(distance) for distance in schools[0]['data']['Distance']]
+        if len(dist_list) == 0:
+            min_distance, avg_distance = 0, 0
+        else:
+            dist_list = np.array(dist_list)
+            min_distance, avg_distance = dist_list.min(), dist_list.mean()
+    except Exception:
+        pass
+
+    try:
+        for grade in schools[0]['data']['Grades']:
+            grades_mask |= get_school_grades_mask(preprocess_grade_str(grade))
+    except Exception:
+        grades_mask = 0
+
+    return count, avg_rate, min_distance, avg_distance, grades_mask
+
+def get_schools_features_arrays(values):
+    """
+    Функция разбирает значения schools (каждое - один раз) и возвращает все признаки по школам
+
+    Parameters:
+    values (list или ndarray): Значения поля schools
+
+    Returns:
+    dictionary: schools_count, schools_avg_rate, schools_min_distance, schools_avg_distance, schools_PK, schools_K, schools_M, schools_H -> ndarray
+    """
+
+    features = [get_schools_features(value) for value in values]
+
+    result = {
+        'schools_count': np.array([item[0] for item in features], dtype=np.float64),
+        'schools_avg_rate': np.array([item[1] for item in features], dtype=np.float64),
+        'schools_min_distance': np.array([item[2] for item in features], dtype=np.float64),
+        'schools_avg_distance': np.array([item[3] for item in features], dtype=np.float64)
+    }
+
+    grades_masks = np.array([item[4] for item in features], dtype=np.int64)
+    for grade, bit in school_grades_bits.items():
+        result['schools_' + grade] = ((grades_masks & bit) != 0).astype(np.int64)
+
+    return result
+
+def get_schools_features_columns(values):
+    """
+    Функция разбирает столбец schools (каждое значение - один раз) и возвращает все признаки по школам
+
+    Parameters:
+    values (Series): Значения поля schools
+
+    Returns:
+    DataFrame: Признаки (см. get_schools_features_arrays) с индексом values
+    """
+
+    return pd.DataFrame(get_schools_features_arrays(values.values), index=values.index)
+
 def convert_sqft_str_to_float(value, need_print_error=False):
     """
     Функция преобразования строки с площадью объекта в число типа float
@@ -385,7 +807,7 @@ def convert_sqft_str_to_float(value, need_print_error=False):
         else:
             value = parts[0]
             
-        return locale.atof(value)
+        return convert_str_to_float(value)
     except Exception as e:
         if need_print_error:
             print(value)
@@ -393,6 +815,83 @@ def convert_sqft_str_to_float(value, need_print_error=False):
             
         return np.NaN
 
+def convert_sqft_column_to_float(values):
+    """
+    Функция преобразования колонки строк с площадью объекта в числа типа float
+    (векторный вариант convert_sqft_str_to_float)
+
+    Parameters:
+    values (Series или ndarray): Строки с площадью объекта
+
+    Returns:
+    ndarray: Площадь объекта или NaN
+    """
+
+    if len(values) <= column_loop_max_size:
+        return np.array([convert_sqft_str_to_float(value) for value in values], dtype=np.float64)
+
+    parts = pd.Series(values, dtype=object).str.strip().str.split(' ')
+    tokens = parts.str[-2].where(parts.str.len() > 1, parts.str[0])
+
+    return convert_str_column_to_float(tokens)
+
+def compile_regexps_family(regexps, features_list):
+    """
+    Функция собирает все шаблоны семейства бинарных признаков (словарь признак -> список шаблонов)
+    в одно регулярное выражение с именованной группой на каждый признак.
+    Все части выражения - просмотр вперед (нулевой длины), поэтому один проход finditer по строке
+    находит совпадения во всех позициях, а в каждой позиции - все совпавшие признаки
+    (результат тот же, что и у re.search по каждому шаблону отдельно)
+
+    Parameters:
+    regexps (dictionary): Шаблоны признаков
+    features_list (list(str)): Список признаков (порядок элементов вектора признаков)
+
+    Returns:
+    dictionary: Скомпилированное выражение (regexp), номера групп признаков (groups), список признаков (features)
+    """
+
+    any_branches = []
+    feature_branches = []
+
+    for indx, feature in enumerate(features_list):
+        branches = '|'.join('(?:' + re_pattern + ')' for re_pattern in regexps[feature])
+        any_branches.append(branches)
+        # признак проверяется только если в позиции совпал хотя бы один шаблон семейства
+        feature_branches.append('(?:(?=(?P<f' + str(indx) + '>' + branches + '))|)')
+
+    regexp = re.compile('(?=' + '|'.join(any_branches) + ')' + ''.join(feature_branches), re.IGNORECASE)
+
+    return {
+        'regexp': regexp,
+        'groups': [regexp.groupindex['f' + str(indx)] for indx in range(len(features_list))],
+        'features': list(features_list)
+    }
+
+def get_regexps_family_vector(matcher, value):
+    """
+    Функция возвращает вектор бинарных признаков семейства за один проход по строке
+
+    Parameters:
+    matcher (dictionary): Семейство признаков (см. compile_regexps_family)
+    value (str): Значение поля
+
+    Returns:
+    list(int): Значения бинарных признаков в порядке matcher['features']
+    """
+
+    vector = [0] * len(matcher['groups'])
+
+    for match in matcher['regexp'].finditer(value):
+        for indx, group in enumerate(matcher['groups']):
+            if match.start(group) >= 0:
+                vector[indx] = 1
+
+    return vector
+
+def get_regexps_family_feature(matcher, value, feature):
+    return get_regexps_family_vector(matcher, value)[matcher['features'].index(feature)]
+
 def get_pr_type_features_list():
     """
     Функция возвращает список имен признаков, извлекаемых из поля propertyType
@@ -450,6 +949,8 @@ pr_type_regexps = {
     ]
 }
 
+pr_type_matcher = compile_regexps_family(pr_type_regexps, get_pr_type_features_list())
+
 def get_pr_type_feature(value, pr_type_feature):
     """
     Функция возвращает бинарное значение признака, извлекаемого из поля propertyType по имени
@@ -462,11 +963,7 @@ def get_pr_type_feature(value, pr_type_feature):
     int: Значение бинарного признака
     """
   
-    for re_pattern in pr_type_regexps[pr_type_feature]:
-        if re.search(re_pattern, value, re.IGNORECASE) is not None:
-            return 1
-        
-    return 0
+    return get_regexps_family_feature(pr_type_matcher, value, pr_type_feature)
 
     
 def get_stories_features_list():
@@ -507,6 +1004,8 @@ story_pr_type_regexps = {
     ]
 }
 
+story_pr_type_matcher = compile_regexps_family(story_pr_type_regexps, get_stories_features_list())
+
 def get_stroty_feature_by_pr_type(value, story_feature):
     """
     Функция возвращает бинарное значение признака, извлекаемого из поля stories по имени
@@ -519,11 +1018,7 @@ def get_stroty_feature_by_pr_type(value, story_feature):
     int: Значение бинарного признака
     """
 
-    for re_pattern in story_pr_type_regexps[story_feature]:
-        if re.search(re_pattern, value, re.IGNORECASE) is not None:
-            return 1
-        
-    return 0
+    return get_regexps_family_feature(story_pr_type_matcher, value, story_feature)
 
 story_story_regexps = {
     '1-STORY': [
@@ -562,6 +1057,7 @@ story_story_regexps = {
     ]
 }
 
+story_story_matcher = compile_regexps_family(story_story_regexps, get_stories_features_list())
 
 def get_story_count_by_story(value):
     """
@@ -575,7 +1071,7 @@ def get_story_count_by_story(value):
     """
 
     try:
-        result = int(round(locale.atof(value)))
+        result = int(round(convert_str_to_float(value)))
     except:
         result = None
         
@@ -585,17 +1081,33 @@ def get_story_count_by_story(value):
             
         return result
     
-    f_list = get_stories_features_list()
-    cnt = 1
-    for f in f_list:
-        for re_pattern in story_story_regexps[f]:
-            if re.search(re_pattern, value, re.IGNORECASE) is not None:
-                return cnt
-            
-        cnt += 1    
+    # число этажей - номер первого (по порядку) совпавшего признака
+    for cnt, feature_value in enumerate(get_regexps_family_vector(story_story_matcher, value), 1):
+        if feature_value == 1:
+            return cnt
     
     return np.NaN
 
+def get_story_count_column(values):
+    """
+    Функция возвращает число этажей для колонки строк из поля stories (векторный вариант get_story_count_by_story)
+
+    Parameters:
+    values (Series): Строки из поля stories
+
+    Returns:
+    ndarray: Число этажей (1, 2, 3, 4) или NaN
+    """
+
+    result = round_float_column_to_int(convert_str_column_to_float(values))
+    result[result <= 0] = 1
+
+    # нечисловые значения - по шаблонам
+    for indx in np.flatnonzero(np.isnan(result)):
+        result[indx] = get_story_count_by_story(values.iat[indx])
+
+    return result
+
 def clear_beds_from_sqr(value):
     """
     Функция проверяет наличие в строке из поля beds информации о площади объекта
@@ -630,7 +1142,7 @@ def convert_first_word_to_int(value):
     
     if len(parts) > 0:
         try:
-            result = int(round(locale.atof(parts[0])))
+            result = int(round(convert_str_to_float(parts[0])))
             
             return result
         except:
@@ -654,7 +1166,7 @@ def convert_last_word_to_int(value):
     
     if len(parts) > 0:
         try:
-            result = int(round(locale.atof(parts[len(parts)-1])))
+            result = int(round(convert_str_to_float(parts[len(parts)-1])))
             
             return result
         except:
@@ -662,6 +1174,12 @@ def convert_last_word_to_int(value):
     else:
         return np.NaN
 
+def convert_first_word_column_to_int(values):
+    return round_float_column_to_int(convert_str_column_to_float(get_words_column(values, 0)))
+
+def convert_last_word_column_to_int(values):
+    return round_float_column_to_int(convert_str_column_to_float(get_words_column(values, -1)))
+
 def convert_beds_str_to_int(value):
     """
     Функция переводит поле beds в число типа int (берется первое слово строки)
@@ -675,19 +1193,37 @@ def convert_beds_str_to_int(value):
     
     return convert_first_word_to_int(value)
 
-
-def get_beds_features_list():
+def convert_beds_column_to_int(values):
     """
-    Функция возвращает список имен признаков, извлекаемых из поля beds
+    Функция переводит колонку строк из поля beds в числа (векторный вариант clear_beds_from_sqr и convert_beds_str_to_int)
+
+    Parameters:
+    values (Series): Строки из поля beds
 
     Returns:
-    list(str): Список признаков
+    ndarray: Число спален или NaN (в т.ч. для строк с площадью объекта)
     """
 
-    return [
-        '1-BEDROOM',
-        '2-BEDROOMS',
-        '3-BEDROOMS',
+    is_area = values.str.contains(r'(?:^|\W)(?:acres|sqft)(?:$|\W)', case=False).to_numpy(dtype=bool, na_value=False)
+
+    result = convert_first_word_column_to_int(values)
+    result[is_area] = np.NaN
+
+    return result
+
+
+def get_beds_features_list():
+    """
+    Функция возвращает список имен признаков, извлекаемых из поля beds
+
+    Returns:
+    list(str): Список признаков
+    """
+
+    return [
+        '1-BEDROOM',
+        '2-BEDROOMS',
+        '3-BEDROOMS',
         '4-BEDROOMS',
         '5-BEDROOMS',
         '6-BEDROOMS',
@@ -710,6 +1246,21 @@ def convert_baths_str_to_int(value):
     else:
         return convert_first_word_to_int(value)
 
+def convert_baths_column_to_int(values):
+    """
+    Функция переводит колонку строк из поля baths в числа (векторный вариант convert_baths_str_to_int)
+
+    Parameters:
+    values (Series): Строки из поля baths
+
+    Returns:
+    ndarray: Число ванных комнат или NaN
+    """
+
+    is_last_word = values.str.contains(r'(?:^|\W)Bathrooms:(?:$|\W)', case=False).to_numpy(dtype=bool, na_value=False)
+
+    return np.where(is_last_word, convert_last_word_column_to_int(values), convert_first_word_column_to_int(values))
+
 def get_bathrooms_features_list():
     """
     Функция возвращает список имен признаков, извлекаемых из поля bathrooms
@@ -759,6 +1310,54 @@ def get_weighted_nuniques_list(df, col_name, size, mul=10):
 def get_weighted_random_item(weighted_list):
     return random.choice(weighted_list)
 
+# начальное значение генератора при заполнении пропусков года постройки (заполнение воспроизводимо)
+years_imputer_seed = 42
+
+def get_values_distribution(values, percent=50, start_n=10, step=1):
+    """
+    Функция возвращает распределение наиболее частых значений колонки (за один проход value_counts):
+    берутся первые start_n + k*step значений, покрывающие не меньше percent процентов непустых записей
+
+    Parameters:
+    values (Series): Значения
+    percent (number): Доля покрываемых записей (в процентах)
+    start_n (int): Минимальное число значений
+    step (int): Шаг увеличения числа значений
+
+    Returns:
+    dictionary: Значения (values) и их вероятности (probabilities)
+    """
+
+    counts = values.value_counts()
+    cover = (counts / values.notna().sum() * 100).cumsum().to_numpy()
+
+    size = start_n
+    while size < len(counts) and cover[size-1] < percent:
+        size += step
+
+    subset = counts[:size]
+
+    return {
+        'values': subset.index.to_numpy(),
+        'probabilities': (subset / subset.sum()).to_numpy()
+    }
+
+def sample_values_distribution(distribution, size, random_state=None):
+    """
+    Функция возвращает случайные значения с заданным распределением (см. get_values_distribution)
+
+    Parameters:
+    distribution (dictionary): Распределение
+    size (int): Число значений
+    random_state (int): Начальное значение генератора
+
+    Returns:
+    ndarray: Значения
+    """
+
+    rng = np.random.default_rng(random_state)
+    return distribution['values'][rng.choice(len(distribution['values']), size=size, p=distribution['probabilities'])]
+
 #################################################################################################################################
 #################################################################################################################################
 #################################################################################################################################
@@ -814,6 +1413,8 @@ cooling_regexps = {
     ]    
 }
 
+cooling_matcher = compile_regexps_family(cooling_regexps, get_cooling_features_list())
+
 def get_cooling_feature(value, cooling_feature):
     """
     Функция возвращает бинарное значение признака, извлекаемого из поля cooling по имени
@@ -826,11 +1427,7 @@ def get_cooling_feature(value, cooling_feature):
     int: Значение бинарного признака
     """
 
-    for re_pattern in cooling_regexps[cooling_feature]:
-        if re.search(re_pattern, value, re.IGNORECASE) is not None:
-            return 1
-        
-    return 0
+    return get_regexps_family_feature(cooling_matcher, value, cooling_feature)
 
 def get_heating_features_list():
     """
@@ -895,6 +1492,8 @@ heating_regexps = {
     ],
 }
 
+heating_matcher = compile_regexps_family(heating_regexps, get_heating_features_list())
+
 def get_heating_feature(value, heating_feature):
     """
     Функция возвращает бинарное значение признака, извлекаемого из поля heating по имени
@@ -907,11 +1506,7 @@ def get_heating_feature(value, heating_feature):
     int: Значение бинарного признака
     """
 
-    for re_pattern in heating_regexps[heating_feature]:
-        if re.search(re_pattern, value, re.IGNORECASE) is not None:
-            return 1
-        
-    return 0
+    return get_regexps_family_feature(heating_matcher, value, heating_feature)
 
 def get_parking_features_list():
     """
@@ -986,6 +1581,8 @@ parking_regexps = {
 
 }
 
+parking_matcher = compile_regexps_family(parking_regexps, get_parking_features_list())
+
 def get_parking_feature(value, parking_feature):
     """
     Функция возвращает бинарное значение признака, извлекаемого из поля parking по имени
@@ -998,11 +1595,7 @@ def get_parking_feature(value, parking_feature):
     int: Значение бинарного признака
     """
 
-    for re_pattern in parking_regexps[parking_feature]:
-        if re.search(re_pattern, value, re.IGNORECASE) is not None:
-            return 1
-        
-    return 0
+    return get_regexps_family_feature(parking_matcher, value, parking_feature)
 
 def convert_to_ord_cat(val, min_val, max_val, n_cats):
     """
@@ -1032,6 +1625,128 @@ def convert_to_ord_cat(val, min_val, max_val, n_cats):
         
     return cur_cat
 
+##################################################################################################
+#
+# Векторное разбиение на категории: порядковые категории по границам отрезков (np.digitize)
+# и бинарные признаки количества (сравнение массива количеств со всеми номерами сразу)
+#
+##################################################################################################
+
+# число отрезков разбиения порядковых признаков (границы хранятся в default_values как <имя>_cat_edges)
+ord_cat_sizes = {
+    'city_importance': 15,
+    'city_sqr': 15,
+    'city_lat': 31,
+    'city_lng': 31,
+    'population': 15,
+    'density': 15
+}
+
+def get_ord_cat_edges(min_val, max_val, n_cats):
+    """
+    Функция возвращает границы отрезков разбиения диапазона (накапливаются тем же сложением шага,
+    что и в convert_to_ord_cat, последняя граница - первая, не меньшая max_val)
+
+    Parameters:
+    min_val (number): Начало диапазона
+    max_val (number): Конец диапазона
+    n_cats (int): Число отрезков разбиения
+
+    Returns:
+    ndarray: Границы отрезков
+    """
+
+    step = (max_val - min_val) / n_cats
+
+    edges = [min_val]
+    while edges[-1] < max_val:
+        edges.append(edges[-1] + step)
+
+    return np.array(edges, dtype=np.float64)
+
+def set_ord_cat_range(default_values, name, min_val, max_val):
+    """
+    Функция сохраняет в default_values диапазон порядкового признака и границы его отрезков
+    (save_default_values вызывается отдельно)
+
+    Parameters:
+    default_values (dictionary): Обученные значения
+    name (str): Имя признака (см. ord_cat_sizes)
+    min_val (number): Начало диапазона
+    max_val (number): Конец диапазона
+    """
+
+    default_values[name + '_min'] = min_val
+    default_values[name + '_max'] = max_val
+    default_values[name + '_cat_edges'] = get_ord_cat_edges(min_val, max_val, ord_cat_sizes[name])
+
+def get_ord_cat_edges_by_name(default_values, name):
+    edges = default_values.get(name + '_cat_edges')
+
+    if edges is None:
+        # в default_values, сохраненных без границ, они строятся по диапазону один раз на версию артефакта
+        edges = get_derived_artifact(default_values, name + '_cat_edges',
+            lambda values: get_ord_cat_edges(values[name + '_min'], values[name + '_max'], ord_cat_sizes[name]))
+
+    return edges
+
+def convert_to_ord_cat_column(values, edges):
+    """
+    Функция конвертирует числовые значения в порядковые категории (векторный вариант convert_to_ord_cat)
+
+    Parameters:
+    values (Series или ndarray): Исходные значения
+    edges (ndarray): Границы отрезков (см. get_ord_cat_edges)
+
+    Returns:
+    ndarray: Номера отрезков
+    """
+
+    # номер первой границы, не меньшей значения (для значений больше диапазона и NaN - последняя граница)
+    categories = np.digitize(np.asarray(values, dtype=np.float64), edges, right=True)
+
+    return np.minimum(categories, len(edges) - 1)
+
+def get_count_features_matrix(counts, n_features):
+    """
+    Функция возвращает бинарные признаки количества (последний признак - "n_features и более")
+
+    Parameters:
+    counts (ndarray): Количества (NaN - нет данных)
+    n_features (int): Число признаков
+
+    Returns:
+    ndarray: Матрица (записи x признаки) значений бинарных признаков (для NaN - нули)
+    """
+
+    counts = np.asarray(counts, dtype=np.float64)
+
+    result = (counts[:, np.newaxis] == np.arange(1, n_features + 1)).astype(np.int64)
+    result[:, -1] = counts >= n_features
+
+    return result
+
+def set_count_columns(df, features_list, counts, keep_missing=False):
+    """
+    Функция заполняет колонки бинарных признаков количества
+
+    Parameters:
+    df (DataFrame): Данные
+    features_list (list(str)): Имена признаков по возрастанию количества (начиная с 1)
+    counts (ndarray): Количества (NaN - нет данных)
+    keep_missing (bool): Флаг сохранения существующих значений признаков в записях без данных (иначе - нули)
+    """
+
+    features_values = get_count_features_matrix(counts, len(features_list))
+
+    if keep_missing:
+        has_count = ~np.isnan(counts)
+        for indx, feature in enumerate(features_list):
+            df[feature] = np.where(has_count, features_values[:, indx], df[feature].to_numpy())
+    else:
+        for indx, feature in enumerate(features_list):
+            df[feature] = features_values[:, indx]
+
 
 def get_city_dict_key(state, city):
     """
@@ -1307,14 +2022,18 @@ def get_center_distance(state, city, street, address_dict, city_lat, city_lng, c
         if zipcode is not None and address_by_zip_dict is not None:
             key = get_address_zip_dict_key(state, city, zipcode)
             if key not in address_by_zip_dict:
+                service_metrics.inc_counter('fyp_geo_lookups_total', source='default')
                 return 0.5
         else:
+            service_metrics.inc_counter('fyp_geo_lookups_total', source='default')
             return 0.5
     
     if key in address_dict:
+        service_metrics.inc_counter('fyp_geo_lookups_total', source='address')
         lat = float(address_dict[key]['location']['lat'])
         lng = float(address_dict[key]['location']['lng'])
     else:
+        service_metrics.inc_counter('fyp_geo_lookups_total', source='zip')
         lat = float(address_by_zip_dict[key]['location']['lat'])
         lng = float(address_by_zip_dict[key]['location']['lng'])
     
@@ -1429,6 +2148,229 @@ def get_low_price_distance(state, city, street, address_dict, cities_clusters_di
     
     return result
 
+##################################################################################################
+#
+# Векторное вычисление расстояний: координаты каждой записи определяются один раз (по адресу,
+# по почтовому индексу или не найдены), после чего все три расстояния (до центра города и до центров
+# ценовых кластеров) считаются над массивами. Результат совпадает с get_center_distance,
+# get_hight_price_distance и get_low_price_distance
+#
+##################################################################################################
+
+# источник координат записи и его метка в метрике fyp_geo_lookups_total
+geo_source_address = 0
+geo_source_zip = 1
+geo_source_missing = 2
+
+geo_sources_labels = ['address', 'zip', 'default']
+
+# расстояние для записей без координат (или без ценовых кластеров в городе)
+default_distance = 0.5
+
+class GeoDictOverlay(Mapping):
+    """
+    Словарь геоинформации с дополнением: ключи ищутся сначала в основном словаре (dict или GeoCache),
+    затем в дополнении (координаты, полученные во время работы сервиса, см. geocode_enricher.py)
+
+    Parameters:
+    base (Mapping): Основной словарь
+    overlay (dictionary): Дополнение (может пополняться из другого потока)
+    """
+
+    def __init__(self, base, overlay):
+        self.base = base
+        self.overlay = overlay
+
+    def get(self, key, default=None):
+        value = self.base.get(key)
+        if value is None:
+            value = self.overlay.get(key, default)
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.base or key in self.overlay
+
+    def __len__(self):
+        return len(self.base) + len(self.overlay)
+
+    def __iter__(self):
+        yield from self.base
+        yield from (key for key in list(self.overlay) if key not in self.base)
+
+def get_geo_dict_values(geo_dict, keys, fields):
+    """
+    Функция возвращает числовые поля значений набора ключей словаря геоинформации
+
+    Parameters:
+    geo_dict (Mapping): Словарь геоинформации
+    keys (list(str)): Ключи
+    fields (list(str)): Поля значений (путь во вложенном словаре через точку, например 'location.lat')
+
+    Returns:
+    tuple: Словарь поле -> ndarray (NaN для отсутствующих ключей) и маска найденных ключей
+    """
+
+    if isinstance(geo_dict, geo_cache.GeoCache):
+        positions = geo_dict.find_many(keys)
+        return {field: geo_dict.get_values(field, positions) for field in fields}, positions >= 0
+
+    if isinstance(geo_dict, GeoDictOverlay):
+        values, found = get_geo_dict_values(geo_dict.base, keys, fields)
+
+        missing = np.flatnonzero(~found)
+        if len(missing) > 0 and len(geo_dict.overlay) > 0:
+            overlay_values, overlay_found = get_geo_dict_values(geo_dict.overlay, [keys[indx] for indx in missing], fields)
+
+            rows = missing[overlay_found]
+            for field in fields:
+                values[field][rows] = overlay_values[field][overlay_found]
+            found[rows] = True
+
+        return values, found
+
+    values = {field: np.full(len(keys), np.NaN) for field in fields}
+    found = np.zeros(len(keys), dtype=bool)
+
+    paths = {field: field.split('.') for field in fields}
+
+    for indx, key in enumerate(keys):
+        item = geo_dict.get(key)
+        if item is None:
+            continue
+
+        found[indx] = True
+        for field, path in paths.items():
+            value = item
+            for name in path:
+                value = value[name]
+            values[field][indx] = float(value)
+
+    return values, found
+
+def resolve_addresses_locations(state, city, street, zipcode, address_dict, address_by_zip_dict=None):
+    """
+    Функция определяет координаты записей: по адресу, а если его нет в кэше - по почтовому индексу
+
+    Parameters:
+    state, city, street, zipcode (list или ndarray): Штат, город, адрес и почтовый индекс записей
+    address_dict (dictionary): Словарь с геоинформацией по адресам
+    address_by_zip_dict (dictionary): Словарь с геоинформацией по почтовым индексам
+
+    Returns:
+    tuple: Широта, долгота (ndarray, NaN - координаты не найдены) и источник координат (geo_source_*)
+    """
+
+    rows_count = len(state)
+
+    keys = [get_address_dict_key(state[indx], city[indx], street[indx]) for indx in range(rows_count)]
+    location, found = get_geo_dict_values(address_dict, keys, ['location.lat', 'location.lng'])
+    lat, lng = location['location.lat'], location['location.lng']
+
+    source = np.where(found, geo_source_address, geo_source_missing).astype(np.int8)
+
+    missing = np.flatnonzero(~found)
+    if address_by_zip_dict is not None and len(missing) > 0:
+        keys = [get_address_zip_dict_key(state[indx], city[indx], zipcode[indx]) for indx in missing]
+        location, zip_found = get_geo_dict_values(address_by_zip_dict, keys, ['location.lat', 'location.lng'])
+
+        rows = missing[zip_found]
+        lat[rows] = location['location.lat'][zip_found]
+        lng[rows] = location['location.lng'][zip_found]
+        source[rows] = geo_source_zip
+
+    return lat, lng, source
+
+def get_normalized_distance(lat, lng, center_lat, center_lng, city_bb):
+    # city_bb - матрица (записи x 4) габаритов города, как и в get_center_distance
+    size_lat = city_bb[:, 1] - city_bb[:, 0]
+    size_lng = city_bb[:, 3] - city_bb[:, 2]
+
+    # np.power, а не оператор **: для массивов он заменяется на умножение и sqrt, что расходится
+    # в последнем знаке с расчетом над float в get_center_distance
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.power(np.power(lat - center_lat, 2) / np.power(size_lat, 2) + np.power(lng - center_lng, 2) / np.power(size_lng, 2), 0.5)
+
+    return np.where(result > 1, 1, result)
+
+def get_distances_features(state, city, street, zipcode, city_lat, city_lng, city_bb, address_dict, cities_clusters_dict, address_by_zip_dict=None):
+    """
+    Функция возвращает расстояния до центра города и до центров кластеров дорогой и дешевой недвижимости
+    (см. get_center_distance, get_hight_price_distance, get_low_price_distance)
+
+    Parameters:
+    state, city, street, zipcode (list или ndarray): Штат, город, адрес и почтовый индекс записей
+    city_lat, city_lng (list или ndarray): Координаты центров городов
+    city_bb (list): BoundingBox городов
+    address_dict (dictionary): Словарь с геоинформацией по адресам
+    cities_clusters_dict (dictionary): Словарь с геоинформацией по ценовым кластерам в каждом городе
+    address_by_zip_dict (dictionary): Словарь с геоинформацией по почтовым индексам
+
+    Returns:
+    dictionary: center_dist, hp_dist, lp_dist (ndarray)
+    """
+
+    rows_count = len(state)
+
+    lat, lng, source = resolve_addresses_locations(state, city, street, zipcode, address_dict, address_by_zip_dict)
+
+    for source_indx, label in enumerate(geo_sources_labels):
+        source_count = int((source == source_indx).sum())
+        if source_count > 0:
+            service_metrics.inc_counter('fyp_geo_lookups_total', source_count, source=label)
+
+    found = source != geo_source_missing
+    city_bb = np.array([city_bb[indx] if found[indx] else [np.NaN] * 4 for indx in range(rows_count)], dtype=np.float64).reshape(rows_count, 4)
+
+    city_keys = [get_city_dict_key(state[indx], city[indx]) for indx in range(rows_count)]
+    clusters, has_clusters = get_geo_dict_values(cities_clusters_dict, city_keys, ['hight.lat', 'hight.lng', 'low.lat', 'low.lng'])
+
+    center_lat = np.asarray(city_lat, dtype=np.float64)
+    center_lng = np.asarray(city_lng, dtype=np.float64)
+
+    result = {'center_dist': np.where(found, get_normalized_distance(lat, lng, center_lat, center_lng, city_bb), default_distance)}
+
+    for cluster, feature in [('hight', 'hp_dist'), ('low', 'lp_dist')]:
+        distance = get_normalized_distance(lat, lng, clusters[cluster + '.lat'], clusters[cluster + '.lng'], city_bb)
+        result[feature] = np.where(found & has_clusters, distance, default_distance)
+
+    return result
+
+def get_unresolved_locations(df, artifacts):
+    """
+    Функция возвращает записи известных городов, координаты которых не найдены ни по адресу, ни по почтовому
+    индексу (для них используются расстояния по умолчанию), - кандидатов на геокодирование
+
+    Parameters:
+    df (DataFrame): Исходные данные (см. convert_to_data_frame)
+    artifacts (dictionary): Снимок артефактов (см. get_serving_artifacts)
+
+    Returns:
+    tuple: Маска записей и список (state, city, street, zipcode) этих записей
+    """
+
+    state, city, street, zipcode = get_location_arrays(df)
+    state, city = replace_states_and_cities_arrays(state, city)
+
+    # для записей неизвестных городов город заменяется популярным - адрес в нем искать бессмысленно
+    known = np.array([not pd.isna(city_if_exists(s, c, artifacts['cities_dict'])) for s, c in zip(state, city)], dtype=bool)
+    known &= pd.notna(street)
+
+    rows = np.flatnonzero(known)
+    _, _, source = resolve_addresses_locations(state[rows], city[rows], street[rows], zipcode[rows], artifacts['address_dict'], artifacts['address_by_zip_dict'])
+
+    rows = rows[source == geo_source_missing]
+
+    mask = np.zeros(len(df), dtype=bool)
+    mask[rows] = True
+
+    return mask, [(state[indx], city[indx], street[indx], zipcode[indx]) for indx in rows]
+
 def get_subset_mean_location(df, state, city, percentile, cities_dict, address_dict, address_by_zip_dict=None):
     """
     Функция возвращает структуру, описывающую ценовой кластер для данного города
@@ -1527,6 +2469,12 @@ facts = [
     {'col_name': 'fact_parking', 'col_value': 'Parking'}
 ]
 
+# факты homeFacts, которые пока не используются в признаках модели
+extra_facts = [
+    {'col_name': 'fact_lotsize', 'col_value': 'lotsize'},
+    {'col_name': 'fact_price_sqft', 'col_value': 'Price/sqft'}
+]
+
 city_by_zip_state = {
     '32686_FL': 'Reddick',
     '32668_FL': 'Morriston',
@@ -1558,162 +2506,446 @@ def read_default_values(default_values_file_name, force_read=False):
         try:
             with open(default_values_file_name, 'rb') as f:
                 stored_default_values = pickle.load(f)
+            register_artifact(default_values_file_name, stored_default_values)
         except:
-            stored_default_values = {}            
+            stored_default_values = {}
             save_default_values(default_values_file_name)
 
-def save_default_values(default_values_file_name):
+def save_default_values(default_values_file_name, default_values=None):
     global stored_default_values
-    
-    if stored_default_values is None:
-        stored_default_values = {}
-        
-    with open(default_values_file_name, 'wb') as f:
-        pickle.dump(stored_default_values, f)
-        
+
+    if default_values is None:
+        if stored_default_values is None:
+            stored_default_values = {}
+        default_values = stored_default_values
+
+    write_pickle_file(default_values_file_name, default_values)
+    register_artifact(default_values_file_name, default_values)
+
 def get_default_values():
     global stored_default_values
-    
+
     return stored_default_values
-    
 
-##################################################################################################
+def get_stage_default_values(default_values_file_name, default_values=None, force_read=False):
+    """
+    Функция возвращает обученные значения для этапа обработки: переданные явно (снимок артефактов
+    при предсказании - без обращения к глобальному stored_default_values) или прочитанные из файла
 
-def clear_data_base_line(df, default_values_file_name, can_drop_rows=False, force_rebuild_cached_data=False):
-    global stored_default_values
-    
-    read_default_values(default_values_file_name, force_read=True)
-    
-    df = drop_not_informative_columns(df, ['status', 'private pool', 'fireplace', 'mls-id', 'PrivatePool'])
-    
-    for fact in facts:
-        df[fact['col_name']] = df['homeFacts'].apply(lambda x: get_subfact(x, fact['col_value']))
-        
-    df = df.drop('homeFacts', axis=1)
-    
-    df['schools_count'] = df['schools'].apply(lambda x: get_schools_count(x))
-    df['schools_avg_rate'] = df['schools'].apply(lambda x: get_schools_avg_rate(x))
-    df['schools_min_distance'] = df['schools'].apply(lambda x: get_schools_min_distance(x))
-    df['schools_avg_distance'] = df['schools'].apply(lambda x: get_schools_avg_distance(x))
-    df['schools_grades_list'] = df['schools'].apply(lambda x: get_schools_grades_list(x))
+    Parameters:
+    default_values_file_name (str): Путь к файлу default_values.pkl
+    default_values (dictionary): Обученные значения или None
+    force_read (bool): Флаг повторного чтения файла
 
-    df['schools_PK'] = df['schools_grades_list'].apply(lambda x: 1 if 'PK' in x else 0)
-    df['schools_K'] = df['schools_grades_list'].apply(lambda x: 1 if 'K' in x else 0)
-    df['schools_M'] = df['schools_grades_list'].apply(lambda x: 1 if 'M' in x else 0)
-    df['schools_H'] = df['schools_grades_list'].apply(lambda x: 1 if 'H' in x else 0)
+    Returns:
+    dictionary: Обученные значения
+    """
 
-    df = df.drop(['schools_grades_list', 'schools'], axis=1)
-    
-    city_mask = df['city'].isna()
-    df.loc[city_mask, 'city'] = df[city_mask].apply(lambda x: found_city_by_zip_state(x['zipcode'], x['state']), axis=1)
-       
-    if can_drop_rows:
-        df = df.dropna(subset=['city'], axis=0)
-    else:
-        df['city'].fillna('--', inplace=True)
-    
-    if can_drop_rows:
-        df = df.dropna(subset=['street'], axis=0)
-    
-    df['city'] = df['city'].apply(lambda x: str.lower(x))
-    
-    mask = ~df['sqft'].isna()
-    df.loc[mask, 'sqft_fl'] = df[mask]['sqft'].apply(lambda x: convert_sqft_str_to_float(x))
-    
-    sqft_fill_value = df['sqft_fl'].median()
-    df['sqft_fl'].fillna(sqft_fill_value, inplace=True)
+    if default_values is not None:
+        return default_values
 
-    pr_type_fiil_value = df['propertyType'].mode()[0]
-    df['propertyType'].fillna(pr_type_fiil_value, inplace=True)
+    read_default_values(default_values_file_name, force_read=force_read)
 
-    if can_drop_rows:
-        stored_default_values['sqft_median'] = df[df['sqft_fl'] < 15000]['sqft_fl'].median()        
-        save_default_values(default_values_file_name)
+    return stored_default_values
 
-        df = df[df['sqft_fl'] < 15000].copy()
-    else:
-        mask = df['sqft_fl'] >= 15000
-        df.loc[mask, 'sqft_fl'] = stored_default_values['sqft_median']
-    
-    df = df.drop('sqft', axis=1)
+##################################################################################################
+#
+# Реестр артефактов: каждый файл (словари, default_values, модель, uscities.csv) загружается
+# один раз на процесс и перечитывается только при изменении файла на диске
+#
+##################################################################################################
 
-    df['has_mls_id'] = 0
-    mask = ~df['MlsId'].isna()
-    df.loc[mask, 'has_mls_id'] = 1
+loaded_artifacts = {}
+artifacts_lock = threading.RLock()
 
-    df = df.drop('MlsId', axis=1)
+# Как часто (в секундах) проверять изменение файлов артефактов на диске
+artifacts_check_interval = 5
 
-    pr_type_features = get_pr_type_features_list()
+def read_pickle_file(file_path):
+    with open(file_path, 'rb') as f:
+        return pickle.load(f)
 
-    mask = ~df['propertyType'].isna()
+def write_pickle_file(file_path, value):
+    """
+    Функция атомарной записи объекта в pickle-файл (через временный файл),
+    чтобы читающие процессы никогда не видели частично записанный файл
 
-    for pr_type_feature in pr_type_features:
-        df[pr_type_feature] = 0
-        df.loc[mask, pr_type_feature] = df[mask]['propertyType'].apply(lambda x: get_pr_type_feature(x, pr_type_feature))
-       
-    story_features = get_stories_features_list()
+    Parameters:
+    file_path (str): Путь к файлу
+    value (any): Сохраняемый объект
+    """
 
-    mask = ~df['propertyType'].isna()
+    tmp_file_path = file_path + '.tmp' + str(os.getpid())
+    with open(tmp_file_path, 'wb') as f:
+        pickle.dump(value, f)
+    os.replace(tmp_file_path, file_path)
 
-    for story_feature in story_features:
-        df[story_feature] = 0
-        df.loc[mask, story_feature] = df[mask]['propertyType'].apply(lambda x: get_stroty_feature_by_pr_type(x, story_feature))
-       
-    mask = ~df['stories'].isna()
-    df.loc[mask, 'stories_int'] = df[mask]['stories'].apply(get_story_count_by_story)
-    
-    story_features = get_stories_features_list()
-    st_count = 1
+def get_file_signature(file_path):
+    """
+    Функция возвращает сигнатуру файла, по которой определяется его изменение на диске
+
+    Parameters:
+    file_path (str): Путь к файлу
+
+    Returns:
+    tuple: (mtime в наносекундах, размер) или None, если файла нет
+    """
+
+    try:
+        st = os.stat(file_path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+def register_artifact(file_path, value):
+    """
+    Функция помещает в реестр уже загруженный (или только что сохраненный) артефакт
+
+    Parameters:
+    file_path (str): Путь к файлу артефакта
+    value (any): Объект артефакта
+    """
+
+    with artifacts_lock:
+        loaded_artifacts[file_path] = {
+            'value': value,
+            'signature': get_file_signature(file_path),
+            'checked_at': time.monotonic()
+        }
+
+def load_artifact(file_path, loader=read_pickle_file, default_value=None, check_interval=None, print_error=False):
+    """
+    Функция возвращает артефакт из реестра, загружая его при первом обращении и при изменении файла на диске.
+    Новая версия полностью загружается до замены старой, поэтому подмена атомарна.
+    Если новую версию прочитать не удалось, продолжает использоваться предыдущая
+
+    Parameters:
+    file_path (str): Путь к файлу артефакта
+    loader (function): Функция загрузки файла
+    default_value (any): Значение, если файл не удалось загрузить ни разу
+    check_interval (float): Интервал проверки изменения файла в секундах (по умолчанию artifacts_check_interval)
+    print_error (bool): Флаг вывода ошибки в консоль
+
+    Returns:
+    any: Объект артефакта
+    """
+
+    if check_interval is None:
+        check_interval = artifacts_check_interval
+
+    item = loaded_artifacts.get(file_path)
+    if item is not None and time.monotonic() - item['checked_at'] < check_interval:
+        return item['value']
+
+    with artifacts_lock:
+        item = loaded_artifacts.get(file_path)
+        now = time.monotonic()
+
+        if item is not None and now - item['checked_at'] < check_interval:
+            return item['value']
+
+        signature = get_file_signature(file_path)
+        if item is not None and item['signature'] == signature:
+            loaded_artifacts[file_path] = dict(item, checked_at=now)
+            return item['value']
+
+        try:
+            value = loader(file_path)
+        except Exception as ex:
+            if print_error:
+                print(ex)
+
+            if item is not None:
+                loaded_artifacts[file_path] = dict(item, checked_at=now)
+                return item['value']
+
+            value = default_value
+            signature = None
+
+        loaded_artifacts[file_path] = {
+            'value': value,
+            'signature': signature,
+            'checked_at': now
+        }
+
+        return value
+
+def get_artifacts_version(items):
+    """
+    Функция возвращает версию набора артефактов (меняется при изменении любого из файлов)
+
+    Parameters:
+    items (list(dictionary)): Записи реестра артефактов (см. load_artifact)
+
+    Returns:
+    str: Версия набора артефактов
+    """
+
+    signatures = [str(None if item is None else item['signature']) for item in items]
+
+    return hashlib.md5('|'.join(signatures).encode('utf-8')).hexdigest()[:16]
+
+
+##################################################################################################
+#
+# Признаки текстовых полей с небольшим числом различных значений (propertyType, stories, beds, baths,
+# cooling, heating, parking): признаки вычисляются один раз для каждого различного значения и
+# раздаются по записям. Результаты хранятся в ограниченной по размеру таблице значение -> признаки,
+# общей для всех запросов процесса; таблица, накопленная при обучении, сохраняется в default_values
+#
+##################################################################################################
+
+def get_property_type_text_features(value):
+    return get_regexps_family_vector(pr_type_matcher, value) + get_regexps_family_vector(story_pr_type_matcher, value)
 
-    mask = ~df['stories_int'].isna()
-    for st_feature in story_features:
-        if st_count < len(story_features):
-            df.loc[mask, st_feature] = df[mask]['stories_int'].apply(lambda x: 1 if st_count == x else 0)
+def get_stories_text_features(value):
+    return [get_story_count_by_story(value)]
+
+def get_beds_text_features(value):
+    beds = clear_beds_from_sqr(value)
+    return [np.NaN if pd.isna(beds) else convert_beds_str_to_int(beds)]
+
+def get_baths_text_features(value):
+    return [convert_baths_str_to_int(value)]
+
+# поле -> функция вычисления признаков по значению, имена признаков, значение признаков для пропуска
+text_columns_features = {
+    'propertyType': (get_property_type_text_features, get_pr_type_features_list() + get_stories_features_list(), 0),
+    'stories': (get_stories_text_features, ['stories_int'], np.NaN),
+    'beds': (get_beds_text_features, ['beds_int'], np.NaN),
+    'baths': (get_baths_text_features, ['baths_int'], np.NaN),
+    'fact_cooling': (lambda value: get_regexps_family_vector(cooling_matcher, value), cooling_matcher['features'], 0),
+    'fact_heating': (lambda value: get_regexps_family_vector(heating_matcher, value), heating_matcher['features'], 0),
+    'fact_parking': (lambda value: get_regexps_family_vector(parking_matcher, value), parking_matcher['features'], 0)
+}
+
+# поле -> векторная функция вычисления единственного признака сразу для колонки новых значений
+text_columns_vector_features = {
+    'stories': get_story_count_column,
+    'beds': convert_beds_column_to_int,
+    'baths': convert_baths_column_to_int
+}
+
+# Версия таблицы: меняется при изменении функций вычисления признаков (сохраненная таблица другой версии не используется)
+text_features_version = 1
+# Максимальное число значений в таблице одного поля
+text_features_table_max_size = 20000
+
+text_features_tables = None
+text_features_lock = threading.Lock()
+
+def load_text_features_tables(default_values):
+    """
+    Функция заполняет таблицы значение -> признаки из сохраненных при обучении (см. clear_data_base_line)
+
+    Parameters:
+    default_values (dictionary): Значения по умолчанию (default_values.pkl)
+    """
+
+    global text_features_tables
+
+    stored = None if default_values is None else default_values.get('text_features_tables')
+
+    tables = {}
+    if stored is not None and stored['version'] == text_features_version:
+        for column, table in stored['tables'].items():
+            tables[column] = dict(list(table.items())[-text_features_table_max_size:])
+
+    with text_features_lock:
+        text_features_tables = tables
+
+def get_text_features_tables_snapshot():
+    with text_features_lock:
+        return {
+            'version': text_features_version,
+            'tables': {column: dict(table) for column, table in (text_features_tables or {}).items()}
+        }
+
+def get_text_value_features(column, value):
+    """
+    Функция возвращает признаки одного значения текстового поля (из таблицы или вычисляет и запоминает их)
+
+    Parameters:
+    column (str): Имя поля (см. text_columns_features)
+    value (str): Значение поля
+
+    Returns:
+    tuple: Значения признаков
+    """
+
+    get_features = text_columns_features[column][0]
+
+    # в таблицу попадают только строки
+    if not isinstance(value, str):
+        return tuple(get_features(value))
+
+    table = get_text_features_table(column)
+
+    features = table.get(value)
+    if features is None:
+        features = tuple(get_features(value))
+        store_text_value_features(table, value, features)
+
+    return features
+
+def get_text_features_table(column):
+    if text_features_tables is None:
+        load_text_features_tables(stored_default_values)
+
+    return text_features_tables.setdefault(column, {})
+
+def store_text_value_features(table, value, features):
+    with text_features_lock:
+        # вытесняются самые старые значения
+        while len(table) >= text_features_table_max_size:
+            del table[next(iter(table))]
+        table[value] = features
+
+def get_text_column_features(column, values):
+    """
+    Функция возвращает признаки текстового поля для колонки данных: признаки вычисляются
+    один раз для каждого различного значения (pd.factorize) и раздаются по записям
+
+    Parameters:
+    column (str): Имя поля (см. text_columns_features)
+    values (Series или ndarray): Значения поля
+
+    Returns:
+    ndarray: Матрица (записи x признаки) значений признаков
+    """
+
+    _, features_names, na_value = text_columns_features[column]
+    dtype = np.float64 if pd.isna(na_value) else np.int64
+
+    if len(values) <= column_loop_max_size:
+        return np.array([
+            [na_value] * len(features_names) if pd.isna(value) else get_text_value_features(column, value)
+            for value in values
+        ], dtype=dtype).reshape(len(values), len(features_names))
+
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+
+    # последняя строка - признаки пропуска (код -1)
+    uniques_features = np.full((len(uniques) + 1, len(features_names)), na_value, dtype=dtype)
+
+    table = get_text_features_table(column)
+
+    new_indexes = []
+    for indx, value in enumerate(uniques):
+        features = table.get(value) if isinstance(value, str) else None
+        if features is None:
+            new_indexes.append(indx)
         else:
-            df.loc[mask, st_feature] = df[mask]['stories_int'].apply(lambda x: 1 if st_count <= x else 0)
+            uniques_features[indx] = features
+
+    new_values = pd.Series(uniques[new_indexes], dtype=object)
+    get_column_features = text_columns_vector_features.get(column)
 
-        st_count += 1
+    if get_column_features is not None and pd.api.types.infer_dtype(new_values) == 'string':
+        # значения, которых нет в таблице, разбираются сразу всей колонкой
+        for indx, value, feature_value in zip(new_indexes, new_values, get_column_features(new_values)):
+            uniques_features[indx] = feature_value
+            store_text_value_features(table, value, (float(feature_value), ))
+    else:
+        for indx, value in zip(new_indexes, new_values):
+            uniques_features[indx] = get_text_value_features(column, value)
+
+    return uniques_features[codes]
+
+def set_text_column_features(df, column):
+    features_values = get_text_column_features(column, df[column])
+
+    for indx, feature in enumerate(text_columns_features[column][1]):
+        df[feature] = features_values[:, indx]
+
+##################################################################################################
+
+# наиболее частый тип недвижимости обучающей выборки - для default_values, сохраненных без property_type_mode
+default_property_type = 'single-family home'
+
+def get_fitted_property_type(default_values):
+    return default_values.get('property_type_mode', default_property_type)
+
+def clear_data_base_line(df, default_values_file_name, can_drop_rows=False, force_rebuild_cached_data=False, default_values=None):
     
-    df = df.drop(['propertyType', 'stories', 'stories_int'], axis=1)
+    default_values = get_stage_default_values(default_values_file_name, default_values, force_read=force_rebuild_cached_data)
     
-    mask = ~df['beds'].isna()
-    df.loc[mask, 'beds'] = df[mask]['beds'].apply(clear_beds_from_sqr)    
-
-    mask = ~df['beds'].isna()
-    df.loc[mask, 'beds_int'] = df[mask]['beds'].apply(convert_beds_str_to_int)
+    df = drop_not_informative_columns(df, ['status', 'private pool', 'fireplace', 'mls-id', 'PrivatePool'])
     
-    beds_features = get_beds_features_list()
-    beds_count = 1
-
-    mask = ~df['beds_int'].isna()
-    for bed_feature in beds_features:
-        df[bed_feature] = 0
-        if beds_count < len(beds_features):
-            df.loc[mask, bed_feature] = df[mask]['beds_int'].apply(lambda x: 1 if beds_count == x else 0)
-        else:
-            df.loc[mask, bed_feature] = df[mask]['beds_int'].apply(lambda x: 1 if beds_count <= x else 0)
+    home_facts = get_home_facts_columns(df['homeFacts'], facts)
+    for fact in facts:
+        df[fact['col_name']] = home_facts[fact['col_name']]
+        
+    df = df.drop('homeFacts', axis=1)
+    
+    schools_features = get_schools_features_columns(df['schools'])
+    for col in schools_features.columns:
+        df[col] = schools_features[col]
 
-        beds_count += 1
+    df = df.drop('schools', axis=1)
+    
+    city_mask = df['city'].isna()
+    df.loc[city_mask, 'city'] = df[city_mask].apply(lambda x: found_city_by_zip_state(x['zipcode'], x['state']), axis=1)
+       
+    if can_drop_rows:
+        df = df.dropna(subset=['city'], axis=0)
+    else:
+        df['city'].fillna('--', inplace=True)
+    
+    if can_drop_rows:
+        df = df.dropna(subset=['street'], axis=0)
     
-    df = df.drop(['beds_int', 'beds'], axis=1)
+    df['city'] = df['city'].apply(lambda x: str.lower(x))
     
-    mask = ~df['baths'].isna()
-    df.loc[mask, 'baths_int'] = df[mask]['baths'].apply(convert_baths_str_to_int)
+    df['sqft_fl'] = convert_sqft_column_to_float(df['sqft'])
     
-    baths_features = get_bathrooms_features_list()
-    baths_count = 1
+    if can_drop_rows:
+        sqft_fill_value = df['sqft_fl'].median()
+        pr_type_fiil_value = df['propertyType'].mode()[0]
+        default_values['property_type_mode'] = pr_type_fiil_value
+    else:
+        # признаки записи не должны зависеть от других записей пакета - пропуски заполняются обученными значениями
+        sqft_fill_value = default_values['sqft_median']
+        pr_type_fiil_value = get_fitted_property_type(default_values)
 
-    mask = ~df['baths_int'].isna()
-    for bath_feature in baths_features:
-        df[bath_feature] = 0
-        if baths_count < len(baths_features):
-            df.loc[mask, bath_feature] = df[mask]['baths_int'].apply(lambda x: 1 if baths_count == x else 0)
-        else:
-            df.loc[mask, bath_feature] = df[mask]['baths_int'].apply(lambda x: 1 if baths_count <= x else 0)
+    df['sqft_fl'].fillna(sqft_fill_value, inplace=True)
+    df['propertyType'].fillna(pr_type_fiil_value, inplace=True)
+
+    if can_drop_rows:
+        default_values['sqft_median'] = df[df['sqft_fl'] < 15000]['sqft_fl'].median()        
+        save_default_values(default_values_file_name, default_values)
+
+        df = df[df['sqft_fl'] < 15000].copy()
+    else:
+        mask = df['sqft_fl'] >= 15000
+        df.loc[mask, 'sqft_fl'] = default_values['sqft_median']
+    
+    df = df.drop('sqft', axis=1)
+
+    df['has_mls_id'] = 0
+    mask = ~df['MlsId'].isna()
+    df.loc[mask, 'has_mls_id'] = 1
 
-        baths_count += 1
+    df = df.drop('MlsId', axis=1)
+
+    # признаки текстовых полей вычисляются один раз для каждого различного значения
+    set_text_column_features(df, 'propertyType')
+
+    # число этажей из поля stories заменяет признаки этажности, найденные в propertyType
+    stories_int = get_text_column_features('stories', df['stories'])[:, 0]
+    set_count_columns(df, get_stories_features_list(), stories_int, keep_missing=True)
+    
+    df = df.drop(['propertyType', 'stories'], axis=1)
     
-    df = df.drop(['baths_int', 'baths'], axis=1)
+    beds_int = get_text_column_features('beds', df['beds'])[:, 0]
+    set_count_columns(df, get_beds_features_list(), beds_int)
+    
+    df = df.drop('beds', axis=1)
+    
+    baths_int = get_text_column_features('baths', df['baths'])[:, 0]
+    set_count_columns(df, get_bathrooms_features_list(), baths_int)
+    
+    df = df.drop('baths', axis=1)
     
     df['was_remodeled'] = 0
 
@@ -1722,33 +2954,25 @@ def clear_data_base_line(df, default_values_file_name, can_drop_rows=False, forc
     
     df = df.drop('fact_remodeled_year', axis=1)
 
-    need_rebuil_data = False
-    try:
-        if force_rebuild_cached_data:
-            if 'years_distr_subset' not in stored_default_values:
-                need_rebuil_data = True
-            else:
-                years_distr_subset = stored_default_values['years_distr_subset']
-        else:
-            years_distr_subset = stored_default_values['years_distr_subset']
-            need_rebuil_data = False
-    except Exception as ex:
-        need_rebuil_data = True
-        
-    if need_rebuil_data:
-        years_subset_size = get_nunuques_size(df, 'fact_year_built', percent=50, start_n=10, step=5)
-        years_distr_subset = get_weighted_nuniques_list(df, 'fact_year_built', years_subset_size)
-        
-        stored_default_values['years_distr_subset'] = years_distr_subset       
-        save_default_values(default_values_file_name)
-
     if force_rebuild_cached_data:
-        df['fact_year_built'] = df['fact_year_built'].apply(lambda x: get_weighted_random_item(years_distr_subset) if pd.isnull(x) or x == 'No Data' else x)
+        # пропуски обучающей выборки заполняются случайными годами с распределением наиболее частых значений
+        mask = df['fact_year_built'].isna() | (df['fact_year_built'] == 'No Data')
+
+        years_distribution = default_values.get('years_distribution')
+        if years_distribution is None:
+            years_distribution = get_values_distribution(df.loc[~mask, 'fact_year_built'], percent=50, start_n=10, step=5)
+
+            default_values['years_distribution'] = years_distribution
+            default_values.pop('years_distr_subset', None)
+            save_default_values(default_values_file_name, default_values)
+
+        df['fact_year_built'] = df['fact_year_built'].astype(object)
+        df.loc[mask, 'fact_year_built'] = sample_values_distribution(years_distribution, mask.sum(), random_state=years_imputer_seed)
         freq_year = df['fact_year_built'].mode()[0]
-        stored_default_values['years_mode'] = freq_year
-        save_default_values(default_values_file_name)
+        default_values['years_mode'] = freq_year
+        save_default_values(default_values_file_name, default_values)
     else:
-        freq_year = stored_default_values['years_mode']
+        freq_year = default_values['years_mode']
         df['fact_year_built'] = df['fact_year_built'].apply(lambda x: freq_year if pd.isnull(x) or x == 'No Data' else x)
     
     df['fact_year_built'] = df['fact_year_built'].apply(lambda x: int(x))
@@ -1757,49 +2981,35 @@ def clear_data_base_line(df, default_values_file_name, can_drop_rows=False, forc
     
     df = df.drop('fact_year_built', axis=1)
     
-    cooling_features = get_cooling_features_list()
-
-    mask = ~df['fact_cooling'].isna()
-
-    for cooling_feature in cooling_features:
-        df[cooling_feature] = 0
-        df.loc[mask, cooling_feature] = df[mask]['fact_cooling'].apply(lambda x: get_cooling_feature(x, cooling_feature))
+    set_text_column_features(df, 'fact_cooling')
         
     df = df.drop('fact_cooling', axis=1)
     
-    heating_features = get_heating_features_list()
-
-    mask = ~df['fact_heating'].isna()
-
-    for heat_feature in heating_features:
-        df[heat_feature] = 0
-        df.loc[mask, heat_feature] = df[mask]['fact_heating'].apply(lambda x: get_heating_feature(x, heat_feature))
+    set_text_column_features(df, 'fact_heating')
         
     df = df.drop('fact_heating', axis=1)
     
-    parking_features = get_parking_features_list()
-
-    mask = ~df['fact_parking'].isna()
-
-    for parking_feature in parking_features:
-        df[parking_feature] = 0
-        df.loc[mask, parking_feature] = df[mask]['fact_parking'].apply(lambda x: get_parking_feature(x, parking_feature))
+    set_text_column_features(df, 'fact_parking')
         
     df = df.drop('fact_parking', axis=1)
+
+    if can_drop_rows:
+        # таблица значение -> признаки, накопленная на обучающей выборке, используется сервисом с первого запроса
+        default_values['text_features_tables'] = get_text_features_tables_snapshot()
+        save_default_values(default_values_file_name, default_values)
     
     return df
 
-def encode_state_and_city(df, default_values_file_name, can_drop_rows=False, force_rebuild_cached_data=False):
-    global stored_default_values
+def encode_state_and_city(df, default_values_file_name, can_drop_rows=False, force_rebuild_cached_data=False, default_values=None):
     
-    read_default_values(default_values_file_name)
+    default_values = get_stage_default_values(default_values_file_name, default_values)
 
     need_rebuil_data = False
     try:
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            top_cities = stored_default_values['top_cities_list']
+            top_cities = default_values['top_cities_list']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -1807,8 +3017,8 @@ def encode_state_and_city(df, default_values_file_name, can_drop_rows=False, for
     if need_rebuil_data:
         top_cities = set((df['city'].value_counts() / df.shape[0] * 100)[:top_cities_slice_size].index)
         
-        stored_default_values['top_cities_list'] = top_cities
-        save_default_values(default_values_file_name)
+        default_values['top_cities_list'] = top_cities
+        save_default_values(default_values_file_name, default_values)
             
     df['city'] = df['city'].apply(lambda x: x if x in top_cities else 'other_city')
 
@@ -1817,7 +3027,7 @@ def encode_state_and_city(df, default_values_file_name, can_drop_rows=False, for
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            bin_encoder = stored_default_values['state_binenc']
+            bin_encoder = default_values['state_binenc']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -1826,8 +3036,8 @@ def encode_state_and_city(df, default_values_file_name, can_drop_rows=False, for
         bin_encoder = ce.BinaryEncoder(cols=['state'])
         bin_encoder = bin_encoder.fit(df['state'])
         
-        stored_default_values['state_binenc'] = bin_encoder
-        save_default_values(default_values_file_name)
+        default_values['state_binenc'] = bin_encoder
+        save_default_values(default_values_file_name, default_values)
 
     type_bin = bin_encoder.transform(df['state'])
     df = pd.concat([df, type_bin], axis=1).drop('state', axis=1)
@@ -1837,7 +3047,7 @@ def encode_state_and_city(df, default_values_file_name, can_drop_rows=False, for
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            bin_encoder = stored_default_values['city_binenc']
+            bin_encoder = default_values['city_binenc']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -1846,8 +3056,8 @@ def encode_state_and_city(df, default_values_file_name, can_drop_rows=False, for
         bin_encoder = ce.BinaryEncoder(cols=['city'])
         bin_encoder = bin_encoder.fit(df['city'])
 
-        stored_default_values['city_binenc'] = bin_encoder
-        save_default_values(default_values_file_name)
+        default_values['city_binenc'] = bin_encoder
+        save_default_values(default_values_file_name, default_values)
 
     type_bin = bin_encoder.transform(df['city'])
     df = pd.concat([df, type_bin], axis=1).drop('city', axis=1)
@@ -1922,13 +3132,7 @@ def get_cities_dict(file_path, force_read=False, print_error=False):
     global cities_dict
     
     if cities_dict is None or force_read:
-        try:
-            with open(file_path, 'rb') as f:
-                cities_dict = pickle.load(f)
-        except Exception as ex:
-            if print_error:
-                print(ex)
-            cities_dict = {}
+        cities_dict = load_artifact(file_path, read_geo_dict_file, default_value={}, check_interval=0, print_error=print_error)
     
     return cities_dict
 
@@ -1937,13 +3141,7 @@ def get_addresses_dict(file_path, force_read=False, print_error=False):
     global address_dict
     
     if address_dict is None or force_read:
-        try:
-            with open(file_path, 'rb') as f:
-                address_dict = pickle.load(f)
-        except Exception as ex:
-            if print_error:
-                print(ex)
-            address_dict = {}
+        address_dict = load_artifact(file_path, read_geo_dict_file, default_value={}, check_interval=0, print_error=print_error)
             
     return address_dict
 
@@ -1952,13 +3150,7 @@ def get_address_by_zipcode_dict(file_path, force_read=False, print_error=False):
     global address_by_zip_dict
     
     if address_by_zip_dict is None or force_read:
-        try:
-            with open(file_path, 'rb') as f:
-                address_by_zip_dict = pickle.load(f)
-        except Exception as ex:
-            if print_error:
-                print(ex)
-            address_by_zip_dict = {}
+        address_by_zip_dict = load_artifact(file_path, read_geo_dict_file, default_value={}, check_interval=0, print_error=print_error)
             
     return address_by_zip_dict
 
@@ -1966,13 +3158,7 @@ def get_citiess_clusters_dict(file_path, force_read=False, print_error=False):
     global cities_clusters_dict
     
     if cities_clusters_dict is None or force_read:
-        try:
-            with open(file_path, 'rb') as f:
-                cities_clusters_dict = pickle.load(f)
-        except Exception as ex:
-            if print_error:
-                print(ex)
-            cities_clusters_dict = {}
+        cities_clusters_dict = load_artifact(file_path, read_geo_dict_file, default_value={}, check_interval=0, print_error=print_error)
             
     return cities_clusters_dict
 
@@ -1986,10 +3172,9 @@ def city_if_exists(state, city, cities_dict):
         return np.NaN
 
 
-def fix_incorrect_states_and_cities(df, default_values_file_name, cities_dict, can_drop_rows=False):
-    global stored_default_values
+def fix_incorrect_states_and_cities(df, default_values_file_name, cities_dict, can_drop_rows=False, default_values=None):
     
-    read_default_values(default_values_file_name)
+    default_values = get_stage_default_values(default_values_file_name, default_values)
 
     for s_repl in states_replace:
         mask = (df['state'] == s_repl[0])
@@ -2011,28 +3196,48 @@ def fix_incorrect_states_and_cities(df, default_values_file_name, cities_dict, c
         for _, rec in top_state_cities.iterrows():
             pop_cities[rec['state']] = rec['city']      
         
-        stored_default_values['popular_state_name'] = top_state
-        stored_default_values['popular_cities'] = pop_cities
-        save_default_values(default_values_file_name)
+        default_values['popular_state_name'] = top_state
+        default_values['popular_cities'] = pop_cities
+        save_default_values(default_values_file_name, default_values)
     else:
         for indx, rec in df.iterrows():
             if not pd.isna(rec['city']):
                 continue
             
-            if rec['state'] not in stored_default_values['popular_cities']:
-                df.loc[indx, 'state'] = stored_default_values['popular_state_name']
-                df.loc[indx, 'city'] = stored_default_values['popular_cities'][stored_default_values['popular_state_name']]
+            if rec['state'] not in default_values['popular_cities']:
+                df.loc[indx, 'state'] = default_values['popular_state_name']
+                df.loc[indx, 'city'] = default_values['popular_cities'][default_values['popular_state_name']]
             else:
                 if pd.isna(rec['city']):
-                    df.loc[indx, 'city'] = stored_default_values['popular_cities'][rec['state']]
+                    df.loc[indx, 'city'] = default_values['popular_cities'][rec['state']]
 
     return df        
 
 
-def add_city_features(df, default_values_file_name, cities_dict, address_dict, address_by_zip_dict, cities_clusters_dict, force_rebuild_cached_data=False):
-    global stored_default_values
+def get_popular_cities_types(df):
+    return (df['city_type'].value_counts())[:10].index
+
+def build_popular_cities_types(bin_encoder):
+    # кодировщик обучен на типах после замены непопулярных на 'other_type', т.е. его категории - популярные типы
+    mapping = bin_encoder.ordinal_encoder.mapping[0]['mapping']
+    return pd.Index([x for x in mapping.index if not pd.isna(x) and x != 'other_type'])
+
+def get_fitted_popular_cities_types(default_values):
+    """
+    Функция возвращает популярные типы городов обучающей выборки (по обученному city_type_binenc)
+
+    Parameters:
+    default_values (dictionary): Обученные значения (см. read_default_values)
+
+    Returns:
+    Index: Популярные типы городов
+    """
+
+    return get_derived_artifact(default_values['city_type_binenc'], 'popular_cities_types', build_popular_cities_types)
+
+def add_city_features(df, default_values_file_name, cities_dict, address_dict, address_by_zip_dict, cities_clusters_dict, force_rebuild_cached_data=False, default_values=None):
     
-    read_default_values(default_values_file_name)
+    default_values = get_stage_default_values(default_values_file_name, default_values)
 
     cities_features = [
         {'dict_field': 'type', 'df_field': 'city_type'},
@@ -2045,19 +3250,34 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
     for city_feature in cities_features:
         df[city_feature['df_field']] = df.apply(lambda x: get_city_feature(x['state'], x['city'], city_feature['dict_field'], cities_dict), axis=1)
         
-    popular_cities_types = (df['city_type'].value_counts())[:10].index
+    if force_rebuild_cached_data or 'city_type_binenc' not in default_values:
+        popular_cities_types = get_popular_cities_types(df)
+    else:
+        popular_cities_types = get_fitted_popular_cities_types(default_values)
+
     df['city_type'] = df['city_type'].apply(lambda x: x if x in popular_cities_types else 'other_type')
     
-    df['center_dist'] = df.apply(lambda  x: get_center_distance(x['state'], x['city'], x['street'], address_dict, x['city_lat'], x['city_lng'], x['city_boundingbox'], x['zipcode'], address_by_zip_dict), axis=1)
-    df['hp_dist'] = df.apply(lambda  x: get_hight_price_distance(x['state'], x['city'], x['street'], address_dict, cities_clusters_dict, x['city_boundingbox'], x['zipcode'], address_by_zip_dict), axis=1)    
-    df['lp_dist'] = df.apply(lambda  x: get_low_price_distance(x['state'], x['city'], x['street'], address_dict, cities_clusters_dict, x['city_boundingbox'], x['zipcode'], address_by_zip_dict), axis=1)   
+    distances = get_distances_features(
+        df['state'].to_numpy(dtype=object),
+        df['city'].to_numpy(dtype=object),
+        df['street'].to_numpy(dtype=object),
+        df['zipcode'].to_numpy(dtype=object),
+        df['city_lat'].to_numpy(),
+        df['city_lng'].to_numpy(),
+        df['city_boundingbox'].tolist(),
+        address_dict,
+        cities_clusters_dict,
+        address_by_zip_dict
+    )
+    for col, values in distances.items():
+        df[col] = values
     
     need_rebuil_data = False
     try:
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            bin_encoder = stored_default_values['city_type_binenc']
+            bin_encoder = default_values['city_type_binenc']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2066,8 +3286,8 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
         bin_encoder = ce.BinaryEncoder(cols=['city_type'])
         bin_encoder = bin_encoder.fit(df['city_type'])
         
-        stored_default_values['city_type_binenc'] = bin_encoder
-        save_default_values(default_values_file_name)
+        default_values['city_type_binenc'] = bin_encoder
+        save_default_values(default_values_file_name, default_values)
 
     type_bin = bin_encoder.transform(df['city_type'])
     df = pd.concat([df, type_bin], axis=1).drop('city_type', axis=1)
@@ -2076,23 +3296,17 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
         min_val = df['city_importance'].min()
         max_val = df['city_importance'].max()
         
-        stored_default_values['city_importance_min'] = min_val
-        stored_default_values['city_importance_max'] = max_val
-        save_default_values(default_values_file_name)
-    else:
-        min_val = stored_default_values['city_importance_min']
-        max_val = stored_default_values['city_importance_max']
-        
-    n_cats = 15
-    df['city_importance_cat'] = 0
-    df['city_importance_cat'] = df['city_importance'].apply(lambda x: convert_to_ord_cat(x, min_val, max_val, n_cats))
+        set_ord_cat_range(default_values, 'city_importance', min_val, max_val)
+        save_default_values(default_values_file_name, default_values)
+
+    df['city_importance_cat'] = convert_to_ord_cat_column(df['city_importance'], get_ord_cat_edges_by_name(default_values, 'city_importance'))
 
     need_rebuil_data = False
     try:
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            bin_encoder = stored_default_values['city_importance_cat_binenc']
+            bin_encoder = default_values['city_importance_cat_binenc']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2101,8 +3315,8 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
         bin_encoder = ce.BinaryEncoder(cols=['city_importance_cat'])
         bin_encoder = bin_encoder.fit(df['city_importance_cat'])
         
-        stored_default_values['city_importance_cat_binenc'] = bin_encoder
-        save_default_values(default_values_file_name)
+        default_values['city_importance_cat_binenc'] = bin_encoder
+        save_default_values(default_values_file_name, default_values)
 
     type_bin = bin_encoder.transform(df['city_importance_cat'])
     df = pd.concat([df, type_bin], axis=1).drop(['city_importance', 'city_importance_cat'], axis=1)
@@ -2113,23 +3327,17 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
         min_val = df['city_sqr'].min()
         max_val = df['city_sqr'].mean()
         
-        stored_default_values['city_sqr_min'] = min_val
-        stored_default_values['city_sqr_max'] = max_val
-        save_default_values(default_values_file_name)
-    else:
-        min_val = stored_default_values['city_sqr_min']
-        max_val = stored_default_values['city_sqr_max']
+        set_ord_cat_range(default_values, 'city_sqr', min_val, max_val)
+        save_default_values(default_values_file_name, default_values)
 
-    n_cats = 15
-    df['city_sqr_cat'] = 0
-    df['city_sqr_cat'] = df['city_sqr'].apply(lambda x: convert_to_ord_cat(x, min_val, max_val, n_cats))
+    df['city_sqr_cat'] = convert_to_ord_cat_column(df['city_sqr'], get_ord_cat_edges_by_name(default_values, 'city_sqr'))
     
     need_rebuil_data = False
     try:
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            bin_encoder = stored_default_values['city_sqr_cat_binenc']
+            bin_encoder = default_values['city_sqr_cat_binenc']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2138,8 +3346,8 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
         bin_encoder = ce.BinaryEncoder(cols=['city_sqr_cat'])
         bin_encoder = bin_encoder.fit(df['city_sqr_cat'])
         
-        stored_default_values['city_sqr_cat_binenc'] = bin_encoder
-        save_default_values(default_values_file_name)
+        default_values['city_sqr_cat_binenc'] = bin_encoder
+        save_default_values(default_values_file_name, default_values)
 
     type_bin = bin_encoder.transform(df['city_sqr_cat'])
     df = pd.concat([df, type_bin], axis=1).drop(['city_sqr', 'city_sqr_cat'], axis=1)
@@ -2150,38 +3358,26 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
         min_val = df['city_lat'].min()
         max_val = df['city_lat'].max()
         
-        stored_default_values['city_lat_min'] = min_val
-        stored_default_values['city_lat_max'] = max_val
-        save_default_values(default_values_file_name)
-    else:
-        min_val = stored_default_values['city_lat_min']
-        max_val = stored_default_values['city_lat_max']
+        set_ord_cat_range(default_values, 'city_lat', min_val, max_val)
+        save_default_values(default_values_file_name, default_values)
 
-    n_cats = 31
-    df['city_lat_cat'] = 0
-    df['city_lat_cat'] = df['city_lat'].apply(lambda x: convert_to_ord_cat(x, min_val, max_val, n_cats))
+    df['city_lat_cat'] = convert_to_ord_cat_column(df['city_lat'], get_ord_cat_edges_by_name(default_values, 'city_lat'))
     
     if force_rebuild_cached_data:
         min_val = df['city_lng'].min()
         max_val = df['city_lng'].max()
         
-        stored_default_values['city_lng_min'] = min_val
-        stored_default_values['city_lng_max'] = max_val
-        save_default_values(default_values_file_name)
-    else:
-        min_val = stored_default_values['city_lng_min']
-        max_val = stored_default_values['city_lng_max']
+        set_ord_cat_range(default_values, 'city_lng', min_val, max_val)
+        save_default_values(default_values_file_name, default_values)
 
-    n_cats = 31
-    df['city_lng_cat'] = 0
-    df['city_lng_cat'] = df['city_lng'].apply(lambda x: convert_to_ord_cat(x, min_val, max_val, n_cats))
+    df['city_lng_cat'] = convert_to_ord_cat_column(df['city_lng'], get_ord_cat_edges_by_name(default_values, 'city_lng'))
     
     need_rebuil_data = False
     try:
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            bin_encoder = stored_default_values['city_lat_cat_binenc']
+            bin_encoder = default_values['city_lat_cat_binenc']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2190,8 +3386,8 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
         bin_encoder = ce.BinaryEncoder(cols=['city_lat_cat'])
         bin_encoder = bin_encoder.fit(df['city_lat_cat'])
         
-        stored_default_values['city_lat_cat_binenc'] = bin_encoder
-        save_default_values(default_values_file_name)
+        default_values['city_lat_cat_binenc'] = bin_encoder
+        save_default_values(default_values_file_name, default_values)
 
     type_bin = bin_encoder.transform(df['city_lat_cat'])
     df = pd.concat([df, type_bin], axis=1).drop(['city_lat', 'city_lat_cat'], axis=1)
@@ -2201,7 +3397,7 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            bin_encoder = stored_default_values['city_lng_cat_binenc']
+            bin_encoder = default_values['city_lng_cat_binenc']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2210,8 +3406,8 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
         bin_encoder = ce.BinaryEncoder(cols=['city_lng_cat'])
         bin_encoder = bin_encoder.fit(df['city_lng_cat'])
         
-        stored_default_values['city_lng_cat_binenc'] = bin_encoder
-        save_default_values(default_values_file_name)
+        default_values['city_lng_cat_binenc'] = bin_encoder
+        save_default_values(default_values_file_name, default_values)
 
     type_bin = bin_encoder.transform(df['city_lng_cat'])
     df = pd.concat([df, type_bin], axis=1).drop(['city_lng', 'city_lng_cat'], axis=1)   
@@ -2219,10 +3415,16 @@ def add_city_features(df, default_values_file_name, cities_dict, address_dict, a
     return df
 
 
-def add_population_features(df, default_values_file_name, uscities_df_path, can_drop_rows=False, force_rebuild_cached_data=False):
-    global stored_default_values
-    
-    read_default_values(default_values_file_name)
+def prepare_us_population_df(uscities_df_path):
+    """
+    Функция формирует таблицу медианных населения и плотности по городам из файла uscities.csv
+
+    Parameters:
+    uscities_df_path (str): Путь к файлу uscities.csv
+
+    Returns:
+    DataFrame: Таблица с полями state_id, city, population, density
+    """
 
     df_us_pop = pd.read_csv(uscities_df_path)
     
@@ -2230,7 +3432,20 @@ def add_population_features(df, default_values_file_name, uscities_df_path, can_
     df_us_pop = df_us_pop[['state_id', 'city', 'population', 'density']]
     df_us_pop.drop_duplicates(inplace=True)
     
-    df_us_pop = df_us_pop.groupby(['state_id', 'city']).agg({'population': 'median', 'density': 'median'}).reset_index()
+    return df_us_pop.groupby(['state_id', 'city']).agg({'population': 'median', 'density': 'median'}).reset_index()
+
+def get_us_population_df(uscities_df_path):
+    return load_artifact(uscities_df_path, prepare_us_population_df)
+
+
+def add_population_features(df, default_values_file_name, uscities_df_path, can_drop_rows=False, force_rebuild_cached_data=False, default_values=None):
+    
+    default_values = get_stage_default_values(default_values_file_name, default_values)
+
+    if isinstance(uscities_df_path, pd.DataFrame):
+        df_us_pop = uscities_df_path
+    else:
+        df_us_pop = get_us_population_df(uscities_df_path)
     
     df_pop = pd.merge(
         df,
@@ -2244,10 +3459,10 @@ def add_population_features(df, default_values_file_name, uscities_df_path, can_
     
     if force_rebuild_cached_data:
         state_medians = df[~df['population'].isna()].groupby('state').agg({'population': 'median', 'density': 'median'})
-        stored_default_values['pop_state_medians'] = state_medians
-        save_default_values(default_values_file_name)
+        default_values['pop_state_medians'] = state_medians
+        save_default_values(default_values_file_name, default_values)
     else:
-        state_medians = stored_default_values['pop_state_medians']
+        state_medians = default_values['pop_state_medians']
     
     mask = df['population'].isna()
     df.loc[mask, 'population'] = df[mask]['state'].apply(lambda x: np.NaN if x not in state_medians.index else state_medians.loc[x, 'population'])
@@ -2260,14 +3475,14 @@ def add_population_features(df, default_values_file_name, uscities_df_path, can_
         
         p_median = df[mask]['population'].median()
         d_median = df[mask]['density'].median()
-        stored_default_values['p_median'] = p_median
-        stored_default_values['d_median'] = d_median
-        save_default_values(default_values_file_name)
+        default_values['p_median'] = p_median
+        default_values['d_median'] = d_median
+        save_default_values(default_values_file_name, default_values)
         
         df = df[mask].copy()
     else:
-        p_median = stored_default_values['p_median']
-        d_median = stored_default_values['d_median']
+        p_median = default_values['p_median']
+        d_median = default_values['d_median']
 
         df['population'].fillna(p_median, inplace=True)
         df['density'].fillna(p_median, inplace=True)
@@ -2276,31 +3491,19 @@ def add_population_features(df, default_values_file_name, uscities_df_path, can_
         min_val = df['population'].min()
         max_val = df['population'].max()
         
-        stored_default_values['population_min'] = min_val
-        stored_default_values['population_max'] = max_val
-        save_default_values(default_values_file_name)
-    else:
-        min_val = stored_default_values['population_min']
-        max_val = stored_default_values['population_max']
+        set_ord_cat_range(default_values, 'population', min_val, max_val)
+        save_default_values(default_values_file_name, default_values)
 
-    n_cats = 15
-    df['population_cat'] = 0
-    df['population_cat'] = df['population'].apply(lambda x: convert_to_ord_cat(x, min_val, max_val, n_cats))
+    df['population_cat'] = convert_to_ord_cat_column(df['population'], get_ord_cat_edges_by_name(default_values, 'population'))
     
     if force_rebuild_cached_data:
         min_val = df['density'].min()
         max_val = df['density'].max()
         
-        stored_default_values['density_min'] = min_val
-        stored_default_values['density_max'] = max_val
-        save_default_values(default_values_file_name)
-    else:
-        min_val = stored_default_values['density_min']
-        max_val = stored_default_values['density_max']
+        set_ord_cat_range(default_values, 'density', min_val, max_val)
+        save_default_values(default_values_file_name, default_values)
 
-    n_cats = 15
-    df['density_cat'] = 0
-    df['density_cat'] = df['density'].apply(lambda x: convert_to_ord_cat(x, min_val, max_val, n_cats))
+    df['density_cat'] = convert_to_ord_cat_column(df['density'], get_ord_cat_edges_by_name(default_values, 'density'))
     
     df = df.drop(['population', 'density'], axis=1)
     
@@ -2309,7 +3512,7 @@ def add_population_features(df, default_values_file_name, uscities_df_path, can_
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            bin_encoder = stored_default_values['population_cat_binenc']
+            bin_encoder = default_values['population_cat_binenc']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2318,8 +3521,8 @@ def add_population_features(df, default_values_file_name, uscities_df_path, can_
         bin_encoder = ce.BinaryEncoder(cols=['population_cat'])
         bin_encoder = bin_encoder.fit(df['population_cat'])
         
-        stored_default_values['population_cat_binenc'] = bin_encoder
-        save_default_values(default_values_file_name)
+        default_values['population_cat_binenc'] = bin_encoder
+        save_default_values(default_values_file_name, default_values)
 
     type_bin = bin_encoder.transform(df['population_cat'])
     df = pd.concat([df, type_bin], axis=1).drop('population_cat', axis=1)
@@ -2329,7 +3532,7 @@ def add_population_features(df, default_values_file_name, uscities_df_path, can_
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            bin_encoder = stored_default_values['density_cat_binenc']
+            bin_encoder = default_values['density_cat_binenc']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2338,8 +3541,8 @@ def add_population_features(df, default_values_file_name, uscities_df_path, can_
         bin_encoder = ce.BinaryEncoder(cols=['density_cat'])
         bin_encoder = bin_encoder.fit(df['density_cat'])
         
-        stored_default_values['density_cat_binenc'] = bin_encoder
-        save_default_values(default_values_file_name)
+        default_values['density_cat_binenc'] = bin_encoder
+        save_default_values(default_values_file_name, default_values)
 
     type_bin = bin_encoder.transform(df['density_cat'])
     df = pd.concat([df, type_bin], axis=1).drop('density_cat', axis=1)
@@ -2404,17 +3607,16 @@ num_cols = [
 
 ##################################################################################################
 
-def final_tune_pca_and_scale(df, default_values_file_name, force_rebuild_cached_data=False):
-    global stored_default_values
+def final_tune_pca_and_scale(df, default_values_file_name, force_rebuild_cached_data=False, default_values=None):
     
-    read_default_values(default_values_file_name)
+    default_values = get_stage_default_values(default_values_file_name, default_values)
 
     need_rebuil_data = False
     try:
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            pca_city_descr = stored_default_values['pca_city_descr']
+            pca_city_descr = default_values['pca_city_descr']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2426,8 +3628,8 @@ def final_tune_pca_and_scale(df, default_values_file_name, force_rebuild_cached_
         )
         pca_city_descr = pca_city_descr.fit(df[city_descr_cats_features].values)
         
-        stored_default_values['pca_city_descr'] = pca_city_descr
-        save_default_values(default_values_file_name)
+        default_values['pca_city_descr'] = pca_city_descr
+        save_default_values(default_values_file_name, default_values)
     
     new_features = pca_city_descr.transform(df[city_descr_cats_features].values)
     new_features_names = ['cdcf_'+str(x+1) for x in range(new_features.shape[1])]
@@ -2439,7 +3641,7 @@ def final_tune_pca_and_scale(df, default_values_file_name, force_rebuild_cached_
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            pca_cpop = stored_default_values['pca_cpop']
+            pca_cpop = default_values['pca_cpop']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2452,8 +3654,8 @@ def final_tune_pca_and_scale(df, default_values_file_name, force_rebuild_cached_
 
         pca_cpop = pca_cpop.fit(df[city_population_cats_features].values)
 
-        stored_default_values['pca_cpop'] = pca_cpop
-        save_default_values(default_values_file_name)      
+        default_values['pca_cpop'] = pca_cpop
+        save_default_values(default_values_file_name, default_values)      
     
     new_features = pca_cpop.transform(df[city_population_cats_features].values)
     new_features_names = ['cp_'+str(x+1) for x in range(new_features.shape[1])]
@@ -2466,7 +3668,7 @@ def final_tune_pca_and_scale(df, default_values_file_name, force_rebuild_cached_
         if force_rebuild_cached_data:
             need_rebuil_data = True
         else:
-            scaler = stored_default_values['std_scaler']
+            scaler = default_values['std_scaler']
             need_rebuil_data = False
     except Exception as ex:
         need_rebuil_data = True
@@ -2475,8 +3677,8 @@ def final_tune_pca_and_scale(df, default_values_file_name, force_rebuild_cached_
         scaler = StandardScaler()
         scaler.fit(df[num_cols])
 
-        stored_default_values['std_scaler'] = scaler
-        save_default_values(default_values_file_name)      
+        default_values['std_scaler'] = scaler
+        save_default_values(default_values_file_name, default_values)      
 
     df[num_cols] = scaler.transform(df[num_cols])
     
@@ -2488,11 +3690,14 @@ def get_nan_replacer():
 def prepare_for_json(df):
     return df.fillna(get_nan_replacer()).values.tolist()
 
-def convert_to_data_frame(data):
-    cols_names = [
+def get_source_columns():
+    return [
         'status', 'private pool', 'propertyType', 'street', 'baths', 'homeFacts', 'fireplace', 'city', 'schools', 
         'sqft', 'zipcode', 'beds', 'state', 'stories', 'mls-id', 'PrivatePool', 'MlsId'
     ]
+
+def convert_to_data_frame(data):
+    cols_names = get_source_columns()
     
     result_df = pd.DataFrame(data, columns=cols_names).astype('str')
     
@@ -2503,16 +3708,851 @@ def convert_to_data_frame(data):
     
     return result_df
 
-def get_default_model_name():
-    return 'model_abr'
+def convert_records_to_data_frame(records):
+    """
+    Функция конвертирует список записей (строк NDJSON) в датасет, аналогично convert_to_data_frame
 
-def get_current_prediction_model(path, model_name=None):
-    if model_name is None:
-        model_name = get_default_model_name()
-        
-    with open(path + '/' + model_name + '.pkl', 'rb') as f:
+    Parameters:
+    records (list): Записи - списки значений в порядке get_source_columns() (как в prepare_for_json)
+                    или словари {имя колонки: значение}; пропуски - None или get_nan_replacer()
+
+    Returns:
+    DataFrame: Датасет с исходными колонками
+    """
+
+    cols_names = get_source_columns()
+    replacer = get_nan_replacer()
+
+    rows = []
+    for rec in records:
+        if isinstance(rec, dict):
+            rec = [rec.get(col) for col in cols_names]
+        rows.append([replacer if x is None else x for x in rec])
+
+    return convert_to_data_frame(np.array(rows))
+
+def get_records_cache_keys(df, version):
+    """
+    Функция возвращает ключи кэша предсказаний для записей датасета:
+    хэш канонического представления исходных полей (get_source_columns()) и версии модели/артефактов
+
+    Parameters:
+    df (DataFrame): Датасет с исходными колонками
+    version (str): Версия модели и артефактов (см. get_serving_artifacts)
+
+    Returns:
+    list(str): Ключи записей
+    """
+
+    keys = []
+    for values in df[get_source_columns()].itertuples(index=False, name=None):
+        canonical = json.dumps([None if pd.isna(x) else str(x) for x in values], ensure_ascii=False)
+        keys.append(hashlib.sha1((version + '|' + canonical).encode('utf-8')).hexdigest())
+
+    return keys
+
+##################################################################################################
+#
+# Бинарный колоночный формат обмена с сервисом (альтернатива JSON):
+# NPZ-архив (без pickle), в котором для каждой колонки хранится маска непустых значений (.valid),
+# а значения - либо числовым массивом (.values), либо единым UTF-8 буфером (.data)
+# со смещениями строк в байтах (.offsets). Пропуски передаются маской, а не строкой-заменителем
+#
+##################################################################################################
+
+def get_binary_content_type():
+    return 'application/x-npz'
+
+def encode_columnar(columns, as_str=False):
+    """
+    Функция упаковывает набор колонок в бинарный колоночный формат
+
+    Parameters:
+    columns (dictionary): Колонки (имя -> список/массив/Series значений)
+    as_str (bool): Флаг передачи всех колонок как строковых
+
+    Returns:
+    bytes: Упакованные данные
+    """
+
+    arrays = {'__columns__': np.array(list(columns.keys()))}
+
+    for name, values in columns.items():
+        values = pd.Series(values)
+        valid = ~values.isna().values
+
+        if not as_str and pd.api.types.is_numeric_dtype(values.dtype):
+            arrays[name + '.values'] = values.values.astype(np.float64)
+        else:
+            bytes_values = [str(x).encode('utf-8') if is_valid else b'' for x, is_valid in zip(values.values, valid)]
+            offsets = np.zeros(len(bytes_values) + 1, dtype=np.int64)
+            np.cumsum([len(x) for x in bytes_values], out=offsets[1:])
+
+            arrays[name + '.data'] = np.frombuffer(b''.join(bytes_values), dtype=np.uint8)
+            arrays[name + '.offsets'] = offsets
+
+        arrays[name + '.valid'] = valid
+
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+
+    return buffer.getvalue()
+
+def decode_columnar(payload):
+    """
+    Функция распаковывает данные бинарного колоночного формата
+
+    Parameters:
+    payload (bytes): Упакованные данные
+
+    Returns:
+    dictionary: Колонки (имя -> numpy массив; пропуски - NaN)
+    """
+
+    columns = {}
+
+    with np.load(io.BytesIO(payload), allow_pickle=False) as npz:
+        for name in npz['__columns__']:
+            name = str(name)
+            valid = npz[name + '.valid']
+
+            if name + '.values' in npz.files:
+                values = npz[name + '.values'].astype(np.float64)
+                values[~valid] = np.NaN
+            else:
+                data = npz[name + '.data'].tobytes()
+                offsets = npz[name + '.offsets'].tolist()
+
+                values = np.empty(len(valid), dtype=object)
+                values[:] = [data[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(valid))]
+                values[~valid] = np.NaN
+
+            columns[name] = values
+
+    return columns
+
+def prepare_for_binary(df):
+    return encode_columnar({col: df[col] for col in df.columns}, as_str=True)
+
+def convert_binary_to_data_frame(payload):
+    columns = decode_columnar(payload)
+
+    result_df = pd.DataFrame({col: pd.Series(columns[col], dtype=object) for col in get_source_columns()}, columns=get_source_columns())
+
+    # как в convert_to_data_frame, значения (в т.ч. переданные числовыми колонками) приводятся к строкам; пропуски - NaN
+    for col in result_df.columns:
+        valid = result_df[col].notna()
+        result_df.loc[valid, col] = result_df.loc[valid, col].astype('str')
+
+    return result_df
+
+def prepare_predictions_for_binary(y_pred):
+    return encode_columnar({'predictions': np.asarray(y_pred, dtype=np.float64)})
+
+def convert_binary_to_predictions(payload):
+    return decode_columnar(payload)['predictions']
+
+def get_default_model_name():
+    return 'model_abr'
+
+def get_current_prediction_model(path, model_name=None):
+    if model_name is None:
+        model_name = get_default_model_name()
+        
+    with open(path + '/' + model_name + '.pkl', 'rb') as f:
         model = pickle.load(f)
         
     return model
 
+##################################################################################################
+#
+# Словари геоинформации сервиса: файл компактного формата (см. geo_cache.py) отображается в память,
+# pickle-файл словаря адресов при предзагрузке преобразуется в тот же вид в памяти (geo_cache.GeoCache).
+# Такие объекты почти не содержат объектов Python, поэтому после загрузки в мастер-процессе uWSGI
+# их страницы памяти остаются общими для всех рабочих процессов
+#
+##################################################################################################
+
+def read_geo_dict_file(file_path, compact=False):
+    """
+    Функция загружает словарь геоинформации: файл компактного формата (см. geo_cache.py) отображается
+    в память, pickle-файл загружается целиком (в компактном виде, если compact)
+
+    Parameters:
+    file_path (str): Путь к файлу
+    compact (bool): Флаг преобразования pickle-файла в geo_cache.GeoCache
+
+    Returns:
+    Mapping: Словарь геоинформации
+    """
+
+    if file_path.endswith(geo_cache.geo_cache_extension):
+        return geo_cache.read_geo_cache(file_path)
+
+    geo_dict = read_pickle_file(file_path)
+
+    return geo_cache.create_geo_cache(geo_dict) if compact else geo_dict
+
+# выбранный файл словаря геоинформации: (data_path, name) -> (путь к файлу, время проверки)
+geo_dict_files = {}
+
+def get_geo_dict_file(data_path, name):
+    """
+    Функция возвращает файл словаря геоинформации: из файла компактного формата (см. geo_cache.py)
+    и исходного pickle-файла выбирается более новый, так что обновленный pickle-файл (например, после
+    geocode_builder.py export) подхватывается без пересборки компактного. Выбор проверяется
+    не чаще artifacts_check_interval
+
+    Parameters:
+    data_path (str): Каталог с данными
+    name (str): Имя словаря
+
+    Returns:
+    str: Путь к файлу
+    """
+
+    item = geo_dict_files.get((data_path, name))
+    now = time.monotonic()
+    if item is not None and now - item[1] < artifacts_check_interval:
+        return item[0]
+
+    geo_file_path = data_path + '/' + name + geo_cache.geo_cache_extension
+    pickle_file_path = data_path + '/' + name + '.pkl'
+
+    geo_signature = get_file_signature(geo_file_path)
+    pickle_signature = get_file_signature(pickle_file_path)
+
+    if geo_signature is not None and (pickle_signature is None or geo_signature[0] >= pickle_signature[0]):
+        file_path = geo_file_path
+    else:
+        file_path = pickle_file_path
+
+    geo_dict_files[(data_path, name)] = (file_path, now)
+
+    return file_path
+
+##################################################################################################
+#
+# Подготовка данных для предсказания сервисом: все артефакты берутся из реестра
+# (загружаются один раз на процесс и перечитываются только при изменении файлов)
+#
+##################################################################################################
+
+# артефакты, без которых сервис не может выполнить предсказание (словари адресов могут отсутствовать)
+serving_required_artifacts = ['default_values', 'us_population', 'model']
+
+def get_serving_artifacts_files(data_path, models_path, model_name=None):
+    if model_name is None:
+        model_name = get_default_model_name()
+
+    return {
+        'default_values': data_path + '/default_values.pkl',
+        'cities_dict': get_geo_dict_file(data_path, 'cities_dict'),
+        'address_dict': get_geo_dict_file(data_path, 'address_dict'),
+        'address_by_zip_dict': get_geo_dict_file(data_path, 'address_by_zip_dict'),
+        'cities_clusters_dict': get_geo_dict_file(data_path, 'cities_clusters_dict'),
+        'us_population': data_path + '/uscities.csv',
+        'model': models_path + '/' + model_name + '.pkl'
+    }
+
+def get_serving_artifacts(data_path, models_path, model_name=None, compact_geo=False, print_error=False):
+    """
+    Функция возвращает согласованный набор артефактов для предсказания (снимок реестра)
+
+    Parameters:
+    data_path (str): Каталог с данными (словари, default_values.pkl, uscities.csv)
+    models_path (str): Каталог с сериализованными моделями
+    model_name (str): Имя модели
+    compact_geo (bool): Флаг загрузки pickle-файлов словарей адресов в компактном виде (см. read_geo_dict_file)
+    print_error (bool): Флаг вывода ошибок в консоль
+
+    Returns:
+    dictionary: Артефакты, пути к их файлам (files) и версия набора (version)
+
+    Raises:
+    RuntimeError: Если обязательный артефакт (default_values, us_population, model) не удалось загрузить ни разу
+    """
+
+    files = get_serving_artifacts_files(data_path, models_path, model_name)
+
+    # реестр хранит одну версию файла, поэтому в процессе используется тот вид словарей адресов,
+    # в котором они были загружены впервые (оба вида поддерживают одинаковые операции чтения)
+    def geo_loader(file_path):
+        return read_geo_dict_file(file_path, compact=compact_geo)
+
+    load_artifact(files['default_values'], print_error=print_error)
+    load_artifact(files['cities_dict'], read_geo_dict_file, default_value={}, print_error=print_error)
+    load_artifact(files['address_dict'], geo_loader, default_value={}, print_error=print_error)
+    load_artifact(files['address_by_zip_dict'], geo_loader, default_value={}, print_error=print_error)
+    load_artifact(files['cities_clusters_dict'], read_geo_dict_file, default_value={}, print_error=print_error)
+    load_artifact(files['us_population'], prepare_us_population_df, print_error=print_error)
+    load_artifact(files['model'], print_error=print_error)
+
+    # записи реестра заменяются целиком, поэтому значения и версия, взятые из одних и тех же записей,
+    # согласованы без блокировки (блокировка берется в load_artifact только при проверке или перечитывании файла)
+    items = {name: loaded_artifacts[file_path] for name, file_path in files.items()}
+
+    # без обязательных артефактов предсказание невозможно: ошибка выдается сразу (при старте сервиса
+    # или при загрузке из реестра), а не при обращении к отсутствующему значению на одном из этапов
+    for name in serving_required_artifacts:
+        if items[name]['value'] is None:
+            raise RuntimeError('Serving artifact is not loaded: ' + name + ' (' + files[name] + ')')
+
+    artifacts = {name: item['value'] for name, item in items.items()}
+    artifacts['files'] = files
+    artifacts['version'] = get_artifacts_version(list(items.values()))
+
+    return artifacts
+
+def preload_serving_artifacts(data_path, models_path, model_name=None, print_error=False):
+    """
+    Функция загружает артефакты до создания рабочих процессов (в мастер-процессе uWSGI при lazy-apps = false):
+    словари адресов загружаются в компактном виде, производные таблицы строятся заранее, а все загруженные
+    объекты исключаются из сборки мусора (gc.freeze), чтобы обход сборщиком и изменение счетчиков ссылок
+    не копировали общие страницы памяти в каждый рабочий процесс.
+    Артефакты, перечитанные позже из-за изменения файлов, загружаются каждым процессом отдельно
+
+    Parameters:
+    data_path (str): Каталог с данными
+    models_path (str): Каталог с сериализованными моделями
+    model_name (str): Имя модели
+    print_error (bool): Флаг вывода ошибок в консоль
+
+    Returns:
+    dictionary: Артефакты (см. get_serving_artifacts)
+    """
+
+    artifacts = get_serving_artifacts(data_path, models_path, model_name, compact_geo=True, print_error=print_error)
+
+    get_derived_artifact(artifacts['us_population'], 'lookup', build_us_population_lookup)
+    load_text_features_tables(artifacts['default_values'])
+
+    gc.collect()
+    gc.freeze()
+
+    return artifacts
+
+##################################################################################################
+#
+# Сборка матрицы признаков по плану колонок (для предсказания): план - порядок колонок модели,
+# каждая группа признаков записывается сразу в предвыделенную матрицу float32 (тип, к которому
+# модель приводит признаки), исходные поля не добавляются в DataFrame и не копируются между этапами.
+# Это единственная реализация подготовки данных сервисом; этапы и результат те же, что и у цепочки
+# clear_data_base_line -> ... -> final_tune_pca_and_scale при обучении (can_drop_rows=False)
+#
+##################################################################################################
+
+feature_matrix_dtype = np.float32
+
+def build_column_plan(model):
+    """
+    Функция строит план колонок матрицы признаков по обученной модели
+
+    Parameters:
+    model (any): Модель с feature_names_in_
+
+    Returns:
+    dictionary: Колонки модели (columns), номер колонки по имени (index) и кэш номеров колонок групп признаков (positions)
+    """
+
+    columns = get_model_columns(model)
+
+    return {
+        'columns': columns,
+        'index': {col: indx for indx, col in enumerate(columns)},
+        'positions': {}
+    }
+
+class FeatureMatrix:
+    """
+    Предвыделенная матрица признаков: колонки записываются по имени, колонки, которых нет в плане,
+    пропускаются. Значения колонок из keep_columns дополнительно сохраняются для следующих этапов
+    (входы PCA и масштабируемые признаки)
+
+    Parameters:
+    plan (dictionary): План колонок (см. build_column_plan)
+    rows_count (int): Число записей
+    keep_columns (list(str)): Колонки, значения которых нужны следующим этапам
+    """
+
+    def __init__(self, plan, rows_count, keep_columns):
+        self.plan = plan
+        self.values = np.zeros((rows_count, len(plan['columns'])), dtype=feature_matrix_dtype)
+        self.is_set = np.zeros(len(plan['columns']), dtype=bool)
+        self.keep_columns = set(keep_columns)
+        self.kept = {}
+
+    def set_column(self, name, values):
+        if name in self.keep_columns:
+            self.kept[name] = np.asarray(values, dtype=np.float64)
+
+        indx = self.plan['index'].get(name)
+        if indx is not None:
+            self.values[:, indx] = values
+            self.is_set[indx] = True
+
+    def set_columns(self, names, values):
+        key = tuple(names)
+        positions = self.plan['positions'].get(key)
+        if positions is None:
+            # номера колонок values, попадающих в матрицу, и их номера в матрице (вычисляются один раз на набор имен)
+            found = [(indx, self.plan['index'][name]) for indx, name in enumerate(names) if name in self.plan['index']]
+            positions = (np.array([item[0] for item in found], dtype=np.int64), np.array([item[1] for item in found], dtype=np.int64))
+            self.plan['positions'][key] = positions
+
+        self.values[:, positions[1]] = values[:, positions[0]]
+        self.is_set[positions[1]] = True
+
+        for indx, name in enumerate(names):
+            if name in self.keep_columns:
+                self.kept[name] = np.asarray(values[:, indx], dtype=np.float64)
+
+    def get_data_frame(self):
+        if not self.is_set.all():
+            missing = [col for col, is_set in zip(self.plan['columns'], self.is_set) if not is_set]
+            raise ValueError('Model columns are not produced by the pipeline: ' + ', '.join(missing))
+
+        return pd.DataFrame(self.values, columns=self.plan['columns'], copy=False)
+
+def get_binary_encoded_columns(bin_encoder, values):
+    """
+    Функция возвращает результат BinaryEncoder для колонки: каждое различное значение кодируется
+    один раз (см. get_binary_encoded_features)
+
+    Parameters:
+    bin_encoder (BinaryEncoder): Обученный кодировщик
+    values (list или ndarray): Значения
+
+    Returns:
+    tuple: Имена колонок, матрица (записи x колонки) значений
+    """
+
+    if len(values) <= column_loop_max_size:
+        encoded = [get_binary_encoded_features(bin_encoder, value) for value in values]
+        names = list(get_binary_encoded_features(bin_encoder, np.NaN).keys())
+        return names, np.array([[item[name] for name in names] for item in encoded], dtype=np.float64).reshape(len(values), len(names))
+
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+
+    # последняя строка - кодирование пропуска (код -1)
+    encoded = [get_binary_encoded_features(bin_encoder, value) for value in uniques]
+    encoded.append(get_binary_encoded_features(bin_encoder, np.NaN))
+
+    names = list(encoded[-1].keys())
+    table = np.array([[item[name] for name in names] for item in encoded], dtype=np.float64)
+
+    return names, table[codes]
+
+def set_binary_encoded_columns(matrix, bin_encoder, values):
+    names, encoded = get_binary_encoded_columns(bin_encoder, values)
+    matrix.set_columns(names, encoded)
+
+def get_location_arrays(columns):
+    """
+    Штат, город (пропуски восстанавливаются по почтовому индексу, в нижнем регистре), адрес и почтовый индекс
+    записей, как в clear_data_base_line
+
+    Parameters:
+    columns (DataFrame или dictionary): Исходные колонки (см. get_source_columns())
+
+    Returns:
+    tuple: state, city, street, zipcode (ndarray)
+    """
+
+    state = np.array(columns['state'], dtype=object)
+    street = np.asarray(columns['street'], dtype=object)
+    zipcode = np.asarray(columns['zipcode'], dtype=object)
+
+    city = np.array(columns['city'], dtype=object)
+    city_mask = pd.isna(city)
+    city[city_mask] = [found_city_by_zip_state(zipcode[indx], state[indx]) for indx in np.flatnonzero(city_mask)]
+    city[pd.isna(city)] = '--'
+    city = np.array([str.lower(x) for x in city], dtype=object)
+
+    return state, city, street, zipcode
+
+def set_base_line_matrix_features(columns, matrix, default_values):
+    """
+    Признаки clear_data_base_line (can_drop_rows=False)
+
+    Parameters:
+    columns (DataFrame или dictionary): Исходные колонки (см. get_source_columns())
+    matrix (FeatureMatrix): Матрица признаков
+    default_values (dictionary): Обученные значения
+
+    Returns:
+    tuple: state, city, street, zipcode (ndarray) для следующих этапов
+    """
+
+    home_facts = get_home_facts_arrays(columns['homeFacts'], facts)
+
+    for col, values in get_schools_features_arrays(columns['schools']).items():
+        matrix.set_column(col, values)
+
+    state, city, street, zipcode = get_location_arrays(columns)
+
+    sqft_fl = convert_sqft_column_to_float(columns['sqft'])
+    sqft_fl[np.isnan(sqft_fl) | (sqft_fl >= 15000)] = default_values['sqft_median']
+    matrix.set_column('sqft_fl', sqft_fl)
+
+    matrix.set_column('has_mls_id', pd.notna(np.asarray(columns['MlsId'], dtype=object)))
+
+    property_type = np.array(columns['propertyType'], dtype=object)
+    property_type[pd.isna(property_type)] = get_fitted_property_type(default_values)
+    property_type = get_text_column_features('propertyType', property_type)
+    property_type_names = text_columns_features['propertyType'][1]
+
+    # число этажей из поля stories заменяет признаки этажности, найденные в propertyType
+    story_features = get_stories_features_list()
+    stories_int = get_text_column_features('stories', columns['stories'])[:, 0]
+
+    stories_values = get_count_features_matrix(stories_int, len(story_features))
+    for indx, name in enumerate(property_type_names):
+        if name in story_features:
+            story_indx = story_features.index(name)
+            matrix.set_column(name, np.where(np.isnan(stories_int), property_type[:, indx], stories_values[:, story_indx]))
+        else:
+            matrix.set_column(name, property_type[:, indx])
+
+    beds_features = get_beds_features_list()
+    matrix.set_columns(beds_features, get_count_features_matrix(get_text_column_features('beds', columns['beds'])[:, 0], len(beds_features)))
+
+    baths_features = get_bathrooms_features_list()
+    matrix.set_columns(baths_features, get_count_features_matrix(get_text_column_features('baths', columns['baths'])[:, 0], len(baths_features)))
+
+    matrix.set_column('was_remodeled', pd.notna(home_facts['fact_remodeled_year']))
+
+    freq_year = default_values['years_mode']
+    years = np.array([int(freq_year if pd.isnull(x) or x == 'No Data' else x) for x in home_facts['fact_year_built']], dtype=np.int64)
+    matrix.set_column('object_age', np.maximum(base_year - years, 0))
+
+    # одноименные признаки разных групп перезаписываются в том же порядке, что и в clear_data_base_line
+    for column in ['fact_cooling', 'fact_heating', 'fact_parking']:
+        matrix.set_columns(text_columns_features[column][1], get_text_column_features(column, home_facts[column]))
+
+    return state, city, street, zipcode
+
+def get_replace_map(replaces, convert):
+    # результат последовательных замен (как в fix_incorrect_states_and_cities) для каждого заменяемого значения
+    result = {}
+    for old_value, _ in replaces:
+        value = old_value
+        for repl in replaces:
+            if value == repl[0]:
+                value = convert(repl[1])
+        result[old_value] = value
+
+    return result
+
+states_replace_map = get_replace_map(states_replace, lambda x: x)
+cities_replace_map = get_replace_map(cities_replaces, lambda x: np.NaN if pd.isna(x) else str.lower(x))
+
+def replace_states_and_cities_arrays(state, city):
+    # исправление ошибочных названий штатов и городов (states_replace, cities_replaces) на месте
+    state[:] = [states_replace_map.get(x, x) if isinstance(x, str) else x for x in state]
+    city[:] = [cities_replace_map.get(x, x) if isinstance(x, str) else x for x in city]
+
+    return state, city
+
+def fix_states_and_cities_arrays(state, city, cities_dict, default_values):
+    """
+    Исправления fix_incorrect_states_and_cities (can_drop_rows=False) над массивами state и city
+    """
+
+    state, city = replace_states_and_cities_arrays(state, city)
+
+    city = np.array([city_if_exists(s, c, cities_dict) for s, c in zip(state, city)], dtype=object)
+
+    popular_cities = default_values['popular_cities']
+    popular_state_name = default_values['popular_state_name']
+
+    for indx in np.flatnonzero(pd.isna(city)):
+        if state[indx] not in popular_cities:
+            state[indx] = popular_state_name
+            city[indx] = popular_cities[popular_state_name]
+        else:
+            city[indx] = popular_cities[state[indx]]
+
+    return state, city
+
+def set_city_matrix_features(matrix, state, city, street, zipcode, artifacts):
+    """
+    Признаки add_city_features (force_rebuild_cached_data=False)
+    """
+
+    default_values = artifacts['default_values']
+    cities_dict = artifacts['cities_dict']
+    address_dict = artifacts['address_dict']
+    address_by_zip_dict = artifacts['address_by_zip_dict']
+    cities_clusters_dict = artifacts['cities_clusters_dict']
+
+    city_type = [get_city_feature(s, c, 'type', cities_dict) for s, c in zip(state, city)]
+    city_importance = [get_city_feature(s, c, 'importance', cities_dict) for s, c in zip(state, city)]
+    city_boundingbox = [get_city_feature(s, c, 'boundingbox', cities_dict) for s, c in zip(state, city)]
+    city_lat = [get_city_feature(s, c, 'lat', cities_dict) for s, c in zip(state, city)]
+    city_lng = [get_city_feature(s, c, 'lng', cities_dict) for s, c in zip(state, city)]
+
+    popular_cities_types = get_fitted_popular_cities_types(default_values)
+    city_type = [x if x in popular_cities_types else 'other_type' for x in city_type]
+
+    distances = get_distances_features(state, city, street, zipcode, city_lat, city_lng, city_boundingbox, address_dict, cities_clusters_dict, address_by_zip_dict)
+    for col, values in distances.items():
+        matrix.set_column(col, values)
+
+    set_binary_encoded_columns(matrix, default_values['city_type_binenc'], city_type)
+
+    city_sqr = [get_city_sqr_by_boundingbox(x) for x in city_boundingbox]
+
+    for name, values in [('city_importance', city_importance), ('city_sqr', city_sqr), ('city_lat', city_lat), ('city_lng', city_lng)]:
+        categories = convert_to_ord_cat_column(values, get_ord_cat_edges_by_name(default_values, name))
+        set_binary_encoded_columns(matrix, default_values[name + '_cat_binenc'], categories)
+
+def set_population_matrix_features(matrix, state, city, artifacts):
+    """
+    Признаки add_population_features (can_drop_rows=False, force_rebuild_cached_data=False)
+    """
+
+    default_values = artifacts['default_values']
+    us_population_lookup = get_derived_artifact(artifacts['us_population'], 'lookup', build_us_population_lookup)
+
+    population_density = [us_population_lookup.get((s, c), (np.NaN, np.NaN)) for s, c in zip(state, city)]
+    population = np.array([item[0] for item in population_density], dtype=np.float64)
+    density = np.array([item[1] for item in population_density], dtype=np.float64)
+
+    state_medians = default_values['pop_state_medians']
+    for indx in np.flatnonzero(np.isnan(population)):
+        population[indx] = np.NaN if state[indx] not in state_medians.index else state_medians.loc[state[indx], 'population']
+    for indx in np.flatnonzero(np.isnan(density)):
+        density[indx] = np.NaN if state[indx] not in state_medians.index else state_medians.loc[state[indx], 'density']
+
+    # как и в add_population_features, пропуски обоих признаков заполняются медианой населения
+    population[np.isnan(population)] = default_values['p_median']
+    density[np.isnan(density)] = default_values['p_median']
+
+    for name, values in [('population', population), ('density', density)]:
+        categories = convert_to_ord_cat_column(values, get_ord_cat_edges_by_name(default_values, name))
+        set_binary_encoded_columns(matrix, default_values[name + '_cat_binenc'], categories)
+
+def set_final_matrix_features(matrix, default_values):
+    """
+    Признаки final_tune_pca_and_scale (force_rebuild_cached_data=False)
+    """
+
+    city_descr = np.column_stack([matrix.kept[col] for col in city_descr_cats_features])
+    city_descr = default_values['pca_city_descr'].transform(city_descr)
+    matrix.set_columns(['cdcf_'+str(x+1) for x in range(city_descr.shape[1])], city_descr)
+
+    city_population = np.column_stack([matrix.kept[col] for col in city_population_cats_features])
+    city_population = default_values['pca_cpop'].transform(city_population)
+    matrix.set_columns(['cp_'+str(x+1) for x in range(city_population.shape[1])], city_population)
+
+    # то же, что и StandardScaler.transform, без проверок sklearn (заметных для нескольких записей)
+    scaler = default_values['std_scaler']
+    num_values = np.column_stack([matrix.kept[col] for col in num_cols])
+    matrix.set_columns(num_cols, (num_values - scaler.mean_) / scaler.scale_)
+
+def fill_feature_matrix(columns, rows_count, artifacts, measure_stages=True):
+    """
+    Функция выполняет этапы подготовки данных для предсказания, записывая признаки в матрицу по плану колонок модели
+    (общая часть transform_matrix_for_prediction и transform_records_for_prediction)
+
+    Parameters:
+    columns (DataFrame или dictionary): Исходные колонки (см. get_source_columns())
+    rows_count (int): Число записей
+    artifacts (dictionary): Снимок артефактов (см. get_serving_artifacts)
+    measure_stages (bool): Флаг замера длительности каждого этапа (service_metrics.measure_stage)
+
+    Returns:
+    FeatureMatrix: Матрица признаков
+    """
+
+    default_values = artifacts['default_values']
+    plan = get_derived_artifact(artifacts['model'], 'column_plan', build_column_plan)
+
+    matrix = FeatureMatrix(plan, rows_count, city_descr_cats_features + city_population_cats_features + num_cols)
+
+    if text_features_tables is None:
+        load_text_features_tables(default_values)
+
+    def measure_stage(stage):
+        return service_metrics.measure_stage(stage, rows_count) if measure_stages else contextlib.nullcontext()
+
+    with measure_stage('clear_data_base_line'):
+        state, city, street, zipcode = set_base_line_matrix_features(columns, matrix, default_values)
+
+    with measure_stage('fix_incorrect_states_and_cities'):
+        state, city = fix_states_and_cities_arrays(state, city, artifacts['cities_dict'], default_values)
+
+    with measure_stage('add_city_features'):
+        set_city_matrix_features(matrix, state, city, street, zipcode, artifacts)
+
+    with measure_stage('add_population_features'):
+        set_population_matrix_features(matrix, state, city, artifacts)
+
+    with measure_stage('encode_state_and_city'):
+        top_cities = default_values['top_cities_list']
+        set_binary_encoded_columns(matrix, default_values['state_binenc'], state)
+        set_binary_encoded_columns(matrix, default_values['city_binenc'], [x if x in top_cities else 'other_city' for x in city])
+
+    with measure_stage('final_tune_pca_and_scale'):
+        set_final_matrix_features(matrix, default_values)
+
+    return matrix
+
+def transform_matrix_for_prediction(df, artifacts):
+    """
+    Функция формирует признаки для предсказания сразу в матрице float32 по плану колонок модели
+
+    Parameters:
+    df (DataFrame): Исходные данные (см. convert_to_data_frame)
+    artifacts (dictionary): Снимок артефактов (см. get_serving_artifacts)
+
+    Returns:
+    DataFrame: Признаки (float32) в порядке колонок модели
+    """
+
+    return fill_feature_matrix(df, len(df), artifacts).get_data_frame()
+
+##################################################################################################
+#
+# Параллельная подготовка больших пакетов: пакет делится на части, которые обрабатываются в пуле процессов
+# (артефакты в процессах пула берутся из реестра - при создании пула через fork они уже загружены).
+# Признаки записи зависят только от нее самой и обученных артефактов, поэтому результат совпадает
+# с последовательной обработкой (transform_matrix_for_prediction)
+#
+##################################################################################################
+
+def split_data_frame(df, shards_count):
+    bounds = np.linspace(0, len(df), shards_count + 1).astype(int)
+    return [df.iloc[bounds[indx]:bounds[indx+1]] for indx in range(shards_count) if bounds[indx+1] > bounds[indx]]
+
+def get_shard_artifacts(artifacts_params, version):
+    artifacts = get_serving_artifacts(**artifacts_params)
+    if artifacts['version'] != version:
+        raise RuntimeError('Artifacts version mismatch: ' + artifacts['version'] + ' != ' + version)
+
+    return artifacts
+
+def transform_shard(df, artifacts_params, version):
+    return transform_matrix_for_prediction(df, get_shard_artifacts(artifacts_params, version))
+
+def transform_for_prediction_parallel(df, artifacts, executor, shards_count, artifacts_params, timeout=None):
+    """
+    Функция выполняет цепочку подготовки данных для предсказания, обрабатывая части пакета в пуле процессов.
+    Результат совпадает с transform_matrix_for_prediction для всего пакета
+
+    Parameters:
+    df (DataFrame): Исходные данные (см. convert_to_data_frame)
+    artifacts (dictionary): Снимок артефактов (см. get_serving_artifacts)
+    executor (ProcessPoolExecutor): Пул процессов
+    shards_count (int): Число частей
+    artifacts_params (dictionary): Параметры get_serving_artifacts для процессов пула
+    timeout (float): Максимальное время ожидания всех частей в секундах (None - без ограничения)
+
+    Returns:
+    DataFrame: Признаки в порядке, ожидаемом моделью
+
+    Raises:
+    concurrent.futures.TimeoutError: Если части не готовы за timeout секунд (незавершенные задачи отменяются)
+    """
+
+    shards = split_data_frame(df, shards_count)
+    futures = [executor.submit(transform_shard, shard, artifacts_params, artifacts['version']) for shard in shards]
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        results = [future.result(None if deadline is None else max(deadline - time.monotonic(), 0)) for future in futures]
+    except concurrent.futures.TimeoutError:
+        for future in futures:
+            future.cancel()
+        raise
+
+    return pd.concat(results, ignore_index=True)
+
+##################################################################################################
+#
+# Обработка небольшого числа записей (словарей исходных полей) без создания DataFrame: колонки записей
+# проходят те же этапы (fill_feature_matrix), что и пакет в transform_matrix_for_prediction; для коротких
+# колонок разбор идет по значениям (см. column_loop_max_size)
+#
+##################################################################################################
+
+derived_artifacts = {}
+
+def get_derived_artifact(source, name, builder):
+    """
+    Функция возвращает производный объект (таблицу поиска, кэш), построенный по артефакту.
+    Объект строится один раз на каждую версию артефакта
+
+    Parameters:
+    source (any): Исходный артефакт
+    name (str): Имя производного объекта
+    builder (function): Функция построения производного объекта по артефакту
+
+    Returns:
+    any: Производный объект
+    """
+
+    key = (id(source), name)
+    item = derived_artifacts.get(key)
+
+    if item is None or item[0] is not source:
+        if len(derived_artifacts) > 256:
+            derived_artifacts.clear()
+
+        item = (source, builder(source))
+        derived_artifacts[key] = item
+
+    return item[1]
+
+def get_binary_encoded_features(bin_encoder, value):
+    """
+    Функция возвращает результат BinaryEncoder для одного значения (результат кэшируется по значению)
+
+    Parameters:
+    bin_encoder (BinaryEncoder): Обученный кодировщик
+    value (any): Значение
+
+    Returns:
+    dictionary: Имя признака -> значение
+    """
+
+    encoded_values = get_derived_artifact(bin_encoder, 'encoded_values', lambda x: {})
+
+    key = get_nan_replacer() if pd.isna(value) else value
+    if key not in encoded_values:
+        encoded = bin_encoder.transform(pd.Series([value], name=bin_encoder.cols[0]))
+        encoded_values[key] = dict(zip(encoded.columns, encoded.values[0].tolist()))
+
+    return encoded_values[key]
+
+def build_us_population_lookup(df_us_pop):
+    return {
+        (state, city): (population, density)
+        for state, city, population, density in zip(df_us_pop['state_id'], df_us_pop['city'], df_us_pop['population'], df_us_pop['density'])
+    }
+
+def get_model_columns(model):
+    return list(model.feature_names_in_)
+
+def transform_records_for_prediction(records, artifacts):
+    """
+    Функция формирует признаки для набора записей без создания DataFrame исходных данных
+    (предназначена для небольших пакетов): те же этапы, что и в transform_matrix_for_prediction,
+    без замера длительности каждого этапа
+
+    Parameters:
+    records (list(dictionary)): Записи с исходными полями (см. get_source_columns()); пропуски - None или NaN
+    artifacts (dictionary): Снимок артефактов (см. get_serving_artifacts)
+
+    Returns:
+    DataFrame: Признаки (float32) в порядке колонок модели
+    """
+
+    columns = {}
+    for col in get_source_columns():
+        values = [record.get(col) for record in records]
+        columns[col] = np.empty(len(values), dtype=object)
+        columns[col][:] = [np.NaN if value is None else value for value in values]
 
+    return fill_feature_matrix(columns, len(records), artifacts, measure_stages=False).get_data_frame()
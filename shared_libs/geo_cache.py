@@ -0,0 +1,408 @@
+import os
+import sys
+import json
+import pickle
+import hashlib
+from collections.abc import Mapping
+
+import numpy as np
+
+##################################################################################################
+#
+# Компактный файловый формат кэша геоинформации (словари адресов, почтовых индексов, городов и ценовых
+# кластеров) вместо pickle вложенных словарей. Файл - заголовок JSON и выровненные массивы NumPy:
+# ключи отсортированы по стабильному хэшу (поиск - searchsorted), строки ключей хранятся одной таблицей
+# байтов UTF-8 со смещениями, значения - колонками (координаты, числа, коды перечислений).
+# Файл отображается в память (memmap), поэтому не копируется в каждый процесс, а страницы
+# читаются с диска по мере обращения и общие для всех процессов узла
+#
+##################################################################################################
+
+geo_cache_magic = b'FYPGEO01'
+geo_cache_extension = '.geo'
+
+# выравнивание начала массивов в файле (в байтах)
+geo_cache_alignment = 64
+
+# тип вещественных значений по умолчанию (координаты, importance). float32 вдвое компактнее, но округление
+# координат меняет расстояния и признаки городов, а с ними - часть предсказаний обученной модели
+# (на валидационном наборе - 32 из 1785), поэтому он подходит только для модели, обученной на таких данных
+geo_cache_float_dtype = np.float64
+
+# поля значений для каждого вида словаря: путь к полю во вложенном словаре и тип колонки
+# (float - число, enum - строка из небольшого набора значений, bbox - 4 числа)
+geo_cache_schemas = {
+    'location': [
+        ('location.lat', 'float'),
+        ('location.lng', 'float'),
+        ('location_type', 'enum')
+    ],
+    'city': [
+        ('type', 'enum'),
+        ('importance', 'float'),
+        ('boundingbox', 'bbox'),
+        ('lat', 'float'),
+        ('lng', 'float')
+    ],
+    'clusters': [
+        ('hight.lat', 'float'),
+        ('hight.lng', 'float'),
+        ('low.lat', 'float'),
+        ('low.lng', 'float')
+    ]
+}
+
+def get_key_hash(key_bytes):
+    # стабильный (не зависящий от PYTHONHASHSEED) 63-битный хэш ключа
+    return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), 'little') >> 1
+
+def get_geo_dict_kind(geo_dict):
+    """
+    Функция определяет вид словаря геоинформации по его первому значению
+
+    Parameters:
+    geo_dict (dictionary): Словарь геоинформации
+
+    Returns:
+    str: Вид словаря (ключ geo_cache_schemas)
+    """
+
+    for value in geo_dict.values():
+        if 'location' in value:
+            return 'location'
+        if 'boundingbox' in value:
+            return 'city'
+        if 'hight' in value:
+            return 'clusters'
+
+        break
+
+    raise ValueError('Unsupported geo dictionary')
+
+def get_field_value(value, field):
+    for name in field.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return None
+        value = value[name]
+
+    return value
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.NaN
+
+def get_geo_cache_arrays(geo_dict, kind, float_dtype):
+    keys = [key.encode('utf-8') for key in geo_dict.keys()]
+    hashes = np.array([get_key_hash(key) for key in keys], dtype=np.int64)
+    order = np.argsort(hashes, kind='stable')
+
+    values = list(geo_dict.values())
+    values = [values[indx] for indx in order]
+
+    keys_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    keys_offsets[1:] = np.cumsum([len(keys[indx]) for indx in order])
+
+    arrays = {
+        'hashes': hashes[order],
+        'keys_offsets': keys_offsets,
+        'keys_data': np.frombuffer(b''.join(keys[indx] for indx in order), dtype=np.uint8)
+    }
+    enums = {}
+
+    for field, field_type in geo_cache_schemas[kind]:
+        field_values = [get_field_value(value, field) for value in values]
+
+        if field_type == 'float':
+            arrays[field] = np.array([to_float(x) for x in field_values], dtype=float_dtype)
+        elif field_type == 'bbox':
+            arrays[field] = np.array([[to_float(x) for x in item] if isinstance(item, (list, tuple)) and len(item) == 4 else [np.NaN] * 4 for item in field_values], dtype=float_dtype).reshape(-1, 4)
+        else:
+            names = sorted(set(x for x in field_values if x is not None))
+            if len(names) > 127:
+                raise ValueError('Too many values of enum field ' + field)
+
+            codes = {name: indx for indx, name in enumerate(names)}
+            arrays[field] = np.array([-1 if x is None else codes[x] for x in field_values], dtype=np.int8)
+            enums[field] = names
+
+    return arrays, enums
+
+def write_geo_cache(file_path, geo_dict, kind=None, float_dtype=geo_cache_float_dtype):
+    """
+    Функция записывает словарь геоинформации в файл компактного формата (атомарно, через временный файл)
+
+    Parameters:
+    file_path (str): Путь к файлу
+    geo_dict (dictionary): Словарь геоинформации
+    kind (str): Вид словаря (см. geo_cache_schemas), None - определить по значениям
+    float_dtype (dtype): Тип вещественных значений
+    """
+
+    if kind is None:
+        kind = get_geo_dict_kind(geo_dict) if len(geo_dict) > 0 else 'location'
+
+    arrays, enums = get_geo_cache_arrays(geo_dict, kind, float_dtype)
+
+    def align(offset):
+        return (offset + geo_cache_alignment - 1) // geo_cache_alignment * geo_cache_alignment
+
+    # смещения массивов считаются от начала области данных (после заголовка)
+    arrays_header = {}
+    offset = 0
+    for name, array in arrays.items():
+        arrays_header[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = align(offset + array.nbytes)
+
+    header = json.dumps({
+        'kind': kind,
+        'count': len(arrays['hashes']),
+        'enums': enums,
+        'arrays': arrays_header
+    }).encode('utf-8')
+
+    data_offset = align(len(geo_cache_magic) + 8 + len(header))
+
+    tmp_file_path = file_path + '.tmp' + str(os.getpid())
+    with open(tmp_file_path, 'wb') as f:
+        f.write(geo_cache_magic)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+
+        for name, array in arrays.items():
+            f.seek(data_offset + arrays_header[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+
+        f.truncate(data_offset + offset)
+    os.replace(tmp_file_path, file_path)
+
+def read_geo_cache(file_path):
+    """
+    Функция отображает в память файл компактного формата (см. write_geo_cache)
+
+    Parameters:
+    file_path (str): Путь к файлу
+
+    Returns:
+    GeoCache: Словарь геоинформации
+    """
+
+    data = np.memmap(file_path, dtype=np.uint8, mode='r')
+
+    if data[:len(geo_cache_magic)].tobytes() != geo_cache_magic:
+        raise ValueError('Not a geo cache file: ' + file_path)
+
+    header_size = int.from_bytes(data[len(geo_cache_magic):len(geo_cache_magic)+8].tobytes(), 'little')
+    header_offset = len(geo_cache_magic) + 8
+    header = json.loads(data[header_offset:header_offset+header_size].tobytes().decode('utf-8'))
+
+    data_offset = (header_offset + header_size + geo_cache_alignment - 1) // geo_cache_alignment * geo_cache_alignment
+
+    arrays = {}
+    for name, item in header['arrays'].items():
+        dtype = np.dtype(item['dtype'])
+        count = int(np.prod(item['shape']))
+        start = data_offset + item['offset']
+        arrays[name] = data[start:start + count * dtype.itemsize].view(dtype).reshape(item['shape'])
+
+    return GeoCache(arrays, header['kind'], header['enums'], file_path)
+
+def create_geo_cache(geo_dict, kind=None, float_dtype=geo_cache_float_dtype):
+    """
+    Функция строит словарь компактного формата в памяти (без файла), например из загруженного pickle-файла
+
+    Parameters:
+    geo_dict (dictionary): Словарь геоинформации
+    kind (str): Вид словаря (см. geo_cache_schemas), None - определить по значениям
+    float_dtype (dtype): Тип вещественных значений
+
+    Returns:
+    GeoCache: Словарь геоинформации
+    """
+
+    if kind is None:
+        kind = get_geo_dict_kind(geo_dict) if len(geo_dict) > 0 else 'location'
+
+    arrays, enums = get_geo_cache_arrays(geo_dict, kind, float_dtype)
+
+    return GeoCache(arrays, kind, enums)
+
+def convert_pickle_to_geo_cache(pickle_path, file_path=None, kind=None, float_dtype=geo_cache_float_dtype):
+    """
+    Функция преобразует pickle-файл словаря геоинформации в файл компактного формата
+
+    Parameters:
+    pickle_path (str): Путь к pickle-файлу
+    file_path (str): Путь к файлу компактного формата (по умолчанию - тот же путь с расширением geo_cache_extension)
+    kind (str): Вид словаря (см. geo_cache_schemas), None - определить по значениям
+    float_dtype (dtype): Тип вещественных значений
+
+    Returns:
+    str: Путь к файлу компактного формата
+    """
+
+    if file_path is None:
+        file_path = os.path.splitext(pickle_path)[0] + geo_cache_extension
+
+    with open(pickle_path, 'rb') as f:
+        geo_dict = pickle.load(f)
+
+    write_geo_cache(file_path, geo_dict, kind, float_dtype)
+
+    return file_path
+
+
+class GeoCache(Mapping):
+    """
+    Словарь геоинформации только для чтения поверх массивов компактного формата (см. write_geo_cache):
+    отображенных в память из файла (read_geo_cache) или построенных в памяти (create_geo_cache).
+    Поддерживает in, [], get, len и перебор ключей, как исходный словарь (значения собираются в тот же вид
+    вложенного словаря), а также поиск сразу набора ключей (find_many) и чтение полей колонками (get_values)
+
+    Parameters:
+    arrays (dictionary): Массивы (hashes, keys_offsets, keys_data и поля значений)
+    kind (str): Вид словаря (см. geo_cache_schemas)
+    enums (dictionary): Значения полей-перечислений
+    file_path (str): Путь к файлу (None - словарь построен в памяти)
+    """
+
+    def __init__(self, arrays, kind, enums, file_path=None):
+        self.file_path = file_path
+        self.kind = kind
+        self.fields = geo_cache_schemas[kind]
+        self.enums = enums
+        self.arrays = arrays
+
+        self.hashes = self.arrays['hashes']
+        self.keys_offsets = self.arrays['keys_offsets']
+        self.keys_data = self.arrays['keys_data']
+
+    def get_key(self, indx):
+        return self.keys_data[self.keys_offsets[indx]:self.keys_offsets[indx+1]].tobytes()
+
+    def find(self, key):
+        """
+        Функция возвращает позицию ключа в таблице или -1, если ключа нет
+        """
+
+        if not isinstance(key, str):
+            return -1
+
+        key_bytes = key.encode('utf-8')
+        key_hash = get_key_hash(key_bytes)
+
+        indx = int(np.searchsorted(self.hashes, key_hash))
+        while indx < len(self.hashes) and self.hashes[indx] == key_hash:
+            if self.get_key(indx) == key_bytes:
+                return indx
+            indx += 1
+
+        return -1
+
+    def find_many(self, keys):
+        """
+        Функция возвращает позиции набора ключей (-1 - ключа нет)
+
+        Parameters:
+        keys (list(str)): Ключи
+
+        Returns:
+        ndarray: Позиции ключей
+        """
+
+        keys_bytes = [key.encode('utf-8') if isinstance(key, str) else None for key in keys]
+        key_hashes = np.array([-1 if key is None else get_key_hash(key) for key in keys_bytes], dtype=np.int64)
+
+        positions = np.searchsorted(self.hashes, key_hashes)
+        positions = np.where(positions < len(self.hashes), positions, -1)
+        positions[key_hashes < 0] = -1
+
+        candidates = np.flatnonzero(positions >= 0)
+        positions[candidates[self.hashes[positions[candidates]] != key_hashes[candidates]]] = -1
+
+        # совпадение хэша проверяется сравнением строк ключей (с учетом коллизий)
+        for indx in np.flatnonzero(positions >= 0):
+            if self.get_key(positions[indx]) != keys_bytes[indx]:
+                positions[indx] = self.find(keys[indx])
+
+        return positions
+
+    def get_values(self, field, positions):
+        """
+        Функция возвращает значения поля для позиций ключей (см. find_many)
+
+        Parameters:
+        field (str): Поле (см. geo_cache_schemas)
+        positions (ndarray): Позиции ключей
+
+        Returns:
+        ndarray: Значения (float64, NaN для отсутствующих ключей), для перечислений - строки (None)
+        """
+
+        positions = np.asarray(positions, dtype=np.int64)
+        found = positions >= 0
+        values = self.arrays[field][np.where(found, positions, 0)]
+
+        if field in self.enums:
+            names = np.array(self.enums[field] + [None], dtype=object)
+            codes = np.where(found & (values >= 0), values, len(names) - 1)
+            return names[codes]
+
+        values = values.astype(np.float64)
+        values[~found] = np.NaN
+
+        return values
+
+    def get_value(self, indx):
+        result = {}
+
+        for field, field_type in self.fields:
+            value = self.arrays[field][indx]
+
+            if field_type == 'enum':
+                value = None if value < 0 else self.enums[field][value]
+            elif field_type == 'bbox':
+                value = [float(x) for x in value]
+            else:
+                value = float(value)
+
+            *path, name = field.split('.')
+            item = result
+            for part in path:
+                item = item.setdefault(part, {})
+            item[name] = value
+
+        return result
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __getitem__(self, key):
+        indx = self.find(key)
+        if indx < 0:
+            raise KeyError(key)
+
+        return self.get_value(indx)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __iter__(self):
+        for indx in range(len(self.hashes)):
+            yield self.get_key(indx).decode('utf-8')
+
+
+if __name__ == '__main__':
+    # преобразование словарей геоинформации каталога данных в компактный формат:
+    # $ python geo_cache.py data [float32|float64]
+    data_path = sys.argv[1] if len(sys.argv) > 1 else 'data'
+    float_dtype = np.dtype(sys.argv[2]) if len(sys.argv) > 2 else geo_cache_float_dtype
+
+    for name in ['address_dict', 'address_by_zip_dict', 'cities_dict', 'cities_clusters_dict']:
+        pickle_path = os.path.join(data_path, name + '.pkl')
+        if not os.path.exists(pickle_path):
+            continue
+
+        file_path = convert_pickle_to_geo_cache(pickle_path, float_dtype=float_dtype)
+        print(name, os.path.getsize(pickle_path), '->', os.path.getsize(file_path), 'bytes')
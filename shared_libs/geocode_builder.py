@@ -0,0 +1,870 @@
+import io
+import csv
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import requests
+
+import data_transform
+import geo_cache
+
+##################################################################################################
+#
+# Построение кэша геоданных (словари адресов и почтовых индексов, см. coord_dicts.ipynb) из командной строки:
+# запросы к геокодерам выполняются пулом из ограниченного числа асинхронных обработчиков, с ограничением
+# частоты запросов для каждого геокодера и повтором с экспоненциальной задержкой при временных ошибках.
+# Результаты (в т.ч. отрицательные - "адрес не найден") по мере получения сохраняются в SQLite-хранилище,
+# поэтому прерванное построение продолжается с того же места. Готовый кэш выгружается в pickle-файл
+# (формат словарей data_transform) или в компактный формат (см. geo_cache.py).
+#
+# $ python geocode_builder.py build --data ../model/data/data_target_cleared.csv --store geocache.sqlite --target address --providers osm,google --google-key KEY
+# $ python geocode_builder.py export --store geocache.sqlite --target address --output data/address_dict.pkl
+# $ python geocode_builder.py stub --port 8089   (локальный геокодер-заглушка для проверки, см. --stub)
+#
+##################################################################################################
+
+geocode_targets = ['address', 'zip']
+
+default_providers_urls = {
+    'osm': 'https://nominatim.openstreetmap.org/search',
+    'google': 'https://maps.googleapis.com/maps/api/geocode/json',
+    'census': 'https://geocoding.geo.census.gov/geocoder/locations/addressbatch'
+}
+
+# допустимая частота запросов (в секунду) по умолчанию: Nominatim разрешает 1 запрос в секунду
+default_providers_rates = {
+    'osm': 1,
+    'google': 40,
+    'census': 1
+}
+
+# пути геокодеров в заглушке (см. run_stub_geocoder)
+stub_providers_paths = {
+    'osm': '/osm/search',
+    'google': '/google/geocode/json',
+    'census': '/census/addressbatch'
+}
+
+request_timeout = 30
+
+
+class RetryableError(Exception):
+    """
+    Временная ошибка геокодера (сеть, превышение лимита, ошибка сервера) - запрос нужно повторить
+
+    Parameters:
+    message (str): Описание ошибки
+    retry_after (float): Рекомендуемая задержка перед повтором в секундах (None - по умолчанию)
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def get_retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def check_response(response):
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RetryableError('HTTP ' + str(response.status_code), get_retry_after(response))
+
+    response.raise_for_status()
+
+def get_location_record(lat, lng, location_type='', types=None):
+    # значение словарей адресов (см. get_address_location_info)
+    return {
+        'location': {'lat': float(lat), 'lng': float(lng)},
+        'location_type': location_type,
+        'types': [] if types is None else types
+    }
+
+##################################################################################################
+# Геокодеры: geocode_many получает список запросов (словари key, query, state, city, street, zipcode)
+# и возвращает для каждого значение словаря геоданных или None (не найден); временные ошибки - RetryableError
+##################################################################################################
+
+class OsmProvider:
+    """
+    Геокодер OpenStreetMap (Nominatim), по одному запросу
+
+    Parameters:
+    url (str): Адрес API поиска
+    user_agent (str): User-Agent запросов (обязателен для Nominatim)
+    """
+
+    name = 'osm'
+    batch_size = 1
+    targets = ['address', 'zip']
+
+    def __init__(self, url=default_providers_urls['osm'], user_agent='myapplication'):
+        self.url = url
+        self.user_agent = user_agent
+
+    def geocode_many(self, queries):
+        results = []
+        for query in queries:
+            try:
+                response = requests.get(
+                    self.url,
+                    params={'q': query['query'], 'format': 'json', 'limit': 1},
+                    headers={'User-Agent': self.user_agent},
+                    timeout=request_timeout
+                )
+            except requests.RequestException as ex:
+                raise RetryableError(str(ex))
+
+            check_response(response)
+
+            items = response.json()
+            results.append(None if len(items) == 0 else get_location_record(items[0]['lat'], items[0]['lon'], items[0].get('type', '')))
+
+        return results
+
+class GoogleProvider:
+    """
+    Геокодер Google Maps, по одному запросу
+
+    Parameters:
+    api_key (str): API key GMaps
+    url (str): Адрес API геокодирования
+    """
+
+    name = 'google'
+    batch_size = 1
+    targets = ['address', 'zip']
+
+    def __init__(self, api_key, url=default_providers_urls['google']):
+        self.api_key = api_key
+        self.url = url
+
+    def geocode_many(self, queries):
+        results = []
+        for query in queries:
+            try:
+                response = requests.get(self.url, params={'address': query['query'], 'key': self.api_key}, timeout=request_timeout)
+            except requests.RequestException as ex:
+                raise RetryableError(str(ex))
+
+            check_response(response)
+
+            payload = response.json()
+            status = payload.get('status')
+
+            if status == 'ZERO_RESULTS':
+                results.append(None)
+            elif status in ['OVER_QUERY_LIMIT', 'UNKNOWN_ERROR']:
+                raise RetryableError('Google status ' + status)
+            elif status != 'OK':
+                raise ValueError('Google status ' + str(status) + ': ' + str(payload.get('error_message')))
+            else:
+                result = payload['results'][0]
+                results.append(get_location_record(
+                    result['geometry']['location']['lat'],
+                    result['geometry']['location']['lng'],
+                    result['geometry'].get('location_type', ''),
+                    result.get('types', [])
+                ))
+
+        return results
+
+class CensusProvider:
+    """
+    Пакетный геокодер US Census Bureau (до 10000 адресов в одном запросе, только адреса с улицей)
+
+    Parameters:
+    url (str): Адрес API пакетного геокодирования
+    batch_size (int): Число адресов в одном запросе
+    """
+
+    name = 'census'
+    targets = ['address']
+
+    def __init__(self, url=default_providers_urls['census'], batch_size=1000):
+        self.url = url
+        self.batch_size = batch_size
+
+    def geocode_many(self, queries):
+        lines = io.StringIO()
+        writer = csv.writer(lines)
+        for indx, query in enumerate(queries):
+            writer.writerow([indx, query['street'], query['city'], query['state'], query['zipcode']])
+
+        try:
+            response = requests.post(
+                self.url,
+                data={'benchmark': 'Public_AR_Current'},
+                files={'addressFile': ('addresses.csv', lines.getvalue(), 'text/csv')},
+                timeout=request_timeout * 10
+            )
+        except requests.RequestException as ex:
+            raise RetryableError(str(ex))
+
+        check_response(response)
+
+        # строка ответа: id, адрес, Match/No_Match/Tie, точность, найденный адрес, "lng,lat", ...
+        results = [None] * len(queries)
+        for row in csv.reader(io.StringIO(response.text)):
+            if len(row) < 6 or row[2] != 'Match':
+                continue
+
+            lng, lat = row[5].split(',')
+            results[int(row[0])] = get_location_record(lat, lng, row[3])
+
+        return results
+
+class StubProvider:
+    """
+    Геокодер-заглушка без обращения к сети (координаты - как у run_stub_geocoder, без временных ошибок)
+    """
+
+    name = 'stub'
+    batch_size = 1000
+    targets = ['address', 'zip']
+
+    def geocode_many(self, queries):
+        results = []
+        for query in queries:
+            location = get_stub_location(query['query'])
+            results.append(None if location is None else get_location_record(location[0], location[1], 'stub'))
+
+        return results
+
+def create_provider(name, urls=None, google_key=None, census_batch_size=1000):
+    """
+    Функция создает геокодер по имени
+
+    Parameters:
+    name (str): Имя геокодера (osm, google, census, stub - заглушка без обращения к сети)
+    urls (dictionary): Адреса API геокодеров (None - default_providers_urls)
+    google_key (str): API key GMaps
+    census_batch_size (int): Число адресов в одном запросе к Census
+
+    Returns:
+    object: Геокодер
+    """
+
+    urls = default_providers_urls if urls is None else urls
+
+    if name == 'osm':
+        return OsmProvider(urls['osm'])
+    if name == 'google':
+        return GoogleProvider(google_key, urls['google'])
+    if name == 'census':
+        return CensusProvider(urls['census'], census_batch_size)
+    if name == 'stub':
+        return StubProvider()
+
+    raise ValueError('Unknown provider: ' + name)
+
+def get_providers_urls(args):
+    urls = dict(default_providers_urls)
+
+    if args.stub is not None:
+        for name, path in stub_providers_paths.items():
+            urls[name] = args.stub.rstrip('/') + path
+
+    for name in urls:
+        url = getattr(args, name + '_url', None)
+        if url is not None:
+            urls[name] = url
+
+    return urls
+
+##################################################################################################
+# Хранилище результатов
+##################################################################################################
+
+class GeocodeStore:
+    """
+    Хранилище результатов геокодирования (SQLite): для каждого ключа - координаты или отметка "не найден"
+
+    Parameters:
+    db_path (str): Путь к файлу хранилища
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # соединение может использоваться из разных потоков (см. GeocodeResolver), доступ к нему синхронизирует вызывающий код
+        self.connection = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS geocodes ('
+            'target TEXT, key TEXT, found INTEGER, lat REAL, lng REAL, location_type TEXT, provider TEXT, updated_at REAL, '
+            'PRIMARY KEY (target, key))'
+        )
+
+    def close(self):
+        self.connection.close()
+
+    def get_pending_keys(self, target, keys, negative_ttl):
+        """
+        Функция возвращает ключи, которые нужно геокодировать: еще не найденные и без свежей отметки "не найден"
+
+        Parameters:
+        target (str): Словарь (address или zip)
+        keys (list(str)): Ключи
+        negative_ttl (float): Время (в секундах), в течение которого отметка "не найден" не перепроверяется
+
+        Returns:
+        set(str): Ключи
+        """
+
+        done = set()
+        min_negative_time = time.time() - negative_ttl
+
+        for key, found, updated_at in self.connection.execute('SELECT key, found, updated_at FROM geocodes WHERE target = ?', [target]):
+            if found or updated_at >= min_negative_time:
+                done.add(key)
+
+        return set(keys) - done
+
+    def put_many(self, target, provider, results):
+        """
+        Функция сохраняет результаты геокодирования одной транзакцией
+
+        Parameters:
+        target (str): Словарь (address или zip)
+        provider (str): Имя геокодера
+        results (dictionary): Ключ -> значение словаря геоданных или None (не найден)
+        """
+
+        if len(results) == 0:
+            return
+
+        now = time.time()
+        rows = []
+        for key, loc_rec in results.items():
+            if loc_rec is None:
+                rows.append((target, key, 0, None, None, None, provider, now))
+            else:
+                rows.append((target, key, 1, loc_rec['location']['lat'], loc_rec['location']['lng'], loc_rec.get('location_type', ''), provider, now))
+
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.executemany('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def get(self, target, key):
+        """
+        Функция возвращает сохраненный результат геокодирования ключа
+
+        Parameters:
+        target (str): Словарь (address или zip)
+        key (str): Ключ
+
+        Returns:
+        tuple: Значение словаря геоданных (None - не найден) и время сохранения или None, если ключа нет в хранилище
+        """
+
+        row = self.connection.execute(
+            'SELECT found, lat, lng, location_type, updated_at FROM geocodes WHERE target = ? AND key = ?', [target, key]
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        found, lat, lng, location_type, updated_at = row
+        return (get_location_record(lat, lng, location_type) if found else None), updated_at
+
+    def get_dict(self, target, updated_after=None, limit=None):
+        """
+        Функция возвращает найденные координаты в формате словарей геоданных (см. get_addresses_dict)
+
+        Parameters:
+        target (str): Словарь (address или zip)
+        updated_after (float): Только результаты, сохраненные после этого времени (None - все)
+        limit (int): Только limit последних сохраненных результатов (None - все)
+
+        Returns:
+        dictionary: Ключ -> значение словаря геоданных (в порядке сохранения)
+        """
+
+        rows = self.connection.execute(
+            'SELECT key, lat, lng, location_type FROM geocodes WHERE target = ? AND found = 1 AND updated_at > ? '
+            'ORDER BY updated_at DESC LIMIT ?',
+            [target, -1 if updated_after is None else updated_after, -1 if limit is None else limit]
+        ).fetchall()
+        return {key: get_location_record(lat, lng, location_type) for key, lat, lng, location_type in reversed(rows)}
+
+    def reserve_request_time(self, provider, interval):
+        """
+        Функция резервирует время следующего запроса к геокодеру так, чтобы запросы всех процессов,
+        использующих хранилище, шли не чаще, чем раз в interval секунд
+
+        Parameters:
+        provider (str): Имя геокодера
+        interval (float): Минимальный интервал между запросами (в секундах)
+
+        Returns:
+        float: Время ожидания до зарезервированного запроса (в секундах)
+        """
+
+        self.connection.execute('CREATE TABLE IF NOT EXISTS request_times (provider TEXT PRIMARY KEY, next_time REAL)')
+
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = self.connection.execute('SELECT next_time FROM request_times WHERE provider = ?', [provider]).fetchone()
+
+            request_time = now if row is None else max(now, row[0])
+            self.connection.execute('INSERT OR REPLACE INTO request_times VALUES (?, ?)', [provider, request_time + interval])
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+        return request_time - now
+
+    def get_counts(self, target):
+        rows = self.connection.execute('SELECT found, COUNT(*) FROM geocodes WHERE target = ? GROUP BY found', [target]).fetchall()
+        counts = dict(rows)
+        return counts.get(1, 0), counts.get(0, 0)
+
+##################################################################################################
+# Построение кэша
+##################################################################################################
+
+class RateLimiter:
+    """
+    Ограничение частоты запросов: не чаще rate запросов в секунду (равномерно)
+
+    Parameters:
+    rate (float): Допустимая частота запросов (None или 0 - без ограничения)
+    """
+
+    def __init__(self, rate):
+        self.interval = 0 if not rate else 1.0 / rate
+        self.next_time = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_time > now:
+                await asyncio.sleep(self.next_time - now)
+                now = time.monotonic()
+
+            self.next_time = max(self.next_time, now) + self.interval
+
+async def call_with_retry(provider, limiter, queries, max_retries, backoff_base, backoff_max):
+    """
+    Функция выполняет запрос к геокодеру (в отдельном потоке) с повтором при временных ошибках
+
+    Returns:
+    list: Результаты запроса (см. geocode_many)
+    """
+
+    attempt = 0
+    while True:
+        await limiter.acquire()
+        try:
+            return await asyncio.to_thread(provider.geocode_many, queries)
+        except RetryableError as ex:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+
+            delay = min(backoff_base * 2**(attempt - 1), backoff_max) * random.uniform(0.5, 1.5)
+            if ex.retry_after is not None:
+                delay = max(delay, ex.retry_after)
+
+            await asyncio.sleep(delay)
+
+async def geocode_with_provider(provider, limiter, queries, store, target, args, stats, missed):
+    """
+    Функция геокодирует запросы одним геокодером пулом из args.workers обработчиков.
+    stats['not_found'] ведется по мере ответов: число ключей из missed (ключи, которые не нашел
+    ни один из опрошенных геокодеров)
+
+    Returns:
+    tuple: Ключи найденных адресов, ключи, которые геокодер не нашел, ключи с ошибкой
+    """
+
+    jobs = asyncio.Queue()
+    for pos in range(0, len(queries), provider.batch_size):
+        jobs.put_nowait(queries[pos:pos+provider.batch_size])
+
+    found = set()
+    not_found = set()
+    failed = set()
+
+    # найденные координаты сохраняются частями по checkpoint_size, отметки "не найден" - после всех геокодеров
+    checkpoint = {}
+
+    def flush():
+        store.put_many(target, provider.name, checkpoint)
+        checkpoint.clear()
+
+    async def worker():
+        while True:
+            try:
+                chunk = jobs.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            try:
+                results = await call_with_retry(provider, limiter, chunk, args.max_retries, args.backoff_base, args.backoff_max)
+            except Exception as ex:
+                failed.update(query['key'] for query in chunk)
+                stats['errors'] += len(chunk)
+                if args.verbose:
+                    print(provider.name, 'error:', ex)
+                continue
+
+            for query, loc_rec in zip(chunk, results):
+                if loc_rec is None:
+                    not_found.add(query['key'])
+                    if query['key'] not in missed:
+                        missed.add(query['key'])
+                        stats['not_found'] += 1
+                else:
+                    found.add(query['key'])
+                    checkpoint[query['key']] = loc_rec
+                    stats['found'] += 1
+                    if query['key'] in missed:
+                        missed.discard(query['key'])
+                        stats['not_found'] -= 1
+
+            stats['processed'] += len(chunk)
+            if len(checkpoint) >= args.checkpoint_size:
+                flush()
+
+            if stats['processed'] // args.progress_every != (stats['processed'] - len(chunk)) // args.progress_every:
+                print_progress(provider.name, stats)
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(args.workers)])
+    finally:
+        flush()
+
+    return found, not_found, failed
+
+def print_progress(provider_name, stats):
+    print('{}: processed {}, found {}, not found {}, errors {}'.format(
+        provider_name, stats['processed'], stats['found'], stats['not_found'], stats['errors']
+    ))
+
+async def build_geocache(queries, store, target, providers, args):
+    """
+    Функция геокодирует запросы цепочкой геокодеров: каждому следующему передаются ключи, не найденные предыдущими.
+    Ключ отмечается как "не найден" только если его не нашел ни один геокодер и ни один не вернул ошибку
+    (ключи с ошибкой будут запрошены снова при следующем запуске)
+
+    Parameters:
+    queries (list(dictionary)): Запросы (см. get_geocode_queries)
+    store (GeocodeStore): Хранилище результатов
+    target (str): Словарь (address или zip)
+    providers (list): Геокодеры
+    args (Namespace): Параметры построения
+
+    Returns:
+    dictionary: Статистика (processed, found, not_found, errors)
+    """
+
+    stats = {'processed': 0, 'found': 0, 'not_found': 0, 'errors': 0}
+    failed = set()
+    missed = set()
+
+    for provider in providers:
+        if target not in provider.targets or len(queries) == 0:
+            continue
+
+        limiter = RateLimiter(args.rates.get(provider.name, default_providers_rates.get(provider.name)))
+
+        found, _, provider_failed = await geocode_with_provider(provider, limiter, queries, store, target, args, stats, missed)
+
+        failed.update(provider_failed)
+        queries = [query for query in queries if query['key'] not in found]
+
+    not_found = {query['key']: None for query in queries if query['key'] not in failed}
+    store.put_many(target, 'all', not_found)
+    # итог без ключей, по которым один из геокодеров вернул ошибку
+    stats['not_found'] = len(not_found)
+
+    return stats
+
+def get_geocode_queries(df, target):
+    """
+    Функция возвращает различные запросы к геокодерам по датасету (штаты и города исправляются так же,
+    как и в fix_incorrect_states_and_cities, название города приводится к нижнему регистру)
+
+    Parameters:
+    df (DataFrame): Датасет с колонками state, city, street, zipcode
+    target (str): Словарь (address или zip)
+
+    Returns:
+    list(dictionary): Запросы (key, query, state, city, street, zipcode)
+    """
+
+    df = df[['state', 'city', 'street', 'zipcode']].dropna(subset=['state', 'city']).astype(str)
+    df['city'] = df['city'].str.lower()
+
+    for s_repl in data_transform.states_replace:
+        df.loc[df['state'] == s_repl[0], 'state'] = s_repl[1]
+
+    for c_repl in data_transform.cities_replaces:
+        df.loc[df['city'] == c_repl[0], 'city'] = np.NaN if pd.isna(c_repl[1]) else str.lower(c_repl[1])
+
+    df = df.dropna(subset=['city'])
+
+    queries = {}
+    for rec in df.itertuples(index=False):
+        query = get_geocode_query(target, rec.state, rec.city, rec.street, rec.zipcode)
+        if query['key'] not in queries:
+            queries[query['key']] = query
+
+    return list(queries.values())
+
+def get_geocode_query(target, state, city, street, zipcode):
+    """
+    Функция возвращает запрос к геокодерам: ключ словаря геоданных (он же - строка поиска) и части адреса
+
+    Parameters:
+    target (str): Словарь (address или zip)
+    state (str): Название штата
+    city (str): Название города
+    street (str): Адрес
+    zipcode (str): Почтовый индекс
+
+    Returns:
+    dictionary: Запрос (key, query, state, city, street, zipcode)
+    """
+
+    if target == 'address':
+        key = data_transform.get_address_dict_key(state, city, street)
+    else:
+        key = data_transform.get_address_zip_dict_key(state, city, zipcode)
+
+    return {'key': key, 'query': key, 'state': state, 'city': city, 'street': street, 'zipcode': zipcode}
+
+##################################################################################################
+# Локальный геокодер-заглушка (Nominatim, Google и Census в одном HTTP-сервере): координаты
+# детерминированно получаются из хэша запроса, часть адресов "не находится", часть запросов
+# завершается временной ошибкой (429/503) - для проверки повторов, лимитов и возобновления
+##################################################################################################
+
+def get_stub_location(query):
+    digest = hashlib.md5(query.encode('utf-8')).digest()
+    if digest[0] % 10 == 0:
+        return None
+
+    lat = 25 + int.from_bytes(digest[1:5], 'little') / 2**32 * 24
+    lng = -124 + int.from_bytes(digest[5:9], 'little') / 2**32 * 57
+    return lat, lng
+
+def create_stub_handler(fail_rate, seed):
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+
+    class StubGeocoderHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def should_fail(self):
+            with rng_lock:
+                value = rng.random()
+
+            if value < fail_rate / 2:
+                self.send_json(503, {'error': 'unavailable'})
+                return True
+            if value < fail_rate:
+                self.send_json(429, {'error': 'rate limit'}, {'Retry-After': '0'})
+                return True
+
+            return False
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            params = urllib.parse.parse_qs(url.query)
+
+            if self.should_fail():
+                return
+
+            if url.path == stub_providers_paths['osm']:
+                location = get_stub_location(params.get('q', [''])[0])
+                self.send_json(200, [] if location is None else [{'lat': str(location[0]), 'lon': str(location[1]), 'type': 'house'}])
+            elif url.path == stub_providers_paths['google']:
+                location = get_stub_location(params.get('address', [''])[0])
+                if location is None:
+                    self.send_json(200, {'status': 'ZERO_RESULTS', 'results': []})
+                else:
+                    self.send_json(200, {'status': 'OK', 'results': [{
+                        'geometry': {'location': {'lat': location[0], 'lng': location[1]}, 'location_type': 'ROOFTOP'},
+                        'types': ['street_address']
+                    }]})
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            if url.path != stub_providers_paths['census']:
+                self.send_json(404, {'error': 'not found'})
+                return
+
+            if self.should_fail():
+                return
+
+            # из multipart-тела берутся строки CSV вида id,street,city,state,zipcode
+            lines = []
+            for row in csv.reader(io.StringIO(body.decode('utf-8', errors='replace'))):
+                if len(row) != 5 or not row[0].isdigit():
+                    continue
+
+                location = get_stub_location(', '.join([row[3], row[2], row[1]]))
+                if location is None:
+                    lines.append([row[0], ', '.join(row[1:]), 'No_Match'])
+                else:
+                    lines.append([row[0], ', '.join(row[1:]), 'Match', 'Exact', ', '.join(row[1:]), str(location[1]) + ',' + str(location[0]), '0', 'L'])
+
+            output = io.StringIO()
+            csv.writer(output).writerows(lines)
+            data = output.getvalue().encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return StubGeocoderHandler
+
+def run_stub_geocoder(host='127.0.0.1', port=8089, fail_rate=0.1, seed=0):
+    """
+    Функция запускает локальный геокодер-заглушку (см. stub_providers_paths)
+
+    Parameters:
+    host (str): Адрес
+    port (int): Порт
+    fail_rate (float): Доля запросов, завершающихся временной ошибкой
+    seed (int): Начальное значение генератора ошибок
+
+    Returns:
+    ThreadingHTTPServer: Сервер (обработка запросов - serve_forever)
+    """
+
+    return ThreadingHTTPServer((host, port), create_stub_handler(fail_rate, seed))
+
+##################################################################################################
+# Командная строка
+##################################################################################################
+
+def parse_rates(values):
+    rates = {}
+    for value in values or []:
+        name, rate = value.split('=')
+        rates[name] = float(rate)
+
+    return rates
+
+def export_geocache(store, target, output):
+    geo_dict = store.get_dict(target)
+
+    if output.endswith(geo_cache.geo_cache_extension):
+        geo_cache.write_geo_cache(output, geo_dict, 'location')
+    else:
+        data_transform.write_pickle_file(output, geo_dict)
+
+    return len(geo_dict)
+
+def get_arguments_parser():
+    parser = argparse.ArgumentParser(description='Geocoding cache builder')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='geocode dataset addresses into the store')
+    build.add_argument('--data', required=True, help='CSV with state, city, street, zipcode columns')
+    build.add_argument('--store', required=True, help='SQLite store path')
+    build.add_argument('--target', choices=geocode_targets, default='address')
+    build.add_argument('--providers', default='osm', help='comma-separated provider chain: osm, google, census')
+    build.add_argument('--workers', type=int, default=4)
+    build.add_argument('--rate', action='append', help='provider rate limit, e.g. osm=1 (requests per second)')
+    build.add_argument('--max-retries', type=int, default=5)
+    build.add_argument('--backoff-base', type=float, default=1.0)
+    build.add_argument('--backoff-max', type=float, default=60.0)
+    build.add_argument('--checkpoint-size', type=int, default=50)
+    build.add_argument('--progress-every', type=int, default=500)
+    build.add_argument('--negative-ttl-days', type=float, default=30)
+    build.add_argument('--limit', type=int, default=None, help='geocode at most this many keys')
+    build.add_argument('--google-key', default=None)
+    build.add_argument('--census-batch-size', type=int, default=1000)
+    build.add_argument('--stub', default=None, help='base URL of the stub geocoder for all providers')
+    for name in default_providers_urls:
+        build.add_argument('--' + name + '-url', default=None)
+    build.add_argument('--verbose', action='store_true')
+
+    export = commands.add_parser('export', help='write found coordinates as a pickle or .geo dictionary')
+    export.add_argument('--store', required=True)
+    export.add_argument('--target', choices=geocode_targets, default='address')
+    export.add_argument('--output', required=True)
+
+    stub = commands.add_parser('stub', help='run the local stub geocoder')
+    stub.add_argument('--host', default='127.0.0.1')
+    stub.add_argument('--port', type=int, default=8089)
+    stub.add_argument('--fail-rate', type=float, default=0.1)
+    stub.add_argument('--seed', type=int, default=0)
+
+    return parser
+
+def main(argv=None):
+    args = get_arguments_parser().parse_args(argv)
+
+    if args.command == 'stub':
+        server = run_stub_geocoder(args.host, args.port, args.fail_rate, args.seed)
+        print('Stub geocoder on http://' + args.host + ':' + str(server.server_address[1]))
+        server.serve_forever()
+        return
+
+    store = GeocodeStore(args.store)
+    try:
+        if args.command == 'export':
+            print('Exported:', export_geocache(store, args.target, args.output))
+            return
+
+        args.rates = parse_rates(args.rate)
+        urls = get_providers_urls(args)
+        providers = [create_provider(name.strip(), urls, args.google_key, args.census_batch_size) for name in args.providers.split(',')]
+
+        queries = get_geocode_queries(pd.read_csv(args.data, dtype={'zipcode': str}), args.target)
+        pending = store.get_pending_keys(args.target, [query['key'] for query in queries], args.negative_ttl_days * 24*3600)
+        queries = [query for query in queries if query['key'] in pending][:args.limit]
+
+        print('Keys:', len(pending), 'to geocode now:', len(queries))
+
+        stats = asyncio.run(build_geocache(queries, store, args.target, providers, args))
+        print_progress('total', stats)
+
+        found, not_found = store.get_counts(args.target)
+        print('Store:', found, 'found,', not_found, 'not found')
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    main()
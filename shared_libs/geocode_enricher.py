@@ -0,0 +1,250 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+
+import pandas as pd
+
+import data_transform
+import geocode_builder
+import geocode_resolver
+import service_metrics
+
+##################################################################################################
+#
+# Фоновое геокодирование адресов, не найденных в словарях геоданных во время работы сервиса.
+# Сервис сразу отвечает с расстояниями по умолчанию, а адрес ставится в очередь (без повторов);
+# поток процесса геокодирует его через GeocodeResolver и сохраняет результат в хранилище SQLite,
+# общее для всех процессов. Найденные координаты дополняют словари адресов и почтовых индексов
+# (см. data_transform.GeoDictOverlay), так что следующие запросы с тем же адресом получают реальные расстояния
+#
+##################################################################################################
+
+service_metrics.describe_metric('fyp_geo_enrichment_queue_depth', 'gauge', 'Addresses waiting for background geocoding')
+service_metrics.describe_metric('fyp_geo_enrichment_submitted_total', 'counter', 'Unresolved addresses submitted for geocoding by result (queued, duplicate, dropped)')
+service_metrics.describe_metric('fyp_geo_enrichment_results_total', 'counter', 'Background geocoding results by source (address, zip, not_found)')
+service_metrics.describe_metric('fyp_geo_enrichment_duration_seconds', 'histogram', 'Background geocoding time of one address')
+
+# по умолчанию - только OSM (без API key)
+default_enrichment_providers = ['osm']
+
+# время (в секундах), в течение которого адрес, не найденный (или с ошибкой геокодера), не ставится в очередь снова
+default_retry_interval = 3600
+
+# число адресов (и почтовых индексов), найденных в фоне, хранимых в памяти процесса; вытесненные адреса
+# при следующем запросе снова ставятся в очередь и берутся из хранилища без обращения к геокодерам
+default_max_enriched_size = 100000
+
+# как часто (в секундах) процесс подгружает из хранилища координаты, найденные другими процессами
+default_refresh_interval = 10
+
+
+class GeocodeEnricher:
+    """
+    Очередь фонового геокодирования адресов (поток создается лениво в каждом рабочем процессе)
+
+    Parameters:
+    store_path (str): Путь к хранилищу SQLite, общему для всех процессов
+    providers_names (list(str)): Цепочка геокодеров (см. geocode_resolver.create_providers)
+    google_key (str): API key GMaps
+    providers_urls (dictionary): Адреса API геокодеров (None - по умолчанию)
+    max_queue_size (int): Максимальная длина очереди (адреса сверх нее отбрасываются)
+    rates (dictionary): Допустимая частота запросов к каждому геокодеру (в секунду) суммарно по всем процессам,
+        использующим хранилище (None - geocode_builder.default_providers_rates, геокодеры без частоты - без ограничения)
+    max_enriched_size (int): См. default_max_enriched_size
+    retry_interval (float): См. default_retry_interval
+    refresh_interval (float): См. default_refresh_interval
+    """
+
+    def __init__(self, store_path, providers_names=default_enrichment_providers, google_key=None, providers_urls=None, max_queue_size=10000,
+                 rates=None, max_enriched_size=default_max_enriched_size, retry_interval=default_retry_interval,
+                 refresh_interval=default_refresh_interval):
+
+        self.store_path = store_path
+        self.providers_names = providers_names
+        self.google_key = google_key
+        self.providers_urls = providers_urls
+        self.max_queue_size = max_queue_size
+        self.rates = geocode_builder.default_providers_rates if rates is None else rates
+        self.max_enriched_size = max_enriched_size
+        self.retry_interval = retry_interval
+        self.refresh_interval = refresh_interval
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.thread = None
+        self.thread_pid = None
+
+        self.reset()
+
+    def reset(self):
+        # состояние процесса: после fork очередь и найденные координаты начинаются заново (подгружаются из хранилища)
+        self.queue = deque()
+        self.pending = set()
+        self.attempted = OrderedDict()
+        self.enriched = {'address': OrderedDict(), 'zip': OrderedDict()}
+        self.resolver = None
+        self.last_refresh_time = None
+
+    def ensure_started(self):
+        # поток создается лениво в рабочем процессе: потоки мастер-процесса uWSGI не переживают fork
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive() or self.thread_pid != os.getpid():
+                self.reset()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread_pid = os.getpid()
+                self.thread.start()
+
+    def wrap_artifacts(self, artifacts):
+        """
+        Функция возвращает снимок артефактов, в котором словари адресов и почтовых индексов дополнены
+        координатами, найденными в фоне
+
+        Parameters:
+        artifacts (dictionary): Снимок артефактов (см. data_transform.get_serving_artifacts)
+
+        Returns:
+        dictionary: Снимок артефактов
+        """
+
+        self.ensure_started()
+
+        return dict(
+            artifacts,
+            address_dict=data_transform.GeoDictOverlay(artifacts['address_dict'], self.enriched['address']),
+            address_by_zip_dict=data_transform.GeoDictOverlay(artifacts['address_by_zip_dict'], self.enriched['zip'])
+        )
+
+    def submit(self, locations):
+        """
+        Функция ставит адреса в очередь геокодирования (без ожидания), пропуская уже стоящие в очереди
+        и недавно проверенные
+
+        Parameters:
+        locations (list): Адреса (state, city, street, zipcode), см. data_transform.get_unresolved_locations
+        """
+
+        if len(locations) == 0:
+            return
+
+        self.ensure_started()
+
+        counts = {'queued': 0, 'duplicate': 0, 'dropped': 0}
+        now = time.time()
+
+        with self.condition:
+            for location in locations:
+                key = data_transform.get_address_dict_key(location[0], location[1], location[2])
+
+                attempted_time = self.attempted.get(key)
+                if key in self.pending or (attempted_time is not None and attempted_time + self.retry_interval > now):
+                    counts['duplicate'] += 1
+                elif len(self.queue) >= self.max_queue_size:
+                    counts['dropped'] += 1
+                else:
+                    self.queue.append((key, location))
+                    self.pending.add(key)
+                    counts['queued'] += 1
+
+            queue_depth = len(self.queue)
+            self.condition.notify()
+
+        for result, count in counts.items():
+            if count > 0:
+                service_metrics.inc_counter('fyp_geo_enrichment_submitted_total', count, result=result)
+        service_metrics.set_gauge('fyp_geo_enrichment_queue_depth', queue_depth)
+
+    def get_queue_depth(self):
+        with self.lock:
+            return len(self.queue)
+
+    def run(self):
+        self.resolver = geocode_resolver.GeocodeResolver(
+            self.store_path,
+            geocode_resolver.create_providers(self.providers_names, self.google_key, self.providers_urls),
+            before_request=self.wait_request_time
+        )
+
+        while True:
+            with self.condition:
+                if len(self.queue) == 0:
+                    self.condition.wait(self.refresh_interval)
+
+                item = self.queue.popleft() if len(self.queue) > 0 else None
+                queue_depth = len(self.queue)
+
+            service_metrics.set_gauge('fyp_geo_enrichment_queue_depth', queue_depth)
+
+            try:
+                if self.last_refresh_time is None or time.time() - self.last_refresh_time >= self.refresh_interval:
+                    self.refresh()
+
+                if item is not None:
+                    self.enrich(*item)
+            except Exception:
+                # ошибка хранилища или геокодера не должна останавливать поток; адрес будет проверен позже
+                if item is not None:
+                    self.mark_attempted(item[0])
+            finally:
+                if item is not None:
+                    with self.lock:
+                        self.pending.discard(item[0])
+
+    def enrich(self, key, location):
+        state, city, street, zipcode = location
+
+        with service_metrics.measure_time('fyp_geo_enrichment_duration_seconds'):
+            result = 'not_found'
+
+            loc_rec = self.resolver.resolve_address(state, city, street)
+            if loc_rec is not None:
+                self.add_enriched('address', {key: loc_rec})
+                result = 'address'
+            elif not pd.isna(zipcode):
+                loc_rec = self.resolver.resolve_zipcode(state, city, zipcode)
+                if loc_rec is not None:
+                    self.add_enriched('zip', {data_transform.get_address_zip_dict_key(state, city, zipcode): loc_rec})
+                    result = 'zip'
+
+        if result == 'not_found':
+            self.mark_attempted(key)
+
+        service_metrics.inc_counter('fyp_geo_enrichment_results_total', result=result)
+
+    def mark_attempted(self, key):
+        with self.lock:
+            self.attempted[key] = time.time()
+            while len(self.attempted) > self.max_queue_size:
+                self.attempted.popitem(last=False)
+
+    def wait_request_time(self, provider_name):
+        # ограничение частоты запросов к геокодеру общее для всех процессов: время запроса резервируется в хранилище
+        rate = self.rates.get(provider_name)
+        if not rate:
+            return
+
+        with self.resolver.store_lock:
+            wait_time = self.resolver.store.reserve_request_time(provider_name, 1.0 / rate)
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def add_enriched(self, target, geo_dict):
+        # дополнение пополняется только потоком геокодирования; при переполнении вытесняются самые старые ключи
+        enriched = self.enriched[target]
+        for key, loc_rec in geo_dict.items():
+            enriched[key] = loc_rec
+
+        while len(enriched) > self.max_enriched_size:
+            enriched.popitem(last=False)
+
+    def refresh(self):
+        # координаты, найденные другими процессами (и сохраненные в хранилище ранее) - не больше max_enriched_size последних
+        refresh_time = time.time()
+
+        with self.resolver.store_lock:
+            for target in ['address', 'zip']:
+                self.add_enriched(target, self.resolver.store.get_dict(target, self.last_refresh_time, self.max_enriched_size))
+
+        # запас на запись, начатую до чтения
+        self.last_refresh_time = refresh_time - 1
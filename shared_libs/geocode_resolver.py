@@ -0,0 +1,263 @@
+import time
+import threading
+from collections import OrderedDict
+
+import geocode_builder
+
+##################################################################################################
+#
+# Единая точка получения координат адреса (или почтового индекса) по уровням:
+#   1. LRU-кэш в памяти процесса (ограниченного размера, в т.ч. отметки "не найден")
+#   2. словари геоданных (address_dict, address_by_zip_dict), если переданы
+#   3. постоянное хранилище SQLite (общее с geocode_builder.py)
+#   4. цепочка геокодеров (по умолчанию Google -> OSM -> Census)
+# Результат геокодера сохраняется в хранилище; "не найден" запоминается на negative_ttl секунд,
+# ошибки геокодеров не запоминаются (ключ будет запрошен снова)
+#
+##################################################################################################
+
+default_providers_chain = ['google', 'osm', 'census']
+
+default_lru_size = 10000
+
+# время (в секундах), в течение которого адрес, не найденный ни одним геокодером, не запрашивается снова
+default_negative_ttl = 30 * 24*3600
+
+resolver_tiers = ['lru', 'dict', 'store', 'provider']
+
+
+def create_providers(names=default_providers_chain, google_key=None, urls=None):
+    """
+    Функция создает цепочку геокодеров (Google пропускается, если не задан API key)
+
+    Parameters:
+    names (list(str)): Имена геокодеров в порядке опроса
+    google_key (str): API key GMaps
+    urls (dictionary): Адреса API геокодеров (None - geocode_builder.default_providers_urls)
+
+    Returns:
+    list: Геокодеры
+    """
+
+    return [
+        geocode_builder.create_provider(name, urls, google_key)
+        for name in names if name != 'google' or google_key is not None
+    ]
+
+
+class GeocodeResolver:
+    """
+    Получение координат по уровням кэша и цепочке геокодеров (потокобезопасно)
+
+    Parameters:
+    store_path (str): Путь к хранилищу SQLite (None - без постоянного хранилища)
+    providers (list): Цепочка геокодеров (см. create_providers, None - без обращения к геокодерам)
+    geo_dicts (dictionary): Словари геоданных по типу ключа ('address', 'zip'), проверяемые до хранилища
+    lru_size (int): Число ключей в LRU-кэше
+    negative_ttl (float): Время (в секундах) хранения отметки "не найден"
+    print_error (bool): Флаг вывода ошибок геокодеров в консоль
+    before_request (callable): Функция, вызываемая с именем геокодера перед каждым запросом к нему (ограничение частоты)
+    """
+
+    def __init__(self, store_path=None, providers=None, geo_dicts=None, lru_size=default_lru_size,
+                 negative_ttl=default_negative_ttl, print_error=False, before_request=None):
+
+        self.store = None if store_path is None else geocode_builder.GeocodeStore(store_path)
+        self.providers = [] if providers is None else providers
+        self.geo_dicts = {} if geo_dicts is None else geo_dicts
+        self.lru_size = lru_size
+        self.negative_ttl = negative_ttl
+        self.print_error = print_error
+        self.before_request = before_request
+
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.store_lock = threading.Lock()
+
+        self.reset_stats()
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'lookups': 0, 'hits': {tier: 0 for tier in resolver_tiers}, 'negative_hits': 0, 'not_found': 0, 'errors': 0}
+
+    def get_stats(self):
+        """
+        Функция возвращает статистику обращений: число запросов, попаданий по уровням, доля попаданий в кэш
+
+        Returns:
+        dictionary: Статистика (lookups, hits, negative_hits, not_found, errors, hit_rate)
+        """
+
+        with self.lock:
+            stats = {
+                'lookups': self.stats['lookups'],
+                'hits': dict(self.stats['hits']),
+                'negative_hits': self.stats['negative_hits'],
+                'not_found': self.stats['not_found'],
+                'errors': self.stats['errors']
+            }
+
+        cached = stats['hits']['lru'] + stats['hits']['dict'] + stats['hits']['store'] + stats['negative_hits']
+        stats['hit_rate'] = cached / stats['lookups'] if stats['lookups'] > 0 else 0.0
+
+        return stats
+
+    def count(self, name, tier=None):
+        with self.lock:
+            if tier is None:
+                self.stats[name] += 1
+            else:
+                self.stats[name][tier] += 1
+
+    def get_lru(self, lru_key):
+        # значение LRU-кэша: (значение словаря геоданных или None, время истечения отметки "не найден")
+        with self.lock:
+            item = self.lru.get(lru_key)
+            if item is None:
+                return None
+
+            if item[0] is None and item[1] <= time.time():
+                del self.lru[lru_key]
+                return None
+
+            self.lru.move_to_end(lru_key)
+            return item
+
+    def put_lru(self, lru_key, loc_rec, updated_at=None):
+        expires_at = None if loc_rec is not None else (time.time() if updated_at is None else updated_at) + self.negative_ttl
+
+        with self.lock:
+            self.lru[lru_key] = (loc_rec, expires_at)
+            self.lru.move_to_end(lru_key)
+
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def get_cached(self, target, key):
+        """
+        Функция ищет ключ в кэшах без обращения к геокодерам
+
+        Parameters:
+        target (str): Словарь (address или zip)
+        key (str): Ключ
+
+        Returns:
+        tuple: Признак наличия ключа в кэше и значение словаря геоданных (None - не найден)
+        """
+
+        lru_key = (target, key)
+
+        item = self.get_lru(lru_key)
+        if item is not None:
+            if item[0] is None:
+                self.count('negative_hits')
+            else:
+                self.count('hits', 'lru')
+            return True, item[0]
+
+        geo_dict = self.geo_dicts.get(target)
+        if geo_dict is not None:
+            loc_rec = geo_dict.get(key)
+            if loc_rec is not None:
+                self.count('hits', 'dict')
+                self.put_lru(lru_key, loc_rec)
+                return True, loc_rec
+
+        if self.store is not None:
+            with self.store_lock:
+                stored = self.store.get(target, key)
+
+            if stored is not None:
+                loc_rec, updated_at = stored
+                if loc_rec is not None:
+                    self.count('hits', 'store')
+                    self.put_lru(lru_key, loc_rec)
+                    return True, loc_rec
+
+                if updated_at + self.negative_ttl > time.time():
+                    self.count('negative_hits')
+                    self.put_lru(lru_key, None, updated_at)
+                    return True, None
+
+        return False, None
+
+    def resolve_query(self, target, query):
+        """
+        Функция возвращает координаты по запросу: из кэшей или, если ключа в них нет, от цепочки геокодеров
+
+        Parameters:
+        target (str): Словарь (address или zip)
+        query (dictionary): Запрос (см. geocode_builder.get_geocode_query)
+
+        Returns:
+        dictionary: Значение словаря геоданных или None (не найден или ошибка геокодеров)
+        """
+
+        self.count('lookups')
+
+        cached, loc_rec = self.get_cached(target, query['key'])
+        if cached:
+            return loc_rec
+
+        has_errors = False
+        has_answers = False
+        for provider in self.providers:
+            if target not in provider.targets:
+                continue
+
+            try:
+                if self.before_request is not None:
+                    self.before_request(provider.name)
+
+                loc_rec = provider.geocode_many([query])[0]
+            except Exception as ex:
+                has_errors = True
+                self.count('errors')
+                if self.print_error:
+                    print(provider.name, query['key'], ex)
+                continue
+
+            has_answers = True
+            if loc_rec is not None:
+                self.count('hits', 'provider')
+                self.save(target, provider.name, query['key'], loc_rec)
+                return loc_rec
+
+        # отметка "не найден" - только если геокодеры словаря были и все ответили без ошибок
+        # (без геокодеров, обслуживающих словарь, запрос ни разу не выполнялся)
+        if not has_errors and has_answers:
+            self.count('not_found')
+            self.save(target, 'all', query['key'], None)
+
+        return None
+
+    def save(self, target, provider_name, key, loc_rec):
+        self.put_lru((target, key), loc_rec)
+
+        if self.store is not None:
+            with self.store_lock:
+                self.store.put_many(target, provider_name, {key: loc_rec})
+
+    def resolve_address(self, state, city, street):
+        """
+        Функция возвращает координаты адреса (ключ - get_address_dict_key)
+
+        Returns:
+        dictionary: Значение словаря геоданных или None
+        """
+
+        return self.resolve_query('address', geocode_builder.get_geocode_query('address', state, city, street, None))
+
+    def resolve_zipcode(self, state, city, zipcode):
+        """
+        Функция возвращает координаты почтового индекса (ключ - get_address_zip_dict_key)
+
+        Returns:
+        dictionary: Значение словаря геоданных или None
+        """
+
+        return self.resolve_query('zip', geocode_builder.get_geocode_query('zip', state, city, None, zipcode))
@@ -0,0 +1,237 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+import fcntl
+
+##################################################################################################
+#
+# Кэш предсказаний, общий для всех рабочих процессов сервиса (SQLite-файл, по умолчанию в /dev/shm).
+# Ключ - хэш исходных полей записи и версии модели/артефактов (см. data_transform.get_records_cache_keys),
+# вытеснение - по TTL и по давности последнего обращения (LRU) при превышении max_size.
+# Время обращения при чтении накапливается в памяти процесса и записывается пакетами
+# (чтение не берет блокировку записи SQLite, общую для всех процессов).
+# Содержимое кэша может периодически сохраняться на диск (snapshot_path) и восстанавливаться при старте
+#
+##################################################################################################
+
+def get_default_cache_path():
+    cache_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(cache_dir, 'fyp_prediction_cache.sqlite')
+
+
+class PredictionCache:
+    """
+    Кэш предсказаний, разделяемый между процессами
+
+    Parameters:
+    db_path (str): Путь к файлу кэша (общий для всех процессов)
+    max_size (int): Максимальное число записей
+    ttl (float): Время жизни записи в секундах
+    snapshot_path (str): Путь для сохранения кэша на диск (None - не сохранять)
+    snapshot_interval (float): Интервал сохранения кэша на диск в секундах
+    access_flush_interval (float): Интервал записи накопленных времен обращения в секундах
+    print_error (bool): Флаг вывода ошибок в консоль
+    """
+
+    # SQLite ограничивает число параметров в одном запросе
+    keys_per_query = 500
+
+    # накопленные времена обращения записываются не реже, чем при таком их числе
+    access_flush_size = 5000
+
+    def __init__(self, db_path=None, max_size=200000, ttl=24*3600, snapshot_path=None, snapshot_interval=600, access_flush_interval=10, print_error=False):
+        self.db_path = get_default_cache_path() if db_path is None else db_path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.access_flush_interval = access_flush_interval
+        self.print_error = print_error
+
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+        self.inserts_since_evict = 0
+        self.last_snapshot_time = time.monotonic()
+        self.accessed = {}
+        self.last_access_flush_time = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_connection(self):
+        # соединение открывается в каждом процессе заново: соединения SQLite не переживают fork
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.init_db()
+
+            self.connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=OFF')
+            self.connection_pid = os.getpid()
+
+        return self.connection
+
+    def init_db(self):
+        with open(self.db_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if not os.path.exists(self.db_path) and self.snapshot_path is not None and os.path.exists(self.snapshot_path):
+                self.restore_snapshot()
+
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS predictions ('
+                'key TEXT PRIMARY KEY, value REAL, created_at REAL, accessed_at REAL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS predictions_accessed_at ON predictions (accessed_at)')
+            connection.close()
+
+    def get_many(self, keys):
+        """
+        Функция возвращает закэшированные предсказания
+
+        Parameters:
+        keys (list(str)): Ключи записей
+
+        Returns:
+        dictionary: Ключ -> предсказание (только найденные ключи)
+        """
+
+        result = {}
+        now = time.time()
+
+        try:
+            with self.lock:
+                connection = self.get_connection()
+
+                unique_keys = list(set(keys))
+                for pos in range(0, len(unique_keys), self.keys_per_query):
+                    part = unique_keys[pos:pos+self.keys_per_query]
+                    placeholders = ','.join(['?'] * len(part))
+
+                    rows = connection.execute(
+                        'SELECT key, value FROM predictions WHERE key IN (' + placeholders + ') AND created_at >= ?',
+                        part + [now - self.ttl]
+                    ).fetchall()
+
+                    for key, value in rows:
+                        result[key] = value
+                        self.accessed[key] = now
+
+                if len(self.accessed) >= self.access_flush_size or time.monotonic() - self.last_access_flush_time >= self.access_flush_interval:
+                    self.flush_accessed(connection)
+        except Exception as ex:
+            if self.print_error:
+                print(ex)
+
+        hits = sum(1 for key in keys if key in result)
+        self.hits += hits
+        self.misses += len(keys) - hits
+
+        return result
+
+    def set_many(self, items):
+        """
+        Функция сохраняет предсказания в кэш
+
+        Parameters:
+        items (dictionary): Ключ -> предсказание
+        """
+
+        if len(items) == 0:
+            return
+
+        now = time.time()
+
+        try:
+            with self.lock:
+                connection = self.get_connection()
+
+                connection.execute('BEGIN IMMEDIATE')
+                try:
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO predictions (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                        [(key, float(value), now, now) for key, value in items.items()]
+                    )
+                    connection.execute('COMMIT')
+                except Exception:
+                    connection.execute('ROLLBACK')
+                    raise
+
+                self.inserts_since_evict += len(items)
+                if self.inserts_since_evict >= max(self.max_size // 100, 1):
+                    # вытеснение по давности обращения учитывает все обращения процесса
+                    self.flush_accessed(connection)
+                    self.evict(connection, now)
+                    self.inserts_since_evict = 0
+
+            if self.snapshot_path is not None and time.monotonic() - self.last_snapshot_time >= self.snapshot_interval:
+                self.save_snapshot()
+        except Exception as ex:
+            if self.print_error:
+                print(ex)
+
+    def flush_accessed(self, connection):
+        # записываются времена обращения, накопленные процессом (одной транзакцией);
+        # при ошибке они отбрасываются - это влияет только на порядок вытеснения
+        accessed = self.accessed
+        self.accessed = {}
+        self.last_access_flush_time = time.monotonic()
+
+        if len(accessed) == 0:
+            return
+
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'UPDATE predictions SET accessed_at = ? WHERE key = ? AND accessed_at < ?',
+                [(accessed_at, key, accessed_at) for key, accessed_at in accessed.items()]
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def evict(self, connection, now):
+        connection.execute('DELETE FROM predictions WHERE created_at < ?', [now - self.ttl])
+
+        count = connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        if count > self.max_size:
+            connection.execute(
+                'DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY accessed_at LIMIT ?)',
+                [count - self.max_size]
+            )
+
+    def save_snapshot(self):
+        """
+        Функция сохраняет содержимое кэша на диск (атомарно, через временный файл)
+        """
+
+        self.last_snapshot_time = time.monotonic()
+
+        tmp_path = self.snapshot_path + '.tmp' + str(os.getpid())
+        with self.lock:
+            target = sqlite3.connect(tmp_path)
+            try:
+                self.get_connection().backup(target)
+            finally:
+                target.close()
+
+        os.replace(tmp_path, self.snapshot_path)
+
+    def restore_snapshot(self):
+        source = sqlite3.connect(self.snapshot_path)
+        target = sqlite3.connect(self.db_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -0,0 +1,377 @@
+import os
+import json
+import time
+import atexit
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+
+##################################################################################################
+#
+# Метрики сервиса (счетчики, gauge-метрики и гистограммы длительности) в формате Prometheus.
+# Каждый процесс накапливает метрики в памяти; после start_file_export (вызывается сервисом в мастер-процессе
+# uWSGI) процессы периодически сбрасывают их в свой файл в metrics_dir, и endpoint /metrics суммирует файлы
+# всех процессов. Файлы завершившихся процессов удаляются: их счетчики и гистограммы переносятся в общий
+# архивный файл (итоги не уменьшаются), gauge-метрики отбрасываются. Без start_file_export (ноутбуки, скрипты)
+# метрики остаются только в памяти процесса
+#
+##################################################################################################
+
+def get_default_metrics_dir():
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base_dir, 'fyp_metrics')
+
+metrics_dir = get_default_metrics_dir()
+
+file_export_enabled = False
+
+archive_file_name = 'archive.json'
+lock_file_name = '.lock'
+
+# Как часто (в секундах) процесс сбрасывает свои метрики в файл
+flush_interval = 1.0
+
+histogram_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+metrics_descriptions = {
+    'fyp_request_duration_seconds': ('histogram', 'Request processing time by endpoint'),
+    'fyp_request_rows_total': ('counter', 'Number of listings received by endpoint'),
+    'fyp_request_errors_total': ('counter', 'Number of failed requests'),
+    'fyp_stage_duration_seconds': ('histogram', 'Processing time of a pipeline stage'),
+    'fyp_stage_rows_total': ('counter', 'Number of rows processed by a pipeline stage'),
+    'fyp_geo_lookups_total': ('counter', 'Address coordinates lookups by source (address, zip, default)'),
+    'fyp_prediction_cache_lookups_total': ('counter', 'Prediction cache lookups by result (hit, miss)'),
+    'fyp_repr_parse_failures_total': ('counter', 'Structured fields (homeFacts, schools) that could not be parsed'),
+    'fyp_fast_path_fallbacks_total': ('counter', 'Rows the fast path could not transform, by error type (processed by the full pipeline)')
+}
+
+metrics_lock = threading.Lock()
+# сброс в файл из разных потоков (периодический и принудительный при запросе /metrics) выполняется по очереди
+flush_lock = threading.Lock()
+metrics_pid = None
+counters = {}
+gauges = {}
+histograms = {}
+last_flush_time = 0
+
+def describe_metric(name, metric_type, description):
+    metrics_descriptions[name] = (metric_type, description)
+
+def get_metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def reset_if_forked():
+    # после fork дочерний процесс не должен повторно учитывать метрики родителя
+    global metrics_pid, last_flush_time
+
+    if metrics_pid != os.getpid():
+        counters.clear()
+        gauges.clear()
+        histograms.clear()
+        metrics_pid = os.getpid()
+        last_flush_time = time.monotonic()
+
+def inc_counter(name, value=1, **labels):
+    with metrics_lock:
+        reset_if_forked()
+        key = get_metric_key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    flush_metrics()
+
+def set_gauge(name, value, **labels):
+    with metrics_lock:
+        reset_if_forked()
+        gauges[get_metric_key(name, labels)] = value
+
+    flush_metrics()
+
+def observe(name, value, **labels):
+    with metrics_lock:
+        reset_if_forked()
+        key = get_metric_key(name, labels)
+
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = {'buckets': [0] * len(histogram_buckets), 'sum': 0.0, 'count': 0}
+            histograms[key] = histogram
+
+        for indx, bound in enumerate(histogram_buckets):
+            if value <= bound:
+                histogram['buckets'][indx] += 1
+                break
+
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    flush_metrics()
+
+@contextmanager
+def measure_time(name, **labels):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start_time, **labels)
+
+@contextmanager
+def measure_stage(stage, rows_count):
+    """
+    Контекстный менеджер замера длительности этапа обработки и подсчета обработанных строк
+
+    Parameters:
+    stage (str): Имя этапа
+    rows_count (int): Число строк
+    """
+
+    with measure_time('fyp_stage_duration_seconds', stage=stage):
+        yield
+
+    inc_counter('fyp_stage_rows_total', rows_count, stage=stage)
+
+def start_file_export(clean=True):
+    """
+    Функция включает сброс метрик процесса (и процессов, созданных из него через fork) в файлы metrics_dir
+
+    Parameters:
+    clean (bool): Флаг удаления файлов, оставшихся от предыдущего запуска сервиса
+    """
+
+    global file_export_enabled
+
+    if clean:
+        try:
+            for file_name in os.listdir(metrics_dir):
+                if file_name.startswith('metrics_') or file_name == archive_file_name:
+                    os.remove(os.path.join(metrics_dir, file_name))
+        except OSError:
+            pass
+
+    file_export_enabled = True
+
+def get_process_start_time(pid):
+    # время запуска процесса (в тиках с загрузки системы) отличает процесс от более позднего с тем же pid
+    try:
+        with open('/proc/' + str(pid) + '/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return '0'
+
+def get_process_metrics_file(pid):
+    return os.path.join(metrics_dir, 'metrics_' + str(pid) + '_' + get_process_start_time(pid) + '.json')
+
+def is_process_file_alive(file_name):
+    # файл metrics_<pid>_<время запуска>.json принадлежит работающему процессу
+    try:
+        pid, start_time = file_name[len('metrics_'):-len('.json')].split('_')
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    except (ValueError, OSError):
+        return False
+
+    return start_time == '0' or get_process_start_time(pid) == start_time
+
+def flush_metrics(force=False):
+    """
+    Функция сбрасывает метрики процесса в его файл (не чаще, чем раз в flush_interval секунд)
+
+    Parameters:
+    force (bool): Флаг сброса независимо от интервала
+    """
+
+    global last_flush_time
+
+    if not file_export_enabled:
+        return
+
+    if not force and time.monotonic() - last_flush_time < flush_interval:
+        return
+
+    with flush_lock:
+        with metrics_lock:
+            reset_if_forked()
+            last_flush_time = time.monotonic()
+
+            data = {
+                'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+                'gauges': [[name, dict(labels), value] for (name, labels), value in gauges.items()],
+                'histograms': [[name, dict(labels), value] for (name, labels), value in histograms.items()]
+            }
+
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+            # уникальный временный файл: файл процесса не может оказаться частично записанным
+            file_path = get_process_metrics_file(os.getpid())
+            fd, tmp_file_path = tempfile.mkstemp(prefix='metrics_', suffix='.tmp', dir=metrics_dir)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_file_path, file_path)
+            except OSError:
+                os.unlink(tmp_file_path)
+                raise
+        except OSError:
+            pass
+
+atexit.register(lambda: flush_metrics(force=True))
+
+def add_metrics_data(result, data, with_gauges=True):
+    # данные файла метрик (списки [имя, метки, значение]) прибавляются к result (ключ - (имя, метки))
+    for metrics_type in ['counters', 'gauges'] if with_gauges else ['counters']:
+        for name, labels, value in data[metrics_type]:
+            key = get_metric_key(name, labels)
+            result[metrics_type][key] = result[metrics_type].get(key, 0) + value
+
+    for name, labels, value in data['histograms']:
+        key = get_metric_key(name, labels)
+        histogram = result['histograms'].get(key)
+        if histogram is None:
+            histogram = {'buckets': [0] * len(histogram_buckets), 'sum': 0.0, 'count': 0}
+            result['histograms'][key] = histogram
+
+        for indx, bucket_count in enumerate(value['buckets']):
+            histogram['buckets'][indx] += bucket_count
+        histogram['sum'] += value['sum']
+        histogram['count'] += value['count']
+
+def convert_to_metrics_data(result):
+    return {
+        metrics_type: [[name, dict(labels), value] for (name, labels), value in result[metrics_type].items()]
+        for metrics_type in ['counters', 'gauges', 'histograms']
+    }
+
+def read_metrics_file(file_path):
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def archive_dead_processes_files(file_names):
+    """
+    Функция переносит счетчики и гистограммы завершившихся процессов в архивный файл и удаляет их файлы
+    (вызывается под блокировкой каталога)
+
+    Parameters:
+    file_names (list(str)): Файлы процессов в metrics_dir
+
+    Returns:
+    list(str): Файлы работающих процессов
+    """
+
+    alive = [file_name for file_name in file_names if is_process_file_alive(file_name)]
+    dead = [file_name for file_name in file_names if file_name not in alive]
+
+    if len(dead) == 0:
+        return alive
+
+    archive_path = os.path.join(metrics_dir, archive_file_name)
+
+    archive = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    archive_data = read_metrics_file(archive_path)
+    if archive_data is not None:
+        add_metrics_data(archive, archive_data, with_gauges=False)
+
+    for file_name in dead:
+        data = read_metrics_file(os.path.join(metrics_dir, file_name))
+        if data is not None:
+            add_metrics_data(archive, data, with_gauges=False)
+
+    with open(archive_path + '.tmp', 'w') as f:
+        json.dump(convert_to_metrics_data(archive), f)
+    os.replace(archive_path + '.tmp', archive_path)
+
+    for file_name in dead:
+        os.remove(os.path.join(metrics_dir, file_name))
+
+    return alive
+
+def collect_metrics():
+    """
+    Функция суммирует метрики всех процессов (gauge-метрики - только работающих)
+
+    Returns:
+    dictionary: counters, gauges, histograms (ключ - (имя, метки))
+    """
+
+    result = {'counters': {}, 'gauges': {}, 'histograms': {}}
+
+    if not file_export_enabled:
+        with metrics_lock:
+            reset_if_forked()
+            add_metrics_data(result, convert_to_metrics_data({'counters': counters, 'gauges': gauges, 'histograms': histograms}))
+        return result
+
+    flush_metrics(force=True)
+
+    try:
+        with open(os.path.join(metrics_dir, lock_file_name), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            file_names = [x for x in os.listdir(metrics_dir) if x.startswith('metrics_') and x.endswith('.json')]
+            file_names = archive_dead_processes_files(file_names)
+
+            archive_data = read_metrics_file(os.path.join(metrics_dir, archive_file_name))
+    except OSError:
+        return result
+
+    if archive_data is not None:
+        add_metrics_data(result, archive_data, with_gauges=False)
+
+    for file_name in file_names:
+        data = read_metrics_file(os.path.join(metrics_dir, file_name))
+        if data is not None:
+            add_metrics_data(result, data)
+
+    return result
+
+def format_labels(labels, extra_labels=None):
+    labels = list(labels) + ([] if extra_labels is None else list(extra_labels))
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in labels) + '}'
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_prometheus():
+    """
+    Функция формирует текст метрик всех процессов в формате Prometheus
+
+    Returns:
+    str: Метрики в текстовом формате Prometheus
+    """
+
+    metrics = collect_metrics()
+
+    by_name = {}
+    for metrics_type in ['counters', 'gauges', 'histograms']:
+        for (name, labels), value in metrics[metrics_type].items():
+            by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(by_name.keys()):
+        metric_type, description = metrics_descriptions.get(name, ('untyped', name))
+        lines.append('# HELP ' + name + ' ' + description)
+        lines.append('# TYPE ' + name + ' ' + metric_type)
+
+        for labels, value in sorted(by_name[name], key=lambda x: x[0]):
+            if metric_type != 'histogram':
+                lines.append(name + format_labels(labels) + ' ' + format_number(value))
+                continue
+
+            cumulative = 0
+            for bound, bucket_count in zip(histogram_buckets, value['buckets']):
+                cumulative += bucket_count
+                lines.append(name + '_bucket' + format_labels(labels, [('le', repr(bound))]) + ' ' + str(cumulative))
+            lines.append(name + '_bucket' + format_labels(labels, [('le', '+Inf')]) + ' ' + str(value['count']))
+            lines.append(name + '_sum' + format_labels(labels) + ' ' + format_number(value['sum']))
+            lines.append(name + '_count' + format_labels(labels) + ' ' + str(value['count']))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+
+from sklearn.ensemble import AdaBoostRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+##################################################################################################
+#
+# Представление обученного AdaBoostRegressor (над DecisionTreeRegressor) в виде плоских массивов NumPy:
+# узлы всех деревьев хранятся подряд (признак, порог, дочерние узлы, значение), предсказание -
+# векторизованный обход всех деревьев сразу для всего пакета и взвешенная медиана, как в sklearn
+#
+##################################################################################################
+
+# тип, к которому sklearn приводит признаки перед обходом дерева (sklearn.tree._tree.DTYPE)
+tree_input_dtype = np.float32
+
+def export_tree_ensemble(model):
+    """
+    Функция преобразует обученную модель в словарь плоских массивов узлов
+
+    Parameters:
+    model (AdaBoostRegressor): Обученная модель над DecisionTreeRegressor
+
+    Returns:
+    dictionary: Массивы модели (см. TreeEnsemble)
+    """
+
+    if not isinstance(model, AdaBoostRegressor):
+        raise ValueError('Unsupported model type: ' + type(model).__name__)
+
+    estimators = model.estimators_
+    for estimator in estimators:
+        if not isinstance(estimator, DecisionTreeRegressor) or estimator.n_outputs_ != 1:
+            raise ValueError('Unsupported estimator type: ' + type(estimator).__name__)
+
+    node_counts = [estimator.tree_.node_count for estimator in estimators]
+    roots = np.concatenate([[0], np.cumsum(node_counts)[:-1]]).astype(np.int64)
+
+    feature = []
+    threshold = []
+    children_left = []
+    children_right = []
+    value = []
+
+    for root, estimator in zip(roots, estimators):
+        tree = estimator.tree_
+        is_leaf = tree.children_left == -1
+
+        # дочерние узлы переводятся в сквозную нумерацию, лист ссылается сам на себя
+        own_index = np.arange(tree.node_count, dtype=np.int64) + root
+
+        feature.append(np.where(is_leaf, 0, tree.feature).astype(np.int64))
+        threshold.append(tree.threshold.astype(np.float64))
+        children_left.append(np.where(is_leaf, own_index, tree.children_left + root).astype(np.int64))
+        children_right.append(np.where(is_leaf, own_index, tree.children_right + root).astype(np.int64))
+        value.append(tree.value[:, 0, 0].astype(np.float64))
+
+    feature_names = getattr(model, 'feature_names_in_', None)
+
+    return {
+        'feature': np.concatenate(feature),
+        'threshold': np.concatenate(threshold),
+        'children_left': np.concatenate(children_left),
+        'children_right': np.concatenate(children_right),
+        'value': np.concatenate(value),
+        'roots': roots,
+        'estimator_weights': np.asarray(model.estimator_weights_[:len(estimators)], dtype=np.float64),
+        'feature_names': np.array([] if feature_names is None else list(feature_names), dtype=str)
+    }
+
+def save_tree_ensemble(file_path, arrays):
+    np.savez(file_path, **arrays)
+
+def load_tree_ensemble(file_path):
+    with np.load(file_path, allow_pickle=False) as data:
+        return TreeEnsemble({name: data[name] for name in data.files})
+
+
+class TreeEnsemble:
+    """
+    Модель, восстановленная из плоских массивов (см. export_tree_ensemble).
+    predict дает те же значения, что и AdaBoostRegressor.predict исходной модели
+
+    Parameters:
+    arrays (dictionary): Массивы модели
+    """
+
+    def __init__(self, arrays):
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.children_left = arrays['children_left']
+        self.children_right = arrays['children_right']
+        self.value = arrays['value']
+        self.roots = arrays['roots']
+        self.estimator_weights = arrays['estimator_weights']
+        self.feature_names_in_ = arrays['feature_names'] if len(arrays['feature_names']) > 0 else None
+
+        # лист ссылается сам на себя (см. export_tree_ensemble)
+        self.is_leaf = self.children_left == np.arange(len(self.children_left))
+
+    @classmethod
+    def from_model(cls, model):
+        return cls(export_tree_ensemble(model))
+
+    def get_input_matrix(self, X):
+        if isinstance(X, pd.DataFrame):
+            if self.feature_names_in_ is not None and not np.array_equal(X.columns, self.feature_names_in_):
+                X = X[list(self.feature_names_in_)]
+
+            X = X.to_numpy()
+
+        # как и check_array в sklearn: NaN, бесконечность и значения, не помещающиеся в float32, - ошибка
+        with np.errstate(over='ignore'):
+            X = np.ascontiguousarray(X, dtype=tree_input_dtype)
+
+        if not np.isfinite(X).all():
+            raise ValueError('Input contains NaN, infinity or a value too large for ' + repr(X.dtype) + '.')
+
+        return X
+
+    def apply(self, X):
+        """
+        Функция возвращает номера листьев (в сквозной нумерации) для каждой записи и каждого дерева
+
+        Parameters:
+        X (DataFrame или ndarray): Признаки
+
+        Returns:
+        ndarray: Матрица (записи x деревья) номеров листьев
+        """
+
+        X = self.get_input_matrix(X)
+        n_rows, n_features = X.shape
+
+        # пары (запись, дерево) в плоском виде; на каждом шаге продвигаются только те, что еще не в листе
+        nodes = np.tile(self.roots, n_rows)
+        row_offsets = np.repeat(np.arange(n_rows, dtype=np.int64) * n_features, len(self.roots))
+        X = X.ravel()
+
+        active = np.flatnonzero(~self.is_leaf[nodes])
+        while len(active) > 0:
+            active_nodes = nodes[active]
+
+            # сравнение как в sklearn: признак float32 против порога float64
+            go_left = X[row_offsets[active] + self.feature[active_nodes]] <= self.threshold[active_nodes]
+            active_nodes = np.where(go_left, self.children_left[active_nodes], self.children_right[active_nodes])
+
+            nodes[active] = active_nodes
+            active = active[~self.is_leaf[active_nodes]]
+
+        return nodes.reshape(n_rows, len(self.roots))
+
+    def predict_estimators(self, X):
+        return self.value[self.apply(X)]
+
+    def predict(self, X):
+        """
+        Функция возвращает предсказания - взвешенную медиану предсказаний деревьев
+        (повторяет AdaBoostRegressor._get_median_predict)
+
+        Parameters:
+        X (DataFrame или ndarray): Признаки
+
+        Returns:
+        ndarray: Предсказания
+        """
+
+        predictions = self.predict_estimators(X)
+
+        sorted_idx = np.argsort(predictions, axis=1)
+        weight_cdf = np.cumsum(self.estimator_weights[sorted_idx], axis=1, dtype=np.float64)
+        median_or_above = weight_cdf >= 0.5 * weight_cdf[:, -1][:, np.newaxis]
+        median_idx = median_or_above.argmax(axis=1)
+
+        rows = np.arange(predictions.shape[0])
+        median_estimators = sorted_idx[rows, median_idx]
+
+        return predictions[rows, median_estimators]